@@ -7,19 +7,104 @@ unico gigantesco processor.py. Ora sono suddivise in più file specializzati:
 
 - extract.py
     - phase_extract()
-      Estrae toponimi dal PDF + genera PDF marcato, CSV, attestazioni JSON ecc.
+      Estrae toponimi dal PDF + genera CSV, attestazioni JSON ecc.
+
+- refilter.py
+    - phase_refilter()
+      Re-filtro: riapplica le euristiche di contesto (con ALWAYS_ALLOW,
+      COMMON_FIRST_NAMES... modificati) ai Doc salvati dall'estrazione e
+      rigenera CSV ed esclusi in pochi secondi.
+
+- docstore.py
+    - DocStore
+      Doc spaCy per pagina dell'ultima estrazione (extract_docs/) e
+      manifest delle pagine, letti dal re-filtro.
 
 - geocode.py
     - phase_geocode()
       Geocoding "legacy": per ogni riga/pagina.
     - phase_geocode_grouped()
       Geocoding "nuovo": una volta per toponimo, con progress callback,
-      rispettando eventuali esclusioni utente.
+      rispettando eventuali esclusioni utente; più toponimi in parallelo
+      entro i limiti dell'endpoint (token bucket per NOMINATIM_BASE_URL);
+      /search senza poligoni, poi i poligoni dei vincitori da /lookup.
+    - set_geocode_correction()
+      Correzione dell'utente (punto o rifiuto) valida solo nel job.
+
+- geocache.py
+    - GeoCache, open_geocache()
+      Cache delle risposte Nominatim su SQLite (WAL, upsert per voce,
+      thread-safe); importa il vecchio geocache_toponyms.json.
+      Livello condiviso tra i job (TTL, tetto LRU) + livello del job
+      per le correzioni dell'utente.
+
+- marking.py
+    - phase_mark(), ensure_marked_pdf(), iter_marked_pdf()
+      Costruzione di annale_marked.pdf dai box delle attestazioni, separata
+      dall'estrazione (in background, al primo download o saltata); PDF
+      intero, sole pagine elaborate oppure overlay incrementale.
+
+- attestations.py
+    - AttestationWriter, read_term_occurrences(), iter_attestations()
+      Attestazioni e vista "tagged" in NDJSON scritti pagina per pagina,
+      con indice compatto per leggere le occorrenze di un solo toponimo.
 
 - exclusions.py
     - load_user_exclusions(), save_user_exclusions(), apply_exclusions_to_csv()
       Gestione stato esclusioni (globali + per pagina) e rigenerazione CSV filtrato.
 
+- pagetext.py
+    - PageTextLayer, PageWordIndex, TermMatcher
+      Strato testuale unico per pagina (footer, ID, corpo, parole da un solo
+      TextPage), indice parole + matcher multi-termine per i box degli highlight.
+
+- rules.py
+    - ContextRules, DEFAULT_RULES
+      Euristiche di contesto dei toponimi (insiemi di parole, verbi, date)
+      compilate una volta e valutate con caratteristiche calcolate per Doc.
+
+- component.py
+    - ContextFilter, add_context_filter(), toponym_candidates()
+      Le stesse euristiche come componente spaCy ("toponym_context_filter"):
+      ogni entità annotata come tenuta/esclusa con motivo (ent._.toponym_status,
+      doc._.toponyms), anche dentro nlp.pipe(n_process=...).
+
+- bench.py
+    Benchmark da riga di comando (python -m processor.bench ...).
+
+- batch.py (+ __main__.py)
+    - run_batch()
+      Elaborazione in blocco senza server: python -m processor <cartella|glob>
+      estrae (e geocoda) ogni PDF con un process pool, riprende i file già
+      completati e stampa il riepilogo (pagine/secondo).
+
+- prescan.py
+    - PagePrescan
+      Pre-scansione veloce: pagine solo immagine, quasi vuote o duplicate
+      vengono saltate prima della NER.
+
+- checkpoint.py
+    - ExtractCheckpoint
+      Checkpoint di pagina per riprendere un'estrazione interrotta.
+
+- pagecache.py
+    - PageCache, page_content_key()
+      Cache per pagina indirizzata per contenuto (re-run incrementali).
+
+- nercache.py
+    - NerCache, get_ner_cache()
+      Cache NER condivisa tra i job (Doc spaCy in DocBin, chiave = testo +
+      modello), con dimensione massima ed eliminazione LRU.
+
+- profiles.py
+    - EXTRACT_PROFILES, profile_nlp(), describe_profiles()
+      Profili di estrazione (fast / balanced / accurate): modello,
+      componenti spaCy, batch_size, worker e context_mode con un nome.
+
+- models.py
+    - get_nlp(), preload_async(), model_status()
+      Registro process-wide del modello spaCy (caricato una volta sola).
+
 - utils.py
     - list_outputs(), group_toponyms()
       Utility per popolare il pannello download e i conteggi toponimici.
@@ -30,7 +115,12 @@ senza cambiare troppo.
 """
 
 from .extract import phase_extract
-from .geocode import phase_geocode, phase_geocode_grouped
+from .refilter import phase_refilter
+from .marking import phase_mark, ensure_marked_pdf, iter_marked_pdf
+from .attestations import read_term_occurrences, iter_attestations
+from .models import get_nlp, preload_async, model_status
+from .profiles import EXTRACT_PROFILES, describe_profiles
+from .geocode import phase_geocode, phase_geocode_grouped, set_geocode_correction
 from .utils import list_outputs, group_toponyms
 from .exclusions import (
     load_user_exclusions,
@@ -40,8 +130,20 @@ from .exclusions import (
 
 __all__ = [
     "phase_extract",
+    "phase_refilter",
+    "phase_mark",
+    "ensure_marked_pdf",
+    "iter_marked_pdf",
+    "read_term_occurrences",
+    "iter_attestations",
     "phase_geocode",
     "phase_geocode_grouped",
+    "set_geocode_correction",
+    "get_nlp",
+    "preload_async",
+    "model_status",
+    "EXTRACT_PROFILES",
+    "describe_profiles",
     "list_outputs",
     "group_toponyms",
     "load_user_exclusions",
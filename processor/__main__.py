@@ -0,0 +1,8 @@
+# processor/__main__.py
+"""python -m processor: elaborazione in blocco di PDF (vedi batch.py)."""
+
+import sys
+
+from .batch import main
+
+sys.exit(main())
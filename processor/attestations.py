@@ -0,0 +1,160 @@
+# processor/attestations.py
+"""
+Output delle attestazioni in streaming (NDJSON), scritti pagina per pagina
+durante phase_extract() invece di un json.dump finale di tutto il documento.
+
+File nel job:
+  annale_attestazioni.ndjson
+      una riga per attestazione (termine su una pagina), in ordine di pagina:
+      {"norm", "term", "page_label", "pdf_page_index", "boxes", "snippet", "prev"}
+      "prev" = offset in byte della riga precedente con la stessa "norm"
+      (None per la prima): le occorrenze di un termine formano una catena.
+
+  annale_tagged.ndjson
+      una riga per pagina elaborata:
+      {"page", "pdf_page_index", "attestations": [{"term", "snippet"}, ...]}
+
+  annale_attestazioni_index.json
+      indice compatto, una voce per toponimo (non per occorrenza):
+      {"<norm>": {"term_display", "count", "last"}}
+      "last" = offset dell'ultima occorrenza, da cui si risale la catena.
+
+In memoria resta solo l'indice (una voce per toponimo distinto), quindi
+l'occupazione non cresce con il numero di pagine; per leggere le
+occorrenze di un termine basta read_term_occurrences(), che salta alle
+sole righe di quel termine.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+from typing import Dict, Iterator, List, Optional
+
+from .utils import normalize_name
+
+ATTEST_NDJSON_NAME = "annale_attestazioni.ndjson"
+TAGGED_NDJSON_NAME = "annale_tagged.ndjson"
+ATTEST_INDEX_NAME = "annale_attestazioni_index.json"
+
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+class AttestationWriter:
+    """Scrive attestazioni e vista "tagged" di ogni pagina appena è pronta."""
+
+    def __init__(self, out_dir: str):
+        self.attest_path = os.path.join(out_dir, ATTEST_NDJSON_NAME)
+        self.tagged_path = os.path.join(out_dir, TAGGED_NDJSON_NAME)
+        self.index_path = os.path.join(out_dir, ATTEST_INDEX_NAME)
+        self.index: Dict[str, Dict] = {}
+        # modalità binaria: gli offset dell'indice sono offset in byte
+        self._attf = open(self.attest_path, "wb")
+        self._tagf = open(self.tagged_path, "wb")
+
+    def add_page(self, page_label, pdf_page_index: int, terms: List[Dict]):
+        """`terms` = [{"term", "boxes", "snippet"}, ...] di una pagina (analyze_page)."""
+        page_tag_attest: List[Dict] = []
+        for item in terms:
+            term = item["term"]
+            norm = normalize_name(term)
+            entry = self.index.get(norm)
+            if entry is None:
+                entry = self.index[norm] = {"term_display": term, "count": 0, "last": None}
+            elif len(term) < len(entry["term_display"]):
+                entry["term_display"] = term
+
+            offset = self._attf.tell()
+            self._attf.write((_dumps({
+                "norm": norm,
+                "term": term,
+                "page_label": page_label,
+                "pdf_page_index": pdf_page_index,
+                "boxes": [list(b) for b in item["boxes"]],
+                "snippet": item["snippet"],
+                "prev": entry["last"],
+            }) + "\n").encode("utf-8"))
+            entry["last"] = offset
+            entry["count"] += 1
+
+            page_tag_attest.append({"term": term, "snippet": item["snippet"]})
+
+        self._tagf.write((_dumps({
+            "page": page_label,
+            "pdf_page_index": pdf_page_index,
+            "attestations": page_tag_attest,
+        }) + "\n").encode("utf-8"))
+
+    def close(self):
+        self._attf.close()
+        self._tagf.close()
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(_dumps(self.index))
+        os.replace(tmp, self.index_path)
+
+    def abort(self):
+        """
+        Chiude i file dopo un errore e li elimina, con l'indice della run
+        precedente: i suoi offset non corrisponderebbero più all'NDJSON.
+        """
+        self._attf.close()
+        self._tagf.close()
+        for p in (self.attest_path, self.tagged_path, self.index_path):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+# ---------------- Lettura ----------------
+
+def load_attest_index(out_dir: str) -> Dict[str, Dict]:
+    """Indice compatto {norm: {"term_display", "count", "last"}} ({} se assente)."""
+    path = os.path.join(out_dir, ATTEST_INDEX_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_term_occurrences(out_dir: str, term: str,
+                          index: Optional[Dict[str, Dict]] = None) -> List[Dict]:
+    """
+    Occorrenze di un toponimo (forma qualsiasi: viene normalizzata), in
+    ordine di pagina, leggendo solo le sue righe dell'NDJSON.
+    """
+    index = load_attest_index(out_dir) if index is None else index
+    entry = index.get(normalize_name(term))
+    if not entry:
+        return []
+    occs: List[Dict] = []
+    offset = entry.get("last")
+    with open(os.path.join(out_dir, ATTEST_NDJSON_NAME), "rb") as f:
+        while offset is not None:
+            f.seek(offset)
+            occ = json.loads(f.readline().decode("utf-8"))
+            offset = occ.pop("prev", None)
+            occs.append(occ)
+    occs.reverse()
+    return occs
+
+
+def _iter_ndjson(path: str) -> Iterator[Dict]:
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_attestations(out_dir: str) -> Iterator[Dict]:
+    """Tutte le attestazioni, una alla volta, in ordine di pagina."""
+    return _iter_ndjson(os.path.join(out_dir, ATTEST_NDJSON_NAME))
+
+
+def iter_tagged_pages(out_dir: str) -> Iterator[Dict]:
+    """Le pagine elaborate (una riga di annale_tagged.ndjson ciascuna), in ordine."""
+    return _iter_ndjson(os.path.join(out_dir, TAGGED_NDJSON_NAME))
@@ -0,0 +1,294 @@
+# processor/batch.py
+"""
+Elaborazione in blocco da riga di comando, senza server Flask.
+
+Uso:
+    python -m processor annali/ --out risultati/ --workers 4 --geocode
+    python -m processor "annali/**/*.pdf" --out risultati/ --profile fast --ranges 51-104
+
+Per ogni PDF (cartella, glob o file singolo) una cartella di job
+<out>/<nome_pdf>/ con gli stessi output di /api/extract (CSV, esclusi,
+attestazioni, ...) e, con --geocode, di phase_geocode_grouped.
+
+- I file vengono estratti da un process pool di --workers processi
+  (BATCH_WORKERS). Il modello spaCy è caricato prima del fork: i processi
+  lo condividono copy-on-write invece di caricarne una copia ciascuno.
+- Il geocoding gira nel processo principale, un file alla volta, man mano
+  che le estrazioni finiscono (entro i limiti dell'endpoint Nominatim, vedi
+  geocode.py) con una geocache unica per tutto il batch
+  (<out>/geocache_toponyms.sqlite).
+- A file completato viene scritto <job>/batch_done.json (impronta del PDF
+  e opzioni): rilanciando lo stesso comando i file già fatti vengono
+  saltati. Un'estrazione interrotta a metà riparte dal checkpoint di pagina.
+- Alla fine: file fatti / saltati / falliti, pagine e pagine al secondo.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from typing import Any, Dict, List, Optional, Tuple
+
+from .checkpoint import pdf_fingerprint
+from .extract import phase_extract, try_load_spacy, CONTEXT_MODES
+from .geocode import phase_geocode_grouped
+from .geocache import GEOCACHE_DB_NAME
+from .profiles import EXTRACT_PROFILES, EXTRACT_PROFILE, profile_nlp
+
+logger = logging.getLogger(__name__)
+
+BATCH_DONE_NAME = "batch_done.json"
+GEOCACHE_NAME = GEOCACHE_DB_NAME
+
+# file estratti in parallelo (1 = uno alla volta, nel processo principale)
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "1"))
+
+
+# ---------------- File e cartelle di job ----------------
+
+def find_pdfs(inputs: List[str], recursive: bool = False) -> List[str]:
+    """PDF indicati da cartelle, glob o file, senza duplicati, in ordine."""
+    found: List[str] = []
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, "**", "*") if recursive else os.path.join(item, "*")
+            paths = glob.glob(pattern, recursive=recursive)
+        elif os.path.isfile(item):
+            paths = [item]
+        else:
+            paths = glob.glob(item, recursive=True)
+        found.extend(p for p in sorted(paths)
+                     if os.path.isfile(p) and p.lower().endswith(".pdf"))
+    seen = set()
+    out = []
+    for p in found:
+        key = os.path.abspath(p)
+        if key not in seen:
+            seen.add(key)
+            out.append(key)
+    return out
+
+
+def job_dirs(pdfs: List[str], out_root: str) -> List[str]:
+    """Una cartella per PDF (nome del file; _2, _3... se due PDF hanno lo stesso nome)."""
+    used: Dict[str, int] = {}
+    dirs = []
+    for p in pdfs:
+        stem = os.path.splitext(os.path.basename(p))[0]
+        n = used.get(stem, 0) + 1
+        used[stem] = n
+        dirs.append(os.path.join(out_root, stem if n == 1 else f"{stem}_{n}"))
+    return dirs
+
+
+def _read_done(job_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(job_dir, BATCH_DONE_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _write_done(job_dir: str, marker: Dict[str, Any]):
+    path = os.path.join(job_dir, BATCH_DONE_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(marker, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _extract_done(marker: Optional[Dict], pdf_path: str, options: Dict) -> bool:
+    return bool(marker) and marker.get("pdf") == pdf_fingerprint(pdf_path) \
+        and marker.get("options") == options
+
+
+# ---------------- Worker ----------------
+
+def _extract_one(args: Tuple) -> Dict[str, Any]:
+    """Estrae un PDF (nel process pool o nel processo principale)."""
+    pdf_path, job_dir, options, extract_workers = args
+    os.makedirs(job_dir, exist_ok=True)
+    t0 = time.perf_counter()
+    try:
+        res = phase_extract(pdf_path, job_dir, options["ranges"],
+                            workers=extract_workers,
+                            batch_size=options["batch_size"],
+                            context_mode=options["context_mode"],
+                            profile=options["profile"] or None,
+                            mark=options["mark"])
+    except Exception as e:
+        logger.exception("Estrazione fallita: %s", pdf_path)
+        return {"pdf_path": pdf_path, "job_dir": job_dir, "ok": False,
+                "error": f"{type(e).__name__}: {e}"}
+    seconds = time.perf_counter() - t0
+    marker = {
+        "source": pdf_path,
+        "pdf": pdf_fingerprint(pdf_path),
+        "options": options,
+        "pages": res.get("pages_processed", 0),
+        "pages_computed": res.get("pages_computed", 0),
+        "extract_seconds": round(seconds, 2),
+        "geocoded": False,
+    }
+    _write_done(job_dir, marker)
+    return {"pdf_path": pdf_path, "job_dir": job_dir, "ok": True,
+            "pages": marker["pages"], "seconds": seconds}
+
+
+# ---------------- Batch ----------------
+
+def run_batch(inputs: List[str], out_root: str, workers: int = BATCH_WORKERS,
+              ranges: str = "", profile: str = EXTRACT_PROFILE,
+              batch_size: Optional[int] = None, context_mode: Optional[str] = None,
+              extract_workers: Optional[int] = None, mark: bool = False,
+              geocode: bool = False, force: bool = False, recursive: bool = False,
+              echo=print) -> Dict[str, Any]:
+    """
+    Estrae (e con `geocode` geocoda) tutti i PDF di `inputs` in `out_root`.
+    `workers` = file in parallelo; `extract_workers` = processi per file
+    (solo con workers=1: i processi del pool non possono avere figli).
+    Ritorna il riepilogo stampato alla fine.
+    """
+    pdfs = find_pdfs(inputs, recursive)
+    dirs = job_dirs(pdfs, out_root)
+    os.makedirs(out_root, exist_ok=True)
+    geocache = os.path.join(out_root, GEOCACHE_NAME)
+    options = {"ranges": ranges, "profile": profile or "", "batch_size": batch_size,
+               "context_mode": context_mode, "mark": bool(mark)}
+
+    todo: List[Tuple[str, str]] = []
+    to_geocode: List[str] = []
+    skipped = 0
+    for pdf_path, job_dir in zip(pdfs, dirs):
+        marker = None if force else _read_done(job_dir)
+        if _extract_done(marker, pdf_path, options):
+            if geocode and not marker.get("geocoded"):
+                to_geocode.append(job_dir)
+            else:
+                skipped += 1
+            continue
+        todo.append((pdf_path, job_dir))
+
+    echo(f"{len(pdfs)} PDF: {len(todo)} da estrarre, {len(to_geocode)} solo da geocodare, "
+         f"{skipped} già fatti")
+
+    summary: Dict[str, Any] = {
+        "files": len(pdfs), "extracted": 0, "skipped": skipped, "failed": 0,
+        "geocoded": 0, "pages": 0, "extract_seconds": 0.0, "failures": [],
+    }
+    t_start = time.perf_counter()
+
+    def geocode_job(job_dir: str):
+        t0 = time.perf_counter()
+        try:
+            res = phase_geocode_grouped(job_dir, cache_path=geocache) or {}
+        except Exception as e:
+            summary["failures"].append({"job_dir": job_dir, "error": f"geocode: {type(e).__name__}: {e}"})
+            echo(f"  geocoding fallito {os.path.basename(job_dir)}: {e}")
+            return
+        marker = _read_done(job_dir) or {}
+        marker["geocoded"] = True
+        marker["geocode_seconds"] = round(time.perf_counter() - t0, 2)
+        _write_done(job_dir, marker)
+        summary["geocoded"] += 1
+        echo(f"  geocodati {res.get('features', 0)}/{res.get('terms', 0)} toponimi "
+             f"({os.path.basename(job_dir)})")
+
+    for job_dir in to_geocode:
+        geocode_job(job_dir)
+
+    if todo:
+        workers = max(1, min(int(workers), len(todo)))
+        # modello caricato PRIMA del fork: condiviso dai processi del pool
+        if profile:
+            profile_nlp(profile)
+        else:
+            try_load_spacy()
+
+        if workers > 1:
+            args = [(p, d, options, 1) for p, d in todo]
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+            pool = ctx.Pool(processes=workers)
+            results = pool.imap_unordered(_extract_one, args)
+        else:
+            pool = None
+            results = (_extract_one((p, d, options, extract_workers)) for p, d in todo)
+
+        try:
+            for n, r in enumerate(results, start=1):
+                name = os.path.basename(r["pdf_path"])
+                if not r["ok"]:
+                    summary["failed"] += 1
+                    summary["failures"].append({"pdf": r["pdf_path"], "error": r["error"]})
+                    echo(f"[{n}/{len(todo)}] {name}: ERRORE {r['error']}")
+                    continue
+                summary["extracted"] += 1
+                summary["pages"] += r["pages"]
+                summary["extract_seconds"] += r["seconds"]
+                pps = r["pages"] / r["seconds"] if r["seconds"] else 0.0
+                echo(f"[{n}/{len(todo)}] {name}: {r['pages']} pagine in {r['seconds']:.1f}s "
+                     f"({pps:.1f} pagine/s)")
+                if geocode:
+                    geocode_job(r["job_dir"])
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    wall = time.perf_counter() - t_start
+    summary["wall_seconds"] = round(wall, 2)
+    summary["extract_seconds"] = round(summary["extract_seconds"], 2)
+    summary["pages_per_sec"] = round(summary["pages"] / wall, 2) if wall and summary["pages"] else 0.0
+    return summary
+
+
+# ---------------- CLI ----------------
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(
+        prog="python -m processor",
+        description="Estrazione (e geocoding) dei toponimi di una cartella di PDF",
+    )
+    ap.add_argument("inputs", nargs="+", help="cartelle, glob (tra virgolette) o file PDF")
+    ap.add_argument("--out", default="workspace_batch", help="cartella dei risultati")
+    ap.add_argument("--workers", type=int, default=BATCH_WORKERS, help="PDF elaborati in parallelo")
+    ap.add_argument("--extract-workers", type=int, default=None,
+                    help="processi per PDF (solo con --workers 1)")
+    ap.add_argument("--ranges", default="", help="pagine di ogni PDF, es. 51-104,115-136")
+    ap.add_argument("--profile", default=EXTRACT_PROFILE, choices=[""] + list(EXTRACT_PROFILES))
+    ap.add_argument("--batch-size", type=int, default=None)
+    ap.add_argument("--context-mode", default=None, choices=list(CONTEXT_MODES))
+    ap.add_argument("--mark", action="store_true", help="costruisce anche annale_marked.pdf")
+    ap.add_argument("--geocode", action="store_true", help="geocoding raggruppato (Nominatim)")
+    ap.add_argument("--force", action="store_true", help="rielabora anche i file già fatti")
+    ap.add_argument("--recursive", action="store_true", help="cerca i PDF anche nelle sottocartelle")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args(argv)
+
+    # il formato lo imposta già utils.py: qui solo il livello
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    summary = run_batch(args.inputs, args.out, workers=args.workers, ranges=args.ranges,
+                        profile=args.profile, batch_size=args.batch_size,
+                        context_mode=args.context_mode, extract_workers=args.extract_workers,
+                        mark=args.mark, geocode=args.geocode, force=args.force,
+                        recursive=args.recursive)
+
+    print("riepilogo")
+    for k in ("files", "extracted", "skipped", "failed", "geocoded", "pages",
+              "extract_seconds", "wall_seconds", "pages_per_sec"):
+        print(f"  {k:<18} {summary[k]}")
+    for f in summary["failures"]:
+        print(f"  ! {f}")
+    return 1 if summary["failed"] or summary["failures"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
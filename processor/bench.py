@@ -0,0 +1,376 @@
+# processor/bench.py
+"""
+Benchmark della pipeline di estrazione (solo misure: non scrive nulla nel job).
+
+Uso:
+    python -m processor.bench textlayer workspace/<job_id>/annale.pdf --ranges 51-104
+
+- textlayer
+    Lettura testo per pagina (footer, ID/anno, corpo, testo NER, parole):
+    "before" = una chiamata get_text di PyMuPDF per ogni area,
+    "after"  = un solo PageTextLayer per pagina (scan_page).
+    Riporta pagine/secondo e quante pagine danno un testo diverso.
+
+- context
+    Analisi di contesto sugli stessi testi:
+    "full" = pipeline spaCy completa su ogni pagina,
+    "lazy" = solo NER + pipeline completa sulle finestre attorno alle
+    entità non decise dalle regole sui token (context_mode="lazy").
+    Riporta pagine/secondo e l'accordo con "full" (precision/recall dei
+    toponimi selezionati, pagine con risultato identico).
+
+- mark
+    Costruzione del PDF marcato di un job già estratto (annale.pdf +
+    annale_attestazioni.ndjson) nelle tre forme full / subset / incremental,
+    in una cartella temporanea. Riporta secondi e byte scritti per ciascuna.
+
+- prescan
+    phase_extract con e senza pre-scansione (skip_pages), in cartelle
+    temporanee e senza cache NER. Riporta pagine/secondo, pagine saltate
+    e se la colonna "id" del CSV è identica (le pagine saltate devono
+    comunque riportare l'ID alle pagine successive).
+
+- profiles
+    phase_extract con ogni profilo (profiles.py) in una cartella temporanea,
+    senza cache NER. Riporta pagine/secondo (caricamento del modello
+    escluso) e precision/recall dei toponimi rispetto a un campione
+    annotato a mano: un CSV nel formato di annale_toponimi.csv (colonne
+    "pagina" e "luogo", toponimi separati da ";"; contano solo le pagine
+    presenti nel campione, anche con "luogo" vuoto).
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import csv
+import argparse
+from typing import Dict, List, Callable, Optional, Set
+
+import fitz  # PyMuPDF
+
+from . import nercache
+from .utils import parse_include_ranges, iter_included_indices, normalize_name
+from .profiles import EXTRACT_PROFILES, profile_nlp
+from .attestations import ATTEST_NDJSON_NAME, TAGGED_NDJSON_NAME, ATTEST_INDEX_NAME
+from .marking import phase_mark, MARK_OUTPUTS
+from .pagetext import PageWordIndex
+from .extract import (
+    try_load_spacy,
+    collect_page_texts,
+    detect_candidates_batched,
+    NLP_BATCH_SIZE,
+    phase_extract,
+    get_footer_page_number,
+    extract_id_year,
+    compute_body_rect,
+    text_for_nlp,
+    scan_page,
+)
+
+
+def _page_indices(doc: fitz.Document, ranges: str) -> List[int]:
+    includes = parse_include_ranges(ranges, doc.page_count)
+    return list(iter_included_indices(includes, doc.page_count))
+
+
+def _timed(fn: Callable, repeat: int) -> float:
+    """Miglior tempo (secondi) su `repeat` esecuzioni."""
+    best = None
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# ---------------- textlayer ----------------
+
+def _scan_page_legacy(page: fitz.Page) -> Dict:
+    """Stesse letture di scan_page(), ma con una get_text per ogni area."""
+    id_found, year_found = extract_id_year(page)
+    body_rect = compute_body_rect(page)
+    return {
+        "page_label": get_footer_page_number(page),
+        "id_found": id_found,
+        "body_text": text_for_nlp(page, body_rect),
+        "word_index": PageWordIndex.from_page(page, body_rect),
+    }
+
+
+def bench_textlayer(pdf_path: str, ranges: str = "", repeat: int = 3) -> Dict:
+    doc = fitz.open(pdf_path)
+    try:
+        indices = _page_indices(doc, ranges)
+
+        def run(scan):
+            return [scan(doc.load_page(i)) for i in indices]
+
+        t_before = _timed(lambda: run(_scan_page_legacy), repeat)
+        t_after = _timed(lambda: run(scan_page), repeat)
+
+        diff_pages = 0
+        for old, new in zip(run(_scan_page_legacy), run(scan_page)):
+            if (old["page_label"], old["id_found"], old["body_text"], old["word_index"].norms) != \
+               (new["page_label"], new["id_found"], new["body_text"], new["word_index"].norms):
+                diff_pages += 1
+    finally:
+        doc.close()
+
+    n = len(indices)
+    return {
+        "pages": n,
+        "before_pages_per_sec": round(n / t_before, 1) if t_before else None,
+        "after_pages_per_sec": round(n / t_after, 1) if t_after else None,
+        "speedup": round(t_before / t_after, 2) if t_after else None,
+        "pages_with_different_text": diff_pages,
+    }
+
+
+# ---------------- context ----------------
+
+def bench_context(pdf_path: str, ranges: str = "", repeat: int = 3,
+                  batch_size: int = NLP_BATCH_SIZE) -> Dict:
+    nlp = try_load_spacy()
+    doc = fitz.open(pdf_path)
+    try:
+        texts = [p["body_text"] for p in collect_page_texts(doc, _page_indices(doc, ranges))]
+    finally:
+        doc.close()
+
+    # senza cache NER: dalla seconda ripetizione misurerebbe solo la cache
+    def run(mode, stats=None):
+        return list(detect_candidates_batched(nlp, texts, batch_size=batch_size,
+                                              context_mode=mode, stats=stats,
+                                              use_cache=False))
+
+    t_full = _timed(lambda: run("full"), repeat)
+    t_lazy = _timed(lambda: run("lazy"), repeat)
+
+    stats: Dict = {}
+    full, lazy = run("full"), run("lazy", stats)
+    same_pages = sum(1 for a, b in zip(full, lazy) if a == b)
+    n_full = n_lazy = n_agree = 0
+    for (sel_full, _, _), (sel_lazy, _, _) in zip(full, lazy):
+        a, b = set(sel_full), set(sel_lazy)
+        n_full += len(a)
+        n_lazy += len(b)
+        n_agree += len(a & b)
+
+    n = len(texts)
+    return {
+        "pages": n,
+        "full_pages_per_sec": round(n / t_full, 1) if t_full else None,
+        "lazy_pages_per_sec": round(n / t_lazy, 1) if t_lazy else None,
+        "speedup": round(t_full / t_lazy, 2) if t_lazy else None,
+        "pages_identical": same_pages,
+        "selected_full": n_full,
+        "selected_lazy": n_lazy,
+        "precision_vs_full": round(n_agree / n_lazy, 4) if n_lazy else None,
+        "recall_vs_full": round(n_agree / n_full, 4) if n_full else None,
+        "entities": stats.get("entities", 0),
+        "entities_full_pipeline": stats.get("pending", 0),
+        "windows": stats.get("windows", 0),
+        "text_share_full_pipeline": (
+            round(stats["window_chars"] / stats["text_chars"], 3)
+            if stats.get("text_chars") else None
+        ),
+    }
+
+
+# ---------------- mark ----------------
+
+def bench_mark(job_dir: str, repeat: int = 1) -> Dict:
+    pdf_path = os.path.join(job_dir, "annale.pdf")
+    report: Dict = {"pdf_bytes": os.path.getsize(pdf_path)}
+    tmp = tempfile.mkdtemp(prefix="bench_mark_")
+    try:
+        for name in (ATTEST_NDJSON_NAME, TAGGED_NDJSON_NAME, ATTEST_INDEX_NAME):
+            shutil.copy(os.path.join(job_dir, name), tmp)
+        for output in MARK_OUTPUTS:
+            res: Dict = {}
+
+            def run():
+                res.update(phase_mark(pdf_path, tmp, output))
+
+            report[f"{output}_seconds"] = round(_timed(run, repeat), 3)
+            report[f"{output}_bytes"] = res["bytes"]
+        report["pages_marked"] = res.get("pages_marked")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return report
+
+
+# ---------------- prescan ----------------
+
+def _csv_column(csv_path: str, column: str) -> List[str]:
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        return [(row.get(column) or "") for row in csv.DictReader(f)]
+
+
+def bench_prescan(pdf_path: str, ranges: str = "", repeat: int = 1) -> Dict:
+    # tempi della NER vera, non della cache condivisa
+    nercache.NER_CACHE = False
+    try_load_spacy()
+    runs: Dict[bool, Dict] = {}
+    for skip in (False, True):
+        res: Dict = {}
+        tmp = tempfile.mkdtemp(prefix="bench_prescan_")
+        try:
+            def run():
+                shutil.rmtree(tmp, ignore_errors=True)
+                os.makedirs(tmp)
+                res.update(phase_extract(pdf_path, tmp, ranges, skip_pages=skip, keep_docs=False))
+
+            elapsed = _timed(run, repeat)
+            runs[skip] = {
+                "res": res,
+                "seconds": elapsed,
+                "id": _csv_column(res["csv"], "id"),
+                "luogo": _csv_column(res["csv"], "luogo"),
+            }
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    off, on = runs[False], runs[True]
+    n = off["res"].get("pages_processed", 0)
+    return {
+        "pages": n,
+        "pages_skipped": on["res"].get("pages_skipped", 0),
+        "off_pages_per_sec": round(n / off["seconds"], 1) if off["seconds"] else None,
+        "on_pages_per_sec": round(n / on["seconds"], 1) if on["seconds"] else None,
+        "id_column_identical": off["id"] == on["id"],
+        "rows_with_different_toponyms": sum(
+            1 for a, b in zip(off["luogo"], on["luogo"]) if a != b
+        ),
+    }
+
+
+# ---------------- profiles ----------------
+
+def _read_toponyms_by_page(csv_path: str) -> Dict[str, Set[str]]:
+    """{pagina: {toponimi normalizzati}} da un CSV nel formato annale_toponimi.csv."""
+    out: Dict[str, Set[str]] = {}
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            page = (row.get("pagina") or "").strip()
+            names = {normalize_name(t) for t in (row.get("luogo") or "").split(";") if t.strip()}
+            out.setdefault(page, set()).update(names)
+    return out
+
+
+def bench_profiles(pdf_path: str, gold_csv: str, ranges: str = "",
+                   profiles: Optional[List[str]] = None, repeat: int = 1) -> Dict[str, Dict]:
+    gold = _read_toponyms_by_page(gold_csv)
+    # tempi della NER vera, non della cache condivisa
+    nercache.NER_CACHE = False
+    report: Dict[str, Dict] = {}
+    for name in profiles or list(EXTRACT_PROFILES):
+        t0 = time.perf_counter()
+        _, model_key = profile_nlp(name)        # caricamento fuori dalla misura
+        load_seconds = time.perf_counter() - t0
+
+        res: Dict = {}
+        tmp = tempfile.mkdtemp(prefix=f"bench_{name}_")
+        try:
+            def run():
+                shutil.rmtree(tmp, ignore_errors=True)
+                os.makedirs(tmp)
+                res.update(phase_extract(pdf_path, tmp, ranges, profile=name, keep_docs=False))
+
+            elapsed = _timed(run, repeat)
+            found = _read_toponyms_by_page(res["csv"])
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        tp = n_found = n_gold = 0
+        for page, names in gold.items():
+            pred = found.get(page, set())
+            tp += len(pred & names)
+            n_found += len(pred)
+            n_gold += len(names)
+        precision = tp / n_found if n_found else None
+        recall = tp / n_gold if n_gold else None
+        n = res.get("pages_computed", 0)
+        report[name] = {
+            "model": model_key,
+            "context_mode": res.get("context_mode"),
+            "load_seconds": round(load_seconds, 2),
+            "pages": n,
+            "pages_per_sec": round(n / elapsed, 1) if elapsed else None,
+            "sample_pages": len(gold),
+            "precision": round(precision, 4) if precision is not None else None,
+            "recall": round(recall, 4) if recall is not None else None,
+            "f1": (round(2 * precision * recall / (precision + recall), 4)
+                   if precision and recall else None),
+        }
+    return report
+
+
+# ---------------- CLI ----------------
+
+def _print_report(title: str, report: Dict):
+    print(title)
+    for k, v in report.items():
+        print(f"  {k:<28} {v}")
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m processor.bench",
+                                 description="Benchmark della pipeline toponimi")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p_tl = sub.add_parser("textlayer", help="get_text per area vs PageTextLayer")
+    p_tl.add_argument("pdf")
+    p_tl.add_argument("--ranges", default="", help="es. 51-104,115-136")
+    p_tl.add_argument("--repeat", type=int, default=3)
+
+    p_ctx = sub.add_parser("context", help="pipeline completa vs NER + finestre (lazy)")
+    p_ctx.add_argument("pdf")
+    p_ctx.add_argument("--ranges", default="", help="es. 51-104,115-136")
+    p_ctx.add_argument("--repeat", type=int, default=3)
+    p_ctx.add_argument("--batch-size", type=int, default=NLP_BATCH_SIZE)
+
+    p_mk = sub.add_parser("mark", help="PDF marcato: full vs subset vs overlay incrementale")
+    p_mk.add_argument("job_dir", help="cartella del job (annale.pdf + attestazioni)")
+    p_mk.add_argument("--repeat", type=int, default=1)
+
+    p_ps = sub.add_parser("prescan", help="estrazione con e senza pre-scansione delle pagine")
+    p_ps.add_argument("pdf")
+    p_ps.add_argument("--ranges", default="", help="es. 51-104,115-136")
+    p_ps.add_argument("--repeat", type=int, default=1)
+
+    p_pf = sub.add_parser("profiles", help="pagine/secondo e precision/recall per profilo")
+    p_pf.add_argument("pdf")
+    p_pf.add_argument("sample", help="CSV annotato (pagina,luogo) come annale_toponimi.csv")
+    p_pf.add_argument("--ranges", default="", help="pagine da estrarre, es. 51-60")
+    p_pf.add_argument("--profiles", default="", help="es. fast,accurate (default: tutti)")
+    p_pf.add_argument("--repeat", type=int, default=1)
+
+    args = ap.parse_args(argv)
+
+    if args.cmd == "textlayer":
+        _print_report("textlayer", bench_textlayer(args.pdf, args.ranges, args.repeat))
+    elif args.cmd == "context":
+        _print_report("context", bench_context(args.pdf, args.ranges, args.repeat, args.batch_size))
+    elif args.cmd == "mark":
+        _print_report("mark", bench_mark(args.job_dir, args.repeat))
+    elif args.cmd == "prescan":
+        report = bench_prescan(args.pdf, args.ranges, args.repeat)
+        _print_report("prescan", report)
+        if not report["id_column_identical"]:
+            return 1
+    elif args.cmd == "profiles":
+        names = [p.strip() for p in args.profiles.split(",") if p.strip()] or None
+        for name, report in bench_profiles(args.pdf, args.sample, args.ranges,
+                                           names, args.repeat).items():
+            _print_report(f"profile {name}", report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+# processor/checkpoint.py
+"""
+Checkpoint di pagina per phase_extract(), per riprendere un'estrazione
+interrotta (OOM, riavvio del server, ...) senza rifare la NER.
+
+Stato in <job_dir>/extract_checkpoint/:
+  meta.json     impronta dell'estrazione (PDF, pagine richieste, modello,
+                versione euristiche):
+                se cambia, il checkpoint viene scartato
+  pages.ndjson  un risultato di analyze_page() per riga, scritto appena
+                la pagina è completa
+
+Una nuova /api/extract sullo stesso job ricarica le pagine già fatte e
+calcola solo le altre; gli output finali (CSV, JSON, PDF marcato) vengono
+ricostruiti da tutti i risultati. A estrazione completata il checkpoint
+viene rimosso.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import shutil
+import logging
+from typing import Dict, Any
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIRNAME = "extract_checkpoint"
+
+
+def pdf_fingerprint(pdf_path: str) -> Dict[str, Any]:
+    """Impronta economica del file PDF (dimensione + mtime)."""
+    st = os.stat(pdf_path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+class ExtractCheckpoint:
+    """
+    Checkpoint di una estrazione. `fingerprint` è un dict JSON-serializzabile
+    che identifica l'estrazione (vedi phase_extract).
+    """
+
+    def __init__(self, out_dir: str, fingerprint: Dict[str, Any]):
+        self.dir = os.path.join(out_dir, CHECKPOINT_DIRNAME)
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self.pages_path = os.path.join(self.dir, "pages.ndjson")
+        self.fingerprint = fingerprint
+        self._fh = None
+
+    def load(self) -> Dict[int, Dict]:
+        """
+        Ritorna {pdf_page_index: risultato} delle pagine già completate.
+        Se l'impronta non corrisponde, riparte da zero.
+        """
+        done: Dict[int, Dict] = {}
+        meta = None
+        if os.path.exists(self.meta_path):
+            try:
+                meta = json.load(open(self.meta_path, "r", encoding="utf-8"))
+            except Exception:
+                meta = None
+
+        if meta != self.fingerprint:
+            self.clear()
+            os.makedirs(self.dir, exist_ok=True)
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump(self.fingerprint, f, ensure_ascii=False)
+            return done
+
+        if os.path.exists(self.pages_path):
+            with open(self.pages_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        res = json.loads(line)
+                    except Exception:
+                        # ultima riga troncata da un crash: la pagina verrà rifatta
+                        continue
+                    done[int(res["index"])] = res
+        if done:
+            logger.info("Checkpoint: %d pagine già estratte, riprendo", len(done))
+        return done
+
+    def append(self, res: Dict):
+        """Registra una pagina completata (flush immediato)."""
+        if self._fh is None:
+            os.makedirs(self.dir, exist_ok=True)
+            self._fh = open(self.pages_path, "a", encoding="utf-8")
+        self._fh.write(json.dumps(res, ensure_ascii=False) + "\n")
+        self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def clear(self):
+        """Elimina il checkpoint (estrazione completata o impronta cambiata)."""
+        self.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
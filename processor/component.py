@@ -0,0 +1,114 @@
+# processor/component.py
+"""
+Filtro di contesto dei toponimi come componente spaCy.
+
+Le euristiche di rules.py lavorano su un Doc già analizzato: registrate
+come componente ("toponym_context_filter") girano dentro nlp.pipe, anche
+nei processi di nlp.pipe(..., n_process=N), e il processo principale
+riceve Doc già filtrati (deve solo unire i risultati).
+
+Annotazioni (estensioni spaCy, serializzate con il Doc):
+  ent._.toponym_status    "kept" | "excluded" | "duplicate" per le entità
+                          LOC/GPE (None per le altre)
+  ent._.toponym_reason    motivo dell'esclusione (institution_term,
+                          no_spatial_context, ...)
+  doc._.toponyms          [[termine, start_char, end_char], ...] tenuti,
+                          unici e in ordine
+  doc._.toponyms_excluded [[termine, motivo], ...]
+  doc._.toponym_rules     impronta delle regole usate (ContextRules.fingerprint)
+
+Uso:
+    nlp.add_pipe("toponym_context_filter", last=True,
+                 config={"overrides": {"always_allow": {"add": ["Cerignola"]}}})
+oppure add_context_filter(nlp). Il componente va aggiunto DOPO parser e
+NER; con n_process e start method "spawn" questo modulo va importato
+anche nei processi figli (con "fork" basta averlo importato nel padre).
+"""
+
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Tuple
+
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+
+from .rules import ContextRules, DEFAULT_RULES, pending_needed, entity_statuses
+
+CONTEXT_FILTER_NAME = "toponym_context_filter"
+
+for _attr in ("toponym_status", "toponym_reason"):
+    if not Span.has_extension(_attr):
+        Span.set_extension(_attr, default=None)
+for _attr in ("toponyms", "toponyms_excluded", "toponym_rules"):
+    if not Doc.has_extension(_attr):
+        Doc.set_extension(_attr, default=None)
+
+
+def set_toponym_annotations(doc, verdicts: List[Tuple], deep: Dict[int, bool],
+                            rules: ContextRules):
+    """Scrive sul Doc l'esito di verdicts + deep_context (vedi rules.entity_statuses)."""
+    kept: List[List] = []
+    excluded: List[List] = []
+    for (ent, raw, _, _), (status, reason) in zip(verdicts, entity_statuses(verdicts, deep)):
+        ent._.toponym_status = status
+        ent._.toponym_reason = reason
+        if status == "kept":
+            kept.append([raw, ent.start_char, ent.end_char])
+        elif status == "excluded":
+            excluded.append([raw, reason])
+    doc._.toponyms = kept
+    doc._.toponyms_excluded = excluded
+    doc._.toponym_rules = rules.fingerprint
+    return doc
+
+
+def annotate_doc(doc, rules: Optional[ContextRules] = None):
+    """Applica le euristiche di contesto (pipeline completa già eseguita)."""
+    rules = rules or DEFAULT_RULES
+    f = rules.features(doc)
+    verdicts = rules.verdicts(doc, f)
+    deep = {
+        i: rules.deep_context(f, verdicts[i][0], verdicts[i][1])
+        for i in pending_needed(verdicts)
+    }
+    return set_toponym_annotations(doc, verdicts, deep, rules)
+
+
+def toponym_candidates(doc, rules: Optional[ContextRules] = None,
+                       spans: Optional[List[Tuple[int, int]]] = None
+                       ) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    (selected, excluded) del Doc, come detect_candidates_with_context().
+    Se il Doc è già stato annotato con le stesse regole (dal componente,
+    magari in un altro processo) legge le annotazioni, altrimenti le calcola.
+    In `spans` (se dato) gli offset delle entità selezionate.
+    """
+    rules = rules or DEFAULT_RULES
+    if doc._.toponym_rules != rules.fingerprint:
+        annotate_doc(doc, rules)
+    if spans is not None:
+        spans.extend((s, e) for _, s, e in doc._.toponyms)
+    return ([t for t, _, _ in doc._.toponyms],
+            [(t, r) for t, r in doc._.toponyms_excluded])
+
+
+class ContextFilter:
+    """Componente spaCy: annota ogni entità LOC/GPE come tenuta o esclusa."""
+
+    def __init__(self, rules: Optional[ContextRules] = None):
+        self.rules = rules or DEFAULT_RULES
+
+    def __call__(self, doc: Doc) -> Doc:
+        return annotate_doc(doc, self.rules)
+
+
+@Language.factory(CONTEXT_FILTER_NAME, default_config={"overrides": {}})
+def make_context_filter(nlp: Language, name: str, overrides: Dict):
+    return ContextFilter(DEFAULT_RULES.with_overrides(overrides) if overrides else DEFAULT_RULES)
+
+
+def add_context_filter(nlp, overrides: Optional[Dict] = None) -> str:
+    """Aggiunge il filtro in coda alla pipeline (una volta sola); ritorna il nome."""
+    if CONTEXT_FILTER_NAME not in nlp.pipe_names:
+        nlp.add_pipe(CONTEXT_FILTER_NAME, last=True, config={"overrides": overrides or {}})
+    return CONTEXT_FILTER_NAME
@@ -0,0 +1,128 @@
+# processor/docstore.py
+"""
+Doc spaCy dell'ultima estrazione, conservati nel job per il re-filtro.
+
+Cambiare ALWAYS_ALLOW, COMMON_FIRST_NAMES, PERSON_TITLES... non richiede
+di rileggere il PDF né di rifare la NER: phase_refilter() (refilter.py)
+riapplica le euristiche ai Doc salvati qui.
+
+Stato in <job_dir>/extract_docs/:
+  <indice pagina>.spacy   DocBin con il Doc del testo del corpo pagina,
+                          user_data["context_mode"] = "full" (pipeline
+                          completa) o "lazy" (solo NER: le finestre di
+                          contesto si ricalcolano o escono dalla cache NER),
+                          user_data["profile"] = profilo dell'estrazione (None
+                          se senza profilo): il re-filtro risolve le finestre
+                          dei Doc "lazy" con la pipeline dello stesso profilo
+  pages.ndjson            una riga per pagina elaborata, in ordine:
+                          {"index", "page_label", "id_found", "year_found",
+                           "candidates", "pre_excluded", "skipped"}
+                          (i candidati servono se manca il Doc di una pagina)
+
+I Doc li scrive chi calcola la pagina (processo principale o worker);
+pages.ndjson lo scrive _ExtractWriter a ogni estrazione completa.
+EXTRACT_KEEP_DOCS=0 disattiva il salvataggio.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import logging
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+DOCS_DIRNAME = "extract_docs"
+PAGES_MANIFEST_NAME = "pages.ndjson"
+
+EXTRACT_KEEP_DOCS = os.environ.get("EXTRACT_KEEP_DOCS", "1").strip().lower() in {"1", "true", "yes"}
+
+
+class DocStore:
+    """Un DocBin per pagina, scritto in modo atomico."""
+
+    def __init__(self, out_dir: str, profile: Optional[str] = None):
+        self.dir = os.path.join(out_dir, DOCS_DIRNAME)
+        self.profile = profile
+        self._vocab = None
+
+    def _path(self, idx: int) -> str:
+        return os.path.join(self.dir, f"{int(idx)}.spacy")
+
+    def put(self, idx: int, doc, context_mode: str):
+        from spacy.tokens import DocBin
+
+        p = self._path(idx)
+        tmp = p + ".tmp"
+        try:
+            doc.user_data["context_mode"] = context_mode
+            doc.user_data["lang"] = doc.lang_
+            doc.user_data["profile"] = self.profile
+            os.makedirs(self.dir, exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(DocBin(store_user_data=True, docs=[doc]).to_bytes())
+            os.replace(tmp, p)
+        except Exception as e:
+            logger.warning("Doc pagina %s non salvato: %s", idx, e)
+
+    def _blank_vocab(self, data: bytes):
+        """
+        Vocab della lingua del modello (spacy.blank): senza i lex_attr della
+        lingua is_alpha & co. sarebbero sempre False e le regole cambierebbero.
+        """
+        import spacy
+        from spacy.tokens import DocBin
+        from spacy.vocab import Vocab
+
+        doc = next(DocBin(store_user_data=True).from_bytes(data).get_docs(Vocab()))
+        return spacy.blank(doc.user_data.get("lang") or "it").vocab
+
+    def get(self, idx: int, vocab=None):
+        """
+        Doc della pagina `idx` (user_data["context_mode"] e "profile"), o None.
+        Senza `vocab` si usa un vocabolario vuoto della lingua del modello,
+        così il re-filtro non deve caricare il modello.
+        """
+        from spacy.tokens import DocBin
+
+        p = self._path(idx)
+        if not os.path.exists(p):
+            return None
+        try:
+            with open(p, "rb") as f:
+                data = f.read()
+            if vocab is None:
+                if self._vocab is None:
+                    self._vocab = self._blank_vocab(data)
+                vocab = self._vocab
+            return next(DocBin(store_user_data=True).from_bytes(data).get_docs(vocab))
+        except Exception as e:
+            logger.warning("Doc pagina %s illeggibile: %s", idx, e)
+            return None
+
+    # ---- manifest delle pagine ----
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.dir, PAGES_MANIFEST_NAME)
+
+    def open_manifest(self):
+        """File (binario) su cui _ExtractWriter scrive pages.ndjson."""
+        os.makedirs(self.dir, exist_ok=True)
+        return open(self.manifest_path + ".tmp", "wb")
+
+    def commit_manifest(self):
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def iter_pages(self) -> Iterator[Dict]:
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def available(self) -> bool:
+        return os.path.exists(self.manifest_path)
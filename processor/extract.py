@@ -3,35 +3,24 @@
 FASE 1: Estrazione dei toponimi dal PDF con spaCy + marcatura/attestazioni.
 
 Novità rispetto alla vecchia phase_extract():
-- Generiamo anche:
-  1) annale_attestazioni.json
+- Generiamo anche (scritti pagina per pagina, formato in attestations.py):
+  1) annale_attestazioni.ndjson
+     una riga per attestazione:
      {
-       "<norm(term)>": {
-         "term_display": "Cerignola",
-         "occurrences": [
-           {
-             "page_label": 52,         # numero pagina visibile nel footer
-             "pdf_page_index": 51,     # indice 0-based nel PDF
-             "boxes": [[x0,y0,x1,y1], ...],  # bbox per highlight sul PDF
-             "snippet": "…contesto testo…"
-           },
-           ...
-         ]
-       },
-       ...
+       "norm": "cerignola",
+       "term": "Cerignola",
+       "page_label": 52,                # numero pagina visibile nel footer
+       "pdf_page_index": 51,            # indice 0-based nel PDF
+       "boxes": [[x0,y0,x1,y1], ...],   # bbox per highlight sul PDF
+       "snippet": "…contesto testo…",
+       "prev": 10234                    # riga precedente dello stesso termine
      }
+     + annale_attestazioni_index.json
+     {"<norm(term)>": {"term_display": "Cerignola", "count": 12, "last": 98765}}
 
-  2) annale_tagged.json
-     [
-       {
-         "page": 52,
-         "attestations": [
-           {"term": "Cerignola", "snippet": "…contesto testo…"},
-           ...
-         ]
-       },
-       ...
-     ]
+  2) annale_tagged.ndjson
+     una riga per pagina:
+     {"page": 52, "attestations": [{"term": "Cerignola", "snippet": "…"}, ...]}
 
 Questi file servono per:
 - espandere un toponimo in tutte le sue attestazioni (pagine),
@@ -39,9 +28,12 @@ Questi file servono per:
 - più avanti: consentire l'esclusione di Cerignola solo in p.53 ma non altrove.
 
 Manteniamo comunque:
-- annale_marked.pdf (con highlight e asterischi, per retro-compatibilità)
 - annale_toponimi.csv
 - annale_toponimi_esclusi.csv
+
+annale_marked.pdf (highlight e asterischi, per retro-compatibilità) non
+viene più scritto qui: lo costruisce marking.py dai box di
+annale_attestazioni.ndjson, quando serve.
 """
 
 from __future__ import annotations
@@ -51,7 +43,11 @@ import re
 import csv
 import json
 import logging
-from typing import List, Dict, Tuple, Optional
+import time
+import shutil
+import multiprocessing
+from bisect import bisect_left
+from typing import Callable, List, Dict, Tuple, Optional, Iterable
 
 import fitz  # PyMuPDF
 
@@ -59,41 +55,65 @@ from .utils import (
     normalize_name,
     ordered_unique,
     parse_include_ranges,
-    index_in_includes,
+    iter_included_indices,
     HEADER_FALLBACK_RATIO,
     FOOTER_FALLBACK_RATIO,
     SIDE_MARGIN_PT,
 )
+from .models import get_nlp, model_status
+from .profiles import get_profile, profile_nlp, EXTRACT_PROFILE
+from .checkpoint import ExtractCheckpoint, pdf_fingerprint
+from .pagecache import PageCache, page_content_key
+from .nercache import ner_pipe, ANNOTATION_PIPES
+from .docstore import DocStore, EXTRACT_KEEP_DOCS
+from .marking import phase_mark, remove_marked_outputs, MARK_OUTPUT
+from .attestations import AttestationWriter
+from .prescan import PagePrescan, has_text_operators, page_text_key, PAGE_SKIP, PAGE_MIN_CHARS
+from .pagetext import PageTextLayer, PageWordIndex, TermMatcher, union_rect
+from .rules import (
+    ContextRules,
+    DEFAULT_RULES,
+    pending_needed,
+    ENTITY_STRIP_CHARS,
+    DROP_IF_EXACT,
+    PERSON_TITLES,
+    LOC_VERBS,
+    LOC_PREPS,
+    ADDR_WORDS,
+    COMMON_FIRST_NAMES,
+    ALWAYS_ALLOW,
+)
 
 logger = logging.getLogger(__name__)
 
 # ---------------- spaCy loader ----------------
 def try_load_spacy():
     """
-    Carica un modello spaCy italiano disponibile tra:
-    it_core_news_lg, it_core_news_md, it_core_news_sm.
+    Ritorna il modello spaCy italiano condiviso dal registro di processo
+    (vedi processor.models): il primo disponibile tra
+    it_core_news_lg, it_core_news_md, it_core_news_sm, caricato una volta sola.
     """
-    try:
-        import spacy
-    except Exception:
-        raise RuntimeError(
-            "spaCy assente. Installa con: pip install spacy; "
-            "python -m spacy download it_core_news_sm"
-        )
-
-    for model in ("it_core_news_lg", "it_core_news_md", "it_core_news_sm"):
-        try:
-            return spacy.load(model)
-        except Exception:
-            continue
-    raise RuntimeError(
-        "Nessun modello it_core_news_* trovato. "
-        "Esegui: python -m spacy download it_core_news_sm"
-    )
+    return get_nlp()
 
 
 # ---------------- Euristiche / regex varie ----------------
 
+# versione delle euristiche di estrazione: va incrementata quando cambiano
+# regole di contesto, localizzazione dei box o snippet, per invalidare la
+# cache per pagina (extract_cache/)
+HEURISTICS_VERSION = "2"
+
+# quante pagine passare insieme a nlp.pipe (override: NLP_BATCH_SIZE)
+NLP_BATCH_SIZE = int(os.environ.get("NLP_BATCH_SIZE", "32"))
+# processi per l'estrazione parallela (1 = sequenziale)
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "1"))
+# blocchi di pagine per worker (più blocchi = miglior bilanciamento)
+EXTRACT_SHARDS_PER_WORKER = 4
+# processi di nlp.pipe nell'estrazione sequenziale (n_process di spaCy):
+# con N > 1 anche il filtro di contesto gira nei processi di spaCy
+# (component.py) e qui arrivano Doc già filtrati
+NLP_N_PROCESS = int(os.environ.get("NLP_N_PROCESS", "1"))
+
 ID_REGEX = re.compile(r"\b(19[0-9]{2})\s*/\s*([0-9]+)\b")
 OGGETTO_PAT = re.compile(r"\boggetto\b", re.IGNORECASE)
 BODY_END_PAT = re.compile(
@@ -102,61 +122,22 @@ BODY_END_PAT = re.compile(
 )
 SIGLA_NOME_PAT = re.compile(r"^[A-Z]\.\s*[A-ZÀ-Ü][a-zà-ü]+$")
 
-DROP_IF_EXACT = set(map(str.lower, """
-Ministero Interno Direzione Generale Pubblica Sicurezza Servizio
-Governo Stato Regno Capitale Prefettura Questura
-""".strip().split()))
-
-PERSON_TITLES = {
-    "sig", "sig.", "sig.ra", "sig.na", "on.", "onorevole", "dott.", "dott", "prof.", "prof",
-    "ing.", "ing", "avv.", "avv", "mons.", "mons", "cav.", "cav", "prefetto", "questore",
-    "ministro", "direttore", "sottosegretario"
-}
-
-LOC_VERBS = {
-    "risiedere", "risiede", "risiedono", "domiciliare", "domiciliato", "domiciliata",
-    "abitare", "abita", "abitano", "nascere", "nato", "nata", "provenire", "proveniente",
-    "recarsi", "recatosi", "tornare", "tornato", "emigrare", "emigrato", "oriundo", "residente",
-    "resiedeva", "dimorare", "dimora", "trasferirsi", "trasferito", "fermare", "arrestato", "arrestato a"
-}
-
-LOC_PREPS = {
-    "a", "ad", "da", "di", "in", "nel", "nella", "nelle", "nello", "nei", "degli", "dei",
-    "della", "dello", "delle", "sul", "sulla", "sullo", "sui", "sulle", "presso", "tra", "fra"
-}
-
-ADDR_WORDS = {
-    "via", "viale", "piazza", "corso", "largo", "strada", "vicolo", "piazzale"
-}
-
-COMMON_FIRST_NAMES = {
-    "alberto","angelica","angel","antonio","antonietta","anzlovar","aristide","auriti","ausenda",
-    "bagnoli","balduini","balestri","ballarini","bancone","barbato","barbusse","bartocci","bartoli","basile",
-    "celeste","duilio","feltre","franca","giacinto","gigante","luigi","nullo","renato","vincenzo","vincent",
-    "benigni","cerruti","azzi","aprato","alessandro","giuseppe","giovanni","maria","mario",
-    "enzo","pasquale","francesco","paolo","pietro","salvatore","roberto","giorgio","grazia","graziano",
-    "carlo","claudio","fabrizio","giulia","valentina","stefano","simone","riccardo","chiara","celestino"
-}
-
-ALWAYS_ALLOW = {
-    "roma","milano","torino","napoli","genova","bologna","firenze","venezia","palermo","catania",
-    "bari","foggia","cerignola","lecce","taranto","brindisi","andria","barletta","trani",
-    "verona","padova","treviso","vicenza","udine","trieste","trento","bolzano","brescia","bergamo",
-    "como","varese","monza","pavia","piacenza","parma","modena","reggio emilia","ravenna","rimini",
-    "forlì","cesena","ancona","pesaro","urbino","perugia","terni","l'aquila","pescara","chieti",
-    "campobasso","potenza","catanzaro","reggio calabria","cagliari","sassari","aosta","matera","latina",
-    "viterbo","rieti","frosinone","novara","alessandria","asti","biella","cuneo","savona","la spezia",
-    "prato","pisa","lucca","arezzo","siena","grosseto","livorno"
-}
+# ---------------- PDF helpers ----------------
+# Tutti gli helper accettano un PageTextLayer opzionale: se presente, il
+# testo viene letto dall'analisi unica della pagina invece di chiedere a
+# PyMuPDF un nuovo get_text(clip=...) per ogni area.
 
+def _clip_text(page: fitz.Page, rect: fitz.Rect, layer: Optional[PageTextLayer] = None) -> str:
+    if layer is not None:
+        return layer.clip_text(rect)
+    return page.get_text("text", clip=rect) or ""
 
-# ---------------- PDF helpers ----------------
 
-def get_footer_page_number(page: fitz.Page) -> int:
+def get_footer_page_number(page: fitz.Page, layer: Optional[PageTextLayer] = None) -> int:
     h = page.rect.height
     w = page.rect.width
     footer_rect = fitz.Rect(0, h*(1-FOOTER_FALLBACK_RATIO), w, h)
-    txt = page.get_text("text", clip=footer_rect) or ""
+    txt = _clip_text(page, footer_rect, layer)
     nums = re.findall(r"(\d{1,4})", txt)
     if nums:
         try:
@@ -166,12 +147,13 @@ def get_footer_page_number(page: fitz.Page) -> int:
     return page.number + 1  # fallback
 
 
-def extract_id_year(page: fitz.Page, last_id=None, last_year=None):
+def extract_id_year(page: fitz.Page, last_id=None, last_year=None,
+                    layer: Optional[PageTextLayer] = None):
     """
     Recupera l'ID tipo '1937/12345' e l'anno corrente dalla fascia alta.
     """
     top_rect = fitz.Rect(0, 0, page.rect.width, page.rect.height * 0.35)
-    text = page.get_text("text", clip=top_rect) or ""
+    text = _clip_text(page, top_rect, layer)
     text = re.sub(r"[\u00AD\-]\s*\n\s*", "", text)
     text = re.sub(r"\s+", " ", text)
     m = ID_REGEX.search(text)
@@ -182,11 +164,14 @@ def extract_id_year(page: fitz.Page, last_id=None, last_year=None):
     return last_id, last_year
 
 
-def compute_body_rect(page: fitz.Page):
+def compute_body_rect(page: fitz.Page, layer: Optional[PageTextLayer] = None):
     """
     Cerca di delimitare il corpo della lettera/rapporto escludendo intestazioni e firme.
     """
-    blocks = page.get_text("blocks", sort=True)
+    if layer is not None:
+        blocks = layer.blocks()
+    else:
+        blocks = page.get_text("blocks", sort=True)
     page_w, page_h = page.rect.width, page.rect.height
     header_end_y = None
     first_signature_y = None
@@ -211,381 +196,907 @@ def compute_body_rect(page: fitz.Page):
     return fitz.Rect(x0, y0, x1, y1)
 
 
-def text_for_nlp(page: fitz.Page, rect: fitz.Rect) -> str:
+def text_for_nlp(page: fitz.Page, rect: fitz.Rect, layer: Optional[PageTextLayer] = None) -> str:
     """
     Estrae il testo 'continuo' dalla zona corpo, togliendo sillabazioni tipo "foo-\nbar".
     """
-    txt = page.get_text("text", clip=rect) or ""
+    txt = _clip_text(page, rect, layer)
     txt = re.sub(r"-\s*\n\s*", "", txt)
     return txt
 
 
 # ---------------- NER + euristiche di contesto ----------------
 
-def detect_candidates_with_context(nlp, text: str) -> Tuple[List[str], List[Tuple[str, str]]]:
+def detect_candidates_with_context(nlp, text: str, use_cache: bool = True
+                                   ) -> Tuple[List[str], List[Tuple[str, str]]]:
     """
     Ritorna:
       selected: lista di candidati toponimi 'buoni'
       excluded: [(termine, motivo_scarto), ...]
     Applica euristiche sintattiche e semantiche sul contesto (preposizioni, verbi tipo "risiede a ...", ecc.).
-    """
-    selected: List[str] = []
-    excluded: List[Tuple[str,str]] = []
 
+    Versione "una pagina alla volta"; in phase_extract usiamo
+    detect_candidates_batched() che passa tutte le pagine da nlp.pipe.
+    Il Doc viene dalla cache NER condivisa tra i job (nercache.py), se c'è.
+    """
     if not text.strip():
-        return selected, excluded
+        return [], []
+    doc = next(iter(ner_pipe(nlp, [text], 1, use_cache=use_cache)))
+    return filter_entities_with_context(doc)
 
-    doc = nlp(text)
 
-    def lemma(tok):
-        return (tok.lemma_ or tok.text).lower()
+def detect_candidates_batched(nlp, texts: Iterable[str], batch_size: int = NLP_BATCH_SIZE,
+                              context_mode: str = "full", stats: Optional[Dict] = None,
+                              rules: Optional[ContextRules] = None, use_cache: bool = True,
+                              doc_sink: Optional[Callable] = None, n_process: int = 1):
+    """
+    Generatore: per ogni testo (nello stesso ordine) produce
+    (selected, excluded, spans): i primi due come detect_candidates_with_context(),
+    spans = [(start_char, end_char), ...] dell'entità di ogni termine
+    selezionato (servono per gli snippet). Il batching lo fa spaCy via nlp.pipe;
+    i testi già analizzati in un job qualsiasi escono dalla cache NER
+    condivisa (nercache.py, use_cache=False per ignorarla).
+    `doc_sink(doc)`, se dato, riceve il Doc di ogni testo (per extract_docs/).
+
+    Con n_process > 1 i testi da analizzare vanno a nlp.pipe(n_process=...)
+    e il filtro di contesto viene aggiunto in coda alla pipeline
+    (component.py): i processi di spaCy restituiscono Doc già annotati.
+
+    context_mode="lazy": analisi a due livelli, vedi detect_candidates_lazy().
+    """
+    if context_mode == "lazy":
+        yield from detect_candidates_lazy(nlp, texts, batch_size=batch_size,
+                                          stats=stats, rules=rules, use_cache=use_cache,
+                                          doc_sink=doc_sink)
+        return
+    if n_process > 1:
+        from .component import add_context_filter
+        add_context_filter(nlp)
+    for doc in ner_pipe(nlp, texts, max(1, int(batch_size)), use_cache=use_cache,
+                        n_process=n_process):
+        if doc_sink is not None:
+            doc_sink(doc)
+        spans: List[Tuple[int, int]] = []
+        selected, excluded = filter_entities_with_context(doc, rules, spans)
+        yield selected, excluded, spans
+
+
+def filter_entities_with_context(doc, rules: Optional[ContextRules] = None,
+                                 spans: Optional[List[Tuple[int, int]]] = None
+                                 ) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    Applica le euristiche di contesto (rules.py) alle entità LOC/GPE di un
+    Doc spaCy già analizzato. Stesso output di detect_candidates_with_context();
+    in `spans` (se dato) gli offset delle entità selezionate.
+    Le annotazioni restano sul Doc (ent._.toponym_status, ...): se il filtro
+    è già passato con le stesse regole (componente spaCy) vengono solo lette.
+    """
+    from .component import toponym_candidates
+    return toponym_candidates(doc, rules, spans)
 
-    seen_norm = set()
-    months = r"gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre"
 
-    for ent in doc.ents:
-        if ent.label_ not in ("LOC", "GPE"):
-            continue
+# ---------------- Analisi di contesto a due livelli ----------------
 
-        raw = re.sub(r"\s+", " ", ent.text).strip(" ’'\",.;:()[]")
-        if not raw:
-            excluded.append((ent.text, "empty"))
-            continue
-        if any(ch.isdigit() for ch in raw):
-            excluded.append((raw, "has_digit"))
-            continue
+# caratteri di contesto attorno a un'entità da risolvere: la finestra
+# deve contenere i 10 token a sinistra e la frase (verbo fino a 80 caratteri
+# prima del toponimo, data subito dopo)
+CONTEXT_WINDOW_CHARS = int(os.environ.get("CONTEXT_WINDOW_CHARS", "400"))
+# full = pipeline completa su tutte le pagine, lazy = NER + finestre
+CONTEXT_MODES = ("full", "lazy")
+CONTEXT_MODE = os.environ.get("CONTEXT_MODE", "full").strip().lower()
+if CONTEXT_MODE not in CONTEXT_MODES:
+    CONTEXT_MODE = "full"
 
-        norm = normalize_name(raw)
-        if norm in seen_norm:
-            continue
-        if norm in DROP_IF_EXACT:
-            excluded.append((raw, "institution_term"))
-            continue
+_NER_FACTORIES = {"ner", "beam_ner", "entity_ruler"}
 
-        tokens = [t for t in ent]
-        if len(tokens) > 4:
-            excluded.append((raw, "too_many_tokens"))
-            continue
 
-        if all(normalize_name(t.text) in COMMON_FIRST_NAMES for t in tokens):
-            excluded.append((raw, "all_common_first_names"))
-            continue
+def _ner_pipe_names(nlp) -> List[str]:
+    """
+    Componenti che servono al passaggio solo-NER: quelli che assegnano
+    le entità più il tok2vec/transformer condiviso se la NER lo ascolta.
+    """
+    ner = [name for name in nlp.pipe_names
+           if nlp.get_pipe_meta(name).factory in _NER_FACTORIES]
+    keep = set(ner)
+    for name in nlp.pipe_names:
+        listeners = set(getattr(nlp.get_pipe(name), "listening_components", []) or [])
+        if listeners & keep:
+            keep.add(name)
+    return [name for name in nlp.pipe_names if name in keep]
 
-        prev_tok = doc[ent.start - 1] if ent.start > 0 else None
-        if prev_tok is not None and prev_tok.text.endswith(".") and len(prev_tok.text) <= 3:
-            excluded.append((raw, "prev_initial"))
-            continue
 
-        left = doc[max(0, ent.start - 4):ent.start]
-        if any(normalize_name(t.text.strip(".’'")) in PERSON_TITLES for t in left):
-            excluded.append((raw, "left_person_title"))
+def _context_windows(text: str, spans: List[Tuple[int, int]]) -> List[Tuple[int, int, List[int]]]:
+    """
+    Finestre di testo [w0, w1) attorno agli span (char) da risolvere,
+    allargate a CONTEXT_WINDOW_CHARS per lato, tagliate su uno spazio e
+    fuse se si sovrappongono. Ritorna [(w0, w1, [indici span]), ...].
+    """
+    windows: List[List] = []
+    for k, (s, e) in sorted(enumerate(spans), key=lambda x: x[1]):
+        w0 = max(0, s - CONTEXT_WINDOW_CHARS)
+        w1 = min(len(text), e + CONTEXT_WINDOW_CHARS)
+        if w0 > 0:
+            sp = text.find(" ", w0, s)
+            w0 = sp + 1 if sp >= 0 else w0
+        if w1 < len(text):
+            sp = text.rfind(" ", e, w1)
+            w1 = sp if sp >= 0 else w1
+        if windows and w0 <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], w1)
+            windows[-1][2].append(k)
+        else:
+            windows.append([w0, w1, [k]])
+    return [(w0, w1, ks) for w0, w1, ks in windows]
+
+
+def detect_candidates_lazy(nlp, texts: Iterable[str], batch_size: int = NLP_BATCH_SIZE,
+                           stats: Optional[Dict] = None,
+                           rules: Optional[ContextRules] = None, use_cache: bool = True,
+                           doc_sink: Optional[Callable] = None):
+    """
+    Generatore con lo stesso output di detect_candidates_batched()
+    (selected, excluded, spans), in due livelli:
+
+    1) nlp.pipe con la sola NER (tagger, parser, lemmatizer... disattivati):
+       le entità escluse dalle regole sui token o accettate da
+       ALWAYS_ALLOW / preposizione / "in ... via" sono già decise;
+    2) per le entità rimaste, pipeline completa (senza NER) solo su una
+       finestra di testo attorno all'entità, poi verbi e frase come sempre.
+
+    Le pagine senza entità LOC/GPE non passano mai da tagger e parser.
+    Entrambi i livelli passano dalla cache NER condivisa: la chiave include
+    i componenti eseguiti, quindi Doc solo-NER e finestre restano distinti.
+    `stats` (se dato) accumula: entities, pending, windows, window_chars, text_chars.
+    """
+    batch_size = max(1, int(batch_size))
+    ner_names = set(_ner_pipe_names(nlp))
+    ner_disable = [n for n in nlp.pipe_names if n not in ner_names]
+
+    texts = iter(texts)
+    while True:
+        chunk = [t for _, t in zip(range(batch_size), texts)]
+        if not chunk:
+            break
+        docs = list(ner_pipe(nlp, chunk, batch_size, disable=ner_disable, use_cache=use_cache))
+        if doc_sink is not None:
+            for doc in docs:
+                doc_sink(doc)
+        yield from resolve_lazy_docs(docs, nlp, batch_size=batch_size, stats=stats,
+                                     rules=rules, use_cache=use_cache)
+
+
+def resolve_lazy_docs(docs: List, nlp=None, batch_size: int = NLP_BATCH_SIZE,
+                      stats: Optional[Dict] = None,
+                      rules: Optional[ContextRules] = None, use_cache: bool = True,
+                      profile: Optional[str] = None):
+    """
+    Livelli 1 e 2 di detect_candidates_lazy() su Doc solo-NER già pronti
+    (appena calcolati, o riletti da extract_docs/ dal re-filtro).
+    `nlp` serve solo se restano entità da risolvere sulle finestre: se è
+    None viene caricato a quel punto quello di `profile` (o il modello
+    condiviso se non c'è profilo).
+    """
+    batch_size = max(1, int(batch_size))
+    rules = rules or DEFAULT_RULES
+    if stats is not None:
+        for k in ("entities", "pending", "windows", "window_chars", "text_chars"):
+            stats.setdefault(k, 0)
+
+    # livello 1: regole sui token
+    pages = []
+    jobs = []        # (pagina, [indici entità], w0, testo finestra)
+    for p, doc in enumerate(docs):
+        verdicts = rules.verdicts(doc)
+        needed = pending_needed(verdicts)
+        pages.append((verdicts, {}))
+        spans = [(verdicts[i][0].start_char, verdicts[i][0].end_char) for i in needed]
+        for w0, w1, ks in _context_windows(doc.text, spans):
+            jobs.append((p, [needed[k] for k in ks], w0, doc.text[w0:w1]))
+        if stats is not None:
+            stats["entities"] += len(verdicts)
+            stats["pending"] += len(needed)
+            stats["text_chars"] += len(doc.text)
+
+    # livello 2: pipeline completa sulle sole finestre
+    if jobs:
+        nlp = nlp or (profile_nlp(profile)[0] if profile else get_nlp())
+        full_disable = [n for n in nlp.pipe_names
+                        if nlp.get_pipe_meta(n).factory in _NER_FACTORIES
+                        or n in ANNOTATION_PIPES]
+        wdocs = ner_pipe(nlp, (j[3] for j in jobs), batch_size, disable=full_disable,
+                         use_cache=use_cache)
+        for (p, ent_ids, w0, wtext), wdoc in zip(jobs, wdocs):
+            verdicts, deep = pages[p]
+            f = rules.features(wdoc)
+            for i in ent_ids:
+                ent, raw = verdicts[i][0], verdicts[i][1]
+                span = wdoc.char_span(ent.start_char - w0, ent.end_char - w0,
+                                      alignment_mode="expand")
+                deep[i] = span is not None and rules.deep_context(f, span, raw)
+            if stats is not None:
+                stats["windows"] += 1
+                stats["window_chars"] += len(wtext)
+
+    # esito sul Doc solo-NER (ent._.toponym_status, ...) come fa il componente
+    from .component import set_toponym_annotations, toponym_candidates
+    for doc, (verdicts, deep) in zip(docs, pages):
+        set_toponym_annotations(doc, verdicts, deep, rules)
+        spans: List[Tuple[int, int]] = []
+        selected, excluded = toponym_candidates(doc, rules, spans)
+        yield selected, excluded, spans
+
+
+# ---------------- Localizzazione rettangoli nel PDF ----------------
+
+def locate_terms(page: fitz.Page, body_rect: fitz.Rect, terms: List[str],
+                 word_index: Optional[PageWordIndex] = None) -> Dict[str, List[fitz.Rect]]:
+    """
+    Trova le occorrenze (visive) di tutti i `terms` all'interno di body_rect.
+    Le parole della pagina vengono lette e normalizzate una sola volta
+    (PageWordIndex) e confrontate con tutti i termini in un solo passaggio
+    (TermMatcher). Ritorna {termine: [fitz.Rect per occorrenza, ...]}.
+    """
+    if word_index is None:
+        word_index = PageWordIndex.from_page(page, body_rect)
+    return TermMatcher(terms).find(word_index)
+
+
+def locate_term_occurrences(page: fitz.Page, body_rect: fitz.Rect, term: str) -> List[fitz.Rect]:
+    """
+    Trova le occorrenze (visive) di `term` all'interno di body_rect.
+    Ritorna una lista di fitz.Rect, uno per occorrenza.
+    """
+    return locate_terms(page, body_rect, [term])[term]
+
+
+_WS_RUN = re.compile(r"\s+")
+
+
+def make_snippets(body_text: str, terms: List[str],
+                  spans: Optional[Dict[str, Tuple[int, int]]] = None,
+                  max_ctx: int = 60) -> Dict[str, str]:
+    """
+    Piccoli 'contesti' dei toponimi nel testo pagina, per annale_tagged.ndjson:
+    {termine: snippet}, max_ctx caratteri per lato sul testo a spazi compressi.
+
+    Gli spazi vengono compressi una volta per pagina; la posizione di ogni
+    termine viene dagli offset dell'entità spaCy (`spans`: termine ->
+    (start_char, end_char) in body_text) riportati sul testo compresso.
+    I termini senza offset vengono cercati nel testo (prima occorrenza,
+    senza distinguere maiuscole).
+    """
+    if not body_text:
+        return {term: "" for term in terms}
+    spans = spans or {}
+    clean_txt = _WS_RUN.sub(" ", body_text)
+    clean_lower = None
+
+    # offset originale -> offset nel testo compresso: ogni sequenza di
+    # spazi lunga L ne toglie L - 1
+    run_starts: List[int] = []
+    removed: List[int] = []
+    tot = 0
+    for m in _WS_RUN.finditer(body_text):
+        tot += m.end() - m.start() - 1
+        run_starts.append(m.start())
+        removed.append(tot)
+
+    def to_clean(i: int) -> int:
+        k = bisect_left(run_starts, i)  # sequenze che iniziano prima di i
+        return i - (removed[k - 1] if k else 0)
+
+    out: Dict[str, str] = {}
+    for term in terms:
+        span = spans.get(term)
+        if span is not None:
+            s, e = span
+            ent_txt = _WS_RUN.sub(" ", body_text[s:e])
+            lead = len(ent_txt) - len(ent_txt.lstrip(ENTITY_STRIP_CHARS))
+            start = to_clean(s) + lead
+        else:
+            if clean_lower is None:
+                clean_lower = clean_txt.lower()
+            start = (clean_lower.find(term.lower())
+                     if len(clean_lower) == len(clean_txt) else -1)
+            if start < 0:
+                m = re.search(re.escape(term), clean_txt, re.IGNORECASE)
+                start = m.start() if m else -1
+        if start < 0:
+            out[term] = ""
             continue
+        end = start + len(term)
+        out[term] = clean_txt[max(0, start - max_ctx):min(len(clean_txt), end + max_ctx)].strip()
+    return out
+
+
+# ---------------- Elaborazione per pagina (scansione, NER, box) ----------------
+
+def scan_page(page: fitz.Page, layer: Optional[PageTextLayer] = None,
+              text_key: Optional[Tuple[str, int]] = None) -> Dict:
+    """
+    Legge da una pagina tutto ciò che serve prima della NER: numero di pagina
+    (footer), ID/anno trovati SU QUESTA pagina (None se assenti: il riporto
+    dalla pagina precedente lo fa _ExtractWriter), rettangolo del corpo,
+    testo per la NER, indice delle parole del corpo (per i box) e impronta
+    del testo per la pre-scansione (`text_key`, se già calcolata).
+
+    La pagina viene analizzata una volta sola (PageTextLayer) e tutte le
+    letture di testo passano da lì.
+    """
+    layer = layer or PageTextLayer(page)
+    text_hash, text_chars = text_key or page_text_key(page, layer.textpage)
+    id_found, year_found = extract_id_year(page, layer=layer)
+    body_rect = compute_body_rect(page, layer=layer)
+    return {
+        "index": page.number,
+        "page_label": get_footer_page_number(page, layer=layer),
+        "id_found": id_found,
+        "year_found": year_found,
+        "body_rect": body_rect,
+        "body_text": text_for_nlp(page, body_rect, layer=layer),
+        "word_index": PageWordIndex.from_page(page, body_rect, layer=layer),
+        "text_hash": text_hash,
+        "text_chars": text_chars,
+    }
+
+
+def skipped_page_result(page: fitz.Page, reason: str,
+                        layer: Optional[PageTextLayer] = None,
+                        text_key: Tuple[Optional[str], int] = (None, 0)) -> Dict:
+    """
+    Risultato di una pagina scartata dalla pre-scansione (prescan.py): stessa
+    forma di analyze_page(), senza candidati, con il motivo in "skipped".
+    ID e anno si leggono comunque se la pagina ha testo (quasi vuota,
+    duplicata): _ExtractWriter li riporta sulle pagine successive.
+    """
+    id_found = year_found = None
+    if reason != "no_text_layer":
+        id_found, year_found = extract_id_year(page, layer=layer)
+    return {
+        "index": page.number,
+        "page_label": get_footer_page_number(page, layer=layer),
+        "id_found": id_found,
+        "year_found": year_found,
+        "candidates": [],
+        "pre_excluded": [],
+        "terms": [],
+        "skipped": reason,
+        "text_hash": text_key[0],
+        "text_chars": text_key[1],
+    }
+
 
-        ok_context = False
-
-        left_words = [normalize_name(t.text) for t in left if t.is_alpha]
-        if any(w in LOC_PREPS for w in left_words[-4:]):
-            ok_context = True
-
-        if not ok_context:
-            left10 = doc[max(0, ent.start - 10):ent.start]
-            if any(lemma(t) in LOC_VERBS for t in left10 if t.pos_ in {"VERB", "AUX"}):
-                ok_context = True
-
-        if not ok_context:
-            right6 = doc[ent.end: min(len(doc), ent.end + 6)]
-            right_words = [normalize_name(t.text) for t in right6 if t.is_alpha]
-            if (any(w in {"in", "a"} for w in left_words[-4:])
-                and any(w in ADDR_WORDS for w in right_words[:4])):
-                ok_context = True
-
-        if not ok_context:
-            sent_txt = re.sub(r"\s+", " ", ent.sent.text)
-            verb_pat = (
-                r"(risied\w+|resident\w+|domicili\w+|abit\w+|nato|nata|provenient\w+|"
-                r"recat\w+|tornat\w+|emigrat\w+|oriundo|dimor\w+|trasferit\w+|arrestat\w+)"
-            )
-            if re.search(verb_pat + r".{0,80}\b" + re.escape(raw) + r"\b",
-                         sent_txt, flags=re.IGNORECASE):
-                ok_context = True
-
-        if not ok_context:
-            sent_txt = ent.sent.text
-            if re.search(
-                rf"\b{re.escape(raw)}\s*,\s*(?:add[iì]|li|\d{{1,2}}\s+({months}))",
-                sent_txt,
-                flags=re.IGNORECASE
-            ):
-                ok_context = True
-
-        if not ok_context and norm in ALWAYS_ALLOW:
-            ok_context = True
-
-        if not ok_context:
-            excluded.append((raw, "no_spatial_context"))
+def collect_page_texts(doc: fitz.Document, indices: Iterable[int],
+                       prescan: Optional[PagePrescan] = None) -> List[Dict]:
+    """
+    Primo stadio dell'estrazione: scan_page() sulle pagine indicate
+    (indici 0-based). Con `prescan` le pagine da saltare danno subito
+    skipped_page_result(), letto dallo stesso PageTextLayer.
+    Nessuna chiamata a spaCy qui.
+    """
+    out: List[Dict] = []
+    for idx in indices:
+        page = doc.load_page(idx)
+        if prescan is None:
+            out.append(scan_page(page))
+            continue
+        if not has_text_operators(page):
+            out.append(skipped_page_result(page, "no_text_layer"))
             continue
+        layer = PageTextLayer(page)
+        text_key = page_text_key(page, layer.textpage)
+        reason = prescan.reason(idx, *text_key)
+        if reason:
+            out.append(skipped_page_result(page, reason, layer, text_key))
+        else:
+            out.append(scan_page(page, layer, text_key))
+    return out
+
+
+def analyze_page(page: fitz.Page, info: Dict,
+                 candidates: List[str], pre_excluded: List[Tuple[str, str]],
+                 spans: Optional[List[Tuple[int, int]]] = None) -> Dict:
+    """
+    Terzo stadio: dato l'output NER di una pagina, localizza i box di ogni
+    candidato e prepara gli snippet. Non modifica la pagina: la marcatura
+    la applica marking.py, a partire dai box salvati nelle attestazioni.
+    `spans` = offset delle entità dei candidati (stesso ordine), per gli snippet.
+
+    Il risultato contiene solo tipi semplici (serializzabile / picklable):
+      {
+        "index", "page_label", "id_found", "year_found",
+        "candidates": [...],                 # unici, in ordine
+        "pre_excluded": [[term, reason], ...],
+        "terms": [{"term", "boxes": [[x0,y0,x1,y1], ...], "snippet"}, ...],
+        "text_hash", "text_chars",           # impronta del testo (prescan.py)
+      }
+    """
+    unique_candidates = ordered_unique(candidates)
+    terms: List[Dict] = []
+
+    # snippet di tutti i candidati in un solo passaggio sul testo
+    span_by_term: Dict[str, Tuple[int, int]] = {}
+    for term, span in zip(candidates, spans or ()):
+        span_by_term.setdefault(term, tuple(span))
+    snippets = make_snippets(info["body_text"], unique_candidates, span_by_term)
+
+    # bounding boxes di tutti i candidati, con un solo passaggio sulle parole
+    rects_by_term = locate_terms(page, info["body_rect"], unique_candidates,
+                                 word_index=info.get("word_index"))
+
+    for term in unique_candidates:
+        rects_here = rects_by_term[term]
+        boxes = []
+        for rr in rects_here:
+            if rr is None:
+                continue
+            boxes.append([
+                float(rr.x0), float(rr.y0), float(rr.x1), float(rr.y1)
+            ])
 
-        seen_norm.add(norm)
-        selected.append(raw)
+        terms.append({
+            "term": term,
+            "boxes": boxes,
+            "snippet": snippets[term],
+        })
 
-    return selected, excluded
+    return {
+        "index": info["index"],
+        "page_label": info["page_label"],
+        "id_found": info["id_found"],
+        "year_found": info["year_found"],
+        "candidates": unique_candidates,
+        "pre_excluded": [[term, reason] for term, reason in pre_excluded],
+        "terms": terms,
+        "text_hash": info["text_hash"],
+        "text_chars": info["text_chars"],
+    }
 
 
-# ---------------- Localizzazione rettangoli nel PDF ----------------
+def extract_pages(doc: fitz.Document, indices: List[int], nlp,
+                  batch_size: int = NLP_BATCH_SIZE, context_mode: str = "full",
+                  doc_store: Optional[DocStore] = None, n_process: int = 1,
+                  prescan: Optional[PagePrescan] = None):
+    """
+    Generatore: estrazione completa (scan -> NER a batch -> analisi) delle
+    pagine `indices`, un risultato di analyze_page() per pagina, in ordine.
+
+    Le pagine sono lavorate a blocchi di `batch_size`: ogni blocco è un
+    batch di nlp.pipe e in memoria restano solo i testi del blocco corrente.
+    context_mode: "full" o "lazy" (vedi detect_candidates_batched).
+    Con `doc_store` il Doc di ogni pagina viene salvato per il re-filtro.
+    Con n_process > 1 (solo context_mode="full") ogni blocco è di
+    batch_size x n_process pagine, un batch per processo di spaCy.
+    Con `prescan` le pagine da saltare non passano dalla NER: il loro
+    risultato è quello di skipped_page_result().
+    """
+    batch_size = max(1, int(batch_size))
+    n_process = max(1, int(n_process)) if context_mode == "full" else 1
+    block = batch_size * n_process
+    for start in range(0, len(indices), block):
+        # stadio 1: testi del corpo pagina
+        pages = collect_page_texts(doc, indices[start:start + block], prescan)
+
+        # stadio 2: NER a batch + euristiche di contesto (generatore, in ordine)
+        ner_docs: List = []
+        ner_results = iter(detect_candidates_batched(
+            nlp, (p["body_text"] for p in pages if not p.get("skipped")),
+            batch_size=batch_size, context_mode=context_mode,
+            doc_sink=ner_docs.append if doc_store is not None else None,
+            n_process=n_process,
+        ))
+
+        # stadio 3: box + snippet
+        k = 0
+        for info in pages:
+            if info.get("skipped"):
+                yield info
+                continue
+            candidates, pre_excluded, spans = next(ner_results)
+            if doc_store is not None:
+                doc_store.put(info["index"], ner_docs[k], context_mode)
+            k += 1
+            page = doc.load_page(info["index"])
+            yield analyze_page(page, info, candidates, pre_excluded, spans)
 
-def union_rect(rects: List[fitz.Rect]) -> Optional[fitz.Rect]:
-    """Restituisce il bounding box unificato di più rettangoli."""
-    if not rects:
-        return None
-    r = fitz.Rect(rects[0])
-    for rr in rects[1:]:
-        r |= rr
-    return r
 
+def _apply_prescan(prescan: PagePrescan, res: Dict) -> Dict:
+    """
+    Esito definitivo della pre-scansione per un risultato di pagina, in
+    ordine di pagina: un duplicato può emergere solo qui (pagina calcolata
+    in un altro worker, o ripresa da checkpoint/cache).
+    """
+    reason = prescan.reason(res["index"], res.get("text_hash"), res.get("text_chars") or 0)
+    if reason:
+        prescan.count(reason)
+        if res.get("skipped") != reason:
+            res = dict(res, candidates=[], pre_excluded=[], terms=[], skipped=reason)
+    return res
 
-def locate_term_occurrences(page: fitz.Page, body_rect: fitz.Rect, term: str) -> List[fitz.Rect]:
+
+# ---------------- Scrittura output (merge in ordine di pagina) ----------------
+
+class _ExtractWriter:
     """
-    Trova le occorrenze (visive) di `term` all'interno di body_rect.
-    Ritorna una lista di fitz.Rect, uno per occorrenza.
+    Riceve i risultati di analyze_page() in ordine di pagina e produce
+    gli output di phase_extract(): CSV, esclusi, attestazioni e tagged
+    (il PDF marcato lo costruisce marking.py dai box). Qui avviene anche
+    il riporto di ID/anno dalle pagine precedenti, così l'ordine di calcolo
+    delle pagine è irrilevante.
+
+    Ogni pagina viene scritta subito su tutti i file (CSV e NDJSON, vedi
+    attestations.py): in memoria resta solo l'indice dei toponimi.
     """
-    words = page.get_text("words")
-    filtered = []
-    for w in words:
-        rect = fitz.Rect(w[0], w[1], w[2], w[3])
-        inter = rect & body_rect
-        if inter.get_area() > 0.5 * rect.get_area():
-            filtered.append(w)
-
-    term_norm = re.sub(r"[\W_]+", "", term, flags=re.UNICODE).lower()
-    MAX_WIN = 4
-    hits: List[fitz.Rect] = []
-    n = len(filtered)
-    i = 0
-    while i < n:
-        matched = False
-        for win in range(1, min(MAX_WIN, n - i) + 1):
-            toks = [filtered[i + k][4] for k in range(win)]
-            cand = "".join(
-                re.sub(r"[\W_]+", "", t, flags=re.UNICODE) for t in toks
-            ).lower()
-            if cand == term_norm:
-                rects_here = [
-                    fitz.Rect(filtered[i + k][0], filtered[i + k][1],
-                              filtered[i + k][2], filtered[i + k][3])
-                    for k in range(win)
-                ]
-                hits.append(union_rect(rects_here))
-                i += win
-                matched = True
-                break
-        if not matched:
-            i += 1
-    return hits
-
-
-def add_highlight_and_star(page: fitz.Page, rect: fitz.Rect):
-    """
-    Evidenzia nel PDF e aggiunge un asterisco accanto.
-    Manteniamo questo output visivo legacy,
-    ma in parallelo ora generiamo anche annale_tagged.json
-    per una marcatura testuale più pulita.
+
+    def __init__(self, out_dir: str, doc_store: Optional[DocStore] = None):
+        self.csv_path = os.path.join(out_dir, "annale_toponimi.csv")
+        self.out_dir = out_dir
+        self.excl_csv = os.path.join(out_dir, "annale_toponimi_esclusi.csv")
+        self.last_id = None
+        self.last_year = None
+
+        self._csvf = open(self.csv_path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._csvf)
+        self._writer.writerow(["pagina", "anno", "id", "luogo"])
+
+        self._exf = open(self.excl_csv, "w", newline="", encoding="utf-8")
+        self._excl_writer = csv.writer(self._exf)
+        self._excl_writer.writerow(["pagina", "anno", "id", "termine", "stadio", "ragione"])
+
+        self.attest = AttestationWriter(out_dir)
+        self.attest_path = self.attest.attest_path
+        self.tagged_path = self.attest.tagged_path
+        self.index_path = self.attest.index_path
+
+        # manifest delle pagine per il re-filtro (extract_docs/pages.ndjson)
+        self.doc_store = doc_store
+        self._manf = doc_store.open_manifest() if doc_store is not None else None
+
+    def add_page(self, res: Dict):
+        idx = res["index"]
+        pg_num = res["page_label"]
+
+        if res["id_found"] is not None:
+            self.last_id, self.last_year = res["id_found"], res["year_found"]
+        page_id, page_year = self.last_id, self.last_year
+
+        # pagina saltata dalla pre-scansione: una riga senza termine
+        if res.get("skipped"):
+            self._excl_writer.writerow((
+                pg_num, page_year or "", page_id or "",
+                "", "page_skip", res["skipped"]
+            ))
+
+        # esclusi preliminari
+        for term, reason in res["pre_excluded"]:
+            self._excl_writer.writerow((
+                pg_num, page_year or "", page_id or "",
+                term, "pre_filter", reason
+            ))
+
+        # attestazioni (box + snippet) e vista "tagged" della pagina
+        self.attest.add_page(pg_num, idx, res["terms"])
+
+        # CSV principale: tutti i candidati trovati su questa pagina
+        self._writer.writerow([
+            pg_num,
+            page_year or "",
+            page_id or "",
+            ";".join(res["candidates"])
+        ])
+
+        if self._manf is not None:
+            self._manf.write((json.dumps({
+                "index": idx,
+                "page_label": pg_num,
+                "id_found": res["id_found"],
+                "year_found": res["year_found"],
+                "candidates": res["candidates"],
+                "pre_excluded": res["pre_excluded"],
+                "skipped": res.get("skipped"),
+            }, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    def close(self):
+        self._csvf.close()
+        self._exf.close()
+        self.attest.close()
+        if self._manf is not None:
+            self._manf.close()
+            self.doc_store.commit_manifest()
+
+        # un PDF marcato di una run precedente non corrisponde più ai box:
+        # verrà ricostruito da marking.py
+        remove_marked_outputs(self.out_dir)
+
+    def abort(self):
+        """
+        Chiude i file dopo un errore ed elimina gli output scritti a metà;
+        il nuovo manifest non viene pubblicato.
+        """
+        self._csvf.close()
+        self._exf.close()
+        for p in (self.csv_path, self.excl_csv):
+            if os.path.exists(p):
+                os.remove(p)
+        self.attest.abort()
+        if self._manf is not None:
+            self._manf.close()
+            if os.path.exists(self._manf.name):
+                os.remove(self._manf.name)
+
+
+# ---------------- Estrazione parallela (process pool) ----------------
+
+def _extract_shard(args) -> List[Dict]:
+    """
+    Worker del process pool: apre il proprio fitz.Document ed estrae un
+    blocco contiguo di pagine. Con start method "fork" il modello spaCy
+    è già nel registro del processo padre (condiviso copy-on-write).
     """
+    pdf_path, indices, batch_size, context_mode, docs_out_dir, profile, min_chars = args
+    nlp = profile_nlp(profile)[0] if profile else get_nlp()
+    doc_store = DocStore(docs_out_dir, profile) if docs_out_dir else None
+    # duplicati solo tra le pagine del blocco: il resto lo fa phase_extract
+    prescan = PagePrescan(min_chars) if min_chars is not None else None
+    doc = fitz.open(pdf_path)
     try:
-        a = page.add_highlight_annot(rect)
-        a.set_colors({"stroke": (1, 1, 0), "fill": (1, 1, 0)})
-        a.update()
-    except Exception:
-        pass
+        return list(extract_pages(doc, indices, nlp, batch_size=batch_size,
+                                  context_mode=context_mode, doc_store=doc_store,
+                                  prescan=prescan))
+    finally:
+        doc.close()
 
-    try:
-        h = rect.y1 - rect.y0
-        fs = max(8, min(12, h))
-        x = rect.x1 + 1.5
-        y = rect.y0 + max(fs * 0.85, h * 0.8)
-        page.insert_text(
-            fitz.Point(x, y), "*",
-            fontsize=fs, color=(0, 0, 0), overlay=True
-        )
-    except Exception:
-        pass
+
+def _shard_indices(indices: List[int], workers: int) -> List[List[int]]:
+    """
+    Divide gli indici in blocchi contigui: qualche blocco per worker,
+    così i worker più veloci ne prendono altri (bilanciamento del carico).
+    """
+    n_shards = max(1, min(len(indices), workers * EXTRACT_SHARDS_PER_WORKER))
+    size = -(-len(indices) // n_shards)  # ceil
+    return [indices[i:i + size] for i in range(0, len(indices), size)]
 
 
-def _make_snippets_for_term(body_text: str, term: str, max_ctx: int = 60) -> List[str]:
+def _iter_results_parallel(pdf_path: str, indices: List[int], workers: int,
+                           batch_size: int, context_mode: str = "full",
+                           docs_out_dir: Optional[str] = None, profile: Optional[str] = None,
+                           min_chars: Optional[int] = None):
     """
-    Restituisce piccoli 'contesti' in cui compare il toponimo nel testo pagina,
-    per costruire annale_tagged.json.
+    Distribuisce i blocchi di pagine su `workers` processi e restituisce
+    i risultati nell'ordine di pagina (imap preserva l'ordine dei blocchi).
+    `min_chars`: soglia della pre-scansione nei worker (None = nessuna).
     """
-    snippets = []
-    if not body_text:
-        return snippets
-    clean_txt = re.sub(r"\s+", " ", body_text)
-    pat = re.compile(re.escape(term), re.IGNORECASE)
-    for m in pat.finditer(clean_txt):
-        start = max(0, m.start() - max_ctx)
-        end = min(len(clean_txt), m.end() + max_ctx)
-        snip = clean_txt[start:end].strip()
-        if snip not in snippets:
-            snippets.append(snip)
-    return snippets
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+    shards = _shard_indices(indices, workers)
+    with ctx.Pool(processes=min(workers, len(shards))) as pool:
+        for shard_results in pool.imap(
+            _extract_shard, [(pdf_path, sh, batch_size, context_mode, docs_out_dir, profile,
+                              min_chars) for sh in shards]
+        ):
+            yield from shard_results
 
 
 # ---------------- Public API: phase_extract ----------------
 
-def phase_extract(pdf_path: str, out_dir: str, include_ranges: str = "") -> Dict:
+def phase_extract(pdf_path: str, out_dir: str, include_ranges: str = "",
+                  batch_size: Optional[int] = None,
+                  workers: Optional[int] = None,
+                  progress_cb=None,
+                  mark: bool = False,
+                  context_mode: Optional[str] = None,
+                  mark_output: str = MARK_OUTPUT,
+                  skip_pages: bool = PAGE_SKIP,
+                  keep_docs: bool = EXTRACT_KEEP_DOCS,
+                  n_process: int = NLP_N_PROCESS,
+                  profile: Optional[str] = EXTRACT_PROFILE) -> Dict:
     """
     Esegue la 'FASE 1':
     - Estrae toponimi pagina per pagina usando spaCy e le euristiche di contesto
-    - Evidenzia i toponimi nel PDF marcato
     - Salva:
-        * annale_marked.pdf
         * annale_toponimi.csv
         * annale_toponimi_esclusi.csv
     - NUOVO:
-        * annale_attestazioni.json  (per click -> pagina/bbox)
-        * annale_tagged.json        (snippet di contesto testuale)
+        * annale_attestazioni.ndjson + annale_attestazioni_index.json
+                                    (per click -> pagina/bbox)
+        * annale_tagged.ndjson      (snippet di contesto testuale)
+
+    La NER lavora in due stadi: prima raccogliamo i testi del corpo delle
+    pagine (collect_page_texts), poi li passiamo a nlp.pipe a blocchi di
+    `batch_size` pagine. Con context_mode="lazy" la pipeline completa
+    (tagger, parser, ...) gira solo sulle finestre di testo attorno alle
+    entità che le regole sui token non bastano a decidere.
+
+    Con workers > 1 le pagine vengono divise in blocchi contigui ed estratte
+    da un process pool; i risultati vengono riuniti in ordine di pagina e
+    gli output sono identici a quelli dell'estrazione sequenziale.
+    In alternativa (workers=1) n_process > 1 usa il multiprocessing di
+    nlp.pipe, con il filtro di contesto come componente spaCy (component.py).
+
+    Ogni pagina completata viene registrata in extract_checkpoint/: se
+    l'estrazione si interrompe, una nuova chiamata sullo stesso job riparte
+    dalle pagine mancanti e ricostruisce gli output completi.
+
+    I risultati per pagina finiscono anche in extract_cache/ (chiave =
+    contenuto pagina + modello + HEURISTICS_VERSION): una nuova estrazione
+    con range più ampio calcola solo le pagine non ancora viste.
+
+    Con keep_docs (EXTRACT_KEEP_DOCS) i Doc spaCy delle pagine restano in
+    extract_docs/ (docstore.py): refilter.phase_refilter() rigenera CSV e
+    attestazioni con regole di contesto diverse senza rileggere il PDF.
+
+    progress_cb(done, total, current_page) viene chiamato dopo ogni pagina
+    (current_page = numero di pagina visibile nel footer).
+
+    Con include_ranges si visitano solo le pagine dei range (fusi da
+    parse_include_ranges): il costo non dipende dalla lunghezza del PDF.
+
+    Con skip_pages (PAGE_SKIP) una pre-scansione economica (prescan.py)
+    scarta prima della NER le pagine solo immagine, quasi vuote o duplicate
+    di una pagina precedente: finiscono in annale_toponimi_esclusi.csv con
+    stadio "page_skip" e il motivo. Nel risultato: pagine saltate per
+    motivo e stima del tempo risparmiato (pagine saltate prima della NER x
+    tempo medio di una pagina calcolata).
+
+    Con `profile` (profiles.py: fast, balanced, accurate) modello,
+    componenti spaCy e default di batch_size / workers / context_mode
+    vengono dal profilo; i valori passati esplicitamente prevalgono.
+    Senza profilo: get_nlp() e NLP_BATCH_SIZE / EXTRACT_WORKERS / CONTEXT_MODE.
+
+    Il PDF marcato non è sul percorso critico: con mark=True viene costruito
+    subito (marking.phase_mark, nella forma `mark_output`: full, subset o
+    incremental), altrimenti lo si costruisce dopo, in background o al primo
+    download (marking.ensure_marked_pdf).
 
     Ritorna un dict con i path principali.
     """
-    nlp = try_load_spacy()
+    prof = get_profile(profile) if profile else {}
+    batch_size = batch_size or prof.get("batch_size") or NLP_BATCH_SIZE
+    workers = workers or prof.get("workers") or EXTRACT_WORKERS
+    context_mode = context_mode or prof.get("context_mode") or CONTEXT_MODE
+
+    # il modello va caricato PRIMA del fork dei worker
+    if profile:
+        nlp, model_key = profile_nlp(profile)
+    else:
+        nlp = try_load_spacy()
+        model_key = model_status().get("model")
 
     if not os.path.exists(pdf_path):
         raise FileNotFoundError(f"PDF non trovato: {pdf_path}")
+    if context_mode not in CONTEXT_MODES:
+        raise ValueError(f"context_mode non valido: {context_mode}")
+    # la modalità lazy può dare risultati (di poco) diversi: cache separata
+    heuristics_key = HEURISTICS_VERSION if context_mode == "full" else f"{HEURISTICS_VERSION}+{context_mode}"
 
     doc = fitz.open(pdf_path)
     total_pages = doc.page_count
     includes = parse_include_ranges(include_ranges, total_pages)
-
-    excluded_rows: List[Tuple[str,str,str,str,str,str]] = []
-    attest_index: Dict[str, Dict] = {}  # norm(term) -> {term_display, occurrences:[...]}
-    tagged_pages: List[Dict] = []
-
-    last_id = None
-    last_year = None
-
-    csv_path = os.path.join(out_dir, "annale_toponimi.csv")
-    pdf_out_path = os.path.join(out_dir, "annale_marked.pdf")
-    excl_csv = os.path.join(out_dir, "annale_toponimi_esclusi.csv")
-    attest_json_path = os.path.join(out_dir, "annale_attestazioni.json")
-    tagged_json_path = os.path.join(out_dir, "annale_tagged.json")
-
-    with open(csv_path, "w", newline="", encoding="utf-8") as csvf:
-        writer = csv.writer(csvf)
-        writer.writerow(["pagina", "anno", "id", "luogo"])
-
-        for idx in range(total_pages):
-            if not index_in_includes(idx, includes):
-                continue
-
-            page = doc.load_page(idx)
-            pg_num = get_footer_page_number(page)
-
-            page_id, page_year = extract_id_year(page, last_id, last_year)
-            last_id, last_year = page_id, page_year
-
-            body_rect = compute_body_rect(page)
-            body_text = text_for_nlp(page, body_rect)
-
-            # step NER + filtraggio
-            candidates, pre_excluded = detect_candidates_with_context(nlp, body_text)
-
-            # salva info su esclusi preliminari
-            for term, reason in pre_excluded:
-                excluded_rows.append((
-                    pg_num, page_year or "", page_id or "",
-                    term, "pre_filter", reason
-                ))
-
-            unique_candidates = ordered_unique(candidates)
-
-            # per annale_tagged.json
-            page_tag_attest: List[Dict] = []
-
-            for term in unique_candidates:
-                # individua bounding boxes di quel termine su questa pagina
-                rects_here = locate_term_occurrences(page, body_rect, term)
-                for r in rects_here:
-                    if r is None:
-                        continue
-                    add_highlight_and_star(page, r)
-
-                # snippet testuali
-                snippets = _make_snippets_for_term(body_text, term)
-                snippet_preview = snippets[0] if snippets else ""
-
-                # aggiorna indice attestazioni
-                norm = normalize_name(term)
-                entry = attest_index.get(norm)
-                if not entry:
-                    entry = {
-                        "term_display": term,
-                        "occurrences": []
-                    }
-
-                boxes = []
-                for rr in rects_here:
-                    if rr is None:
-                        continue
-                    boxes.append([
-                        float(rr.x0), float(rr.y0), float(rr.x1), float(rr.y1)
-                    ])
-
-                entry["term_display"] = (
-                    entry["term_display"]
-                    if len(entry["term_display"]) <= len(term)
-                    else term
-                )
-                entry["occurrences"].append({
-                    "page_label": pg_num,
-                    "pdf_page_index": idx,
-                    "boxes": boxes,
-                    "snippet": snippet_preview,
-                })
-                attest_index[norm] = entry
-
-                # aggiorna vista "tagged" per la pagina
-                page_tag_attest.append({
-                    "term": term,
-                    "snippet": snippet_preview
-                })
-
-            # CSV principale: tutti i candidati trovati su questa pagina
-            writer.writerow([
-                pg_num,
-                page_year or "",
-                page_id or "",
-                ";".join(unique_candidates)
-            ])
-
-            tagged_pages.append({
-                "page": pg_num,
-                "attestations": page_tag_attest
-            })
-
-    # salva PDF marcato
-    doc.save(pdf_out_path)
-    doc.close()
-
-    # salva CSV degli esclusi preliminari
-    with open(excl_csv, "w", newline="", encoding="utf-8") as exf:
-        w = csv.writer(exf)
-        w.writerow(["pagina", "anno", "id", "termine", "stadio", "ragione"])
-        for row in excluded_rows:
-            w.writerow(row)
-
-    # salva indice attestazioni
-    with open(attest_json_path, "w", encoding="utf-8") as f_att:
-        json.dump(attest_index, f_att, ensure_ascii=False, indent=2)
-
-    # salva versione "tagged"
-    with open(tagged_json_path, "w", encoding="utf-8") as f_tag:
-        json.dump(tagged_pages, f_tag, ensure_ascii=False, indent=2)
+    indices = list(iter_included_indices(includes, total_pages))
+
+    # pagine già completate da un'estrazione precedente interrotta
+    checkpoint = ExtractCheckpoint(out_dir, {
+        "pdf": pdf_fingerprint(pdf_path),
+        "includes": [list(r) for r in includes] if includes else None,
+        "model": model_key,
+        "context_mode": context_mode,
+        "heuristics": heuristics_key,
+    })
+    done = checkpoint.load()
+
+    # pagine già estratte in una run precedente (stesso contenuto, modello,
+    # versione euristiche), anche con un range diverso
+    page_cache = PageCache(out_dir)
+    cache_keys: Dict[int, str] = {}
+    pages_cached = 0
+    for idx in indices:
+        if idx in done:
+            continue
+        key = page_content_key(doc.load_page(idx), model_key, heuristics_key)
+        cached = page_cache.get(key)
+        if cached is not None:
+            done[idx] = cached
+            pages_cached += 1
+        else:
+            cache_keys[idx] = key
+    todo = [idx for idx in indices if idx not in done]
+
+    # pre-scansione (prescan.py): le pagine da calcolare si classificano nello
+    # stadio di scansione; quelle già pronte entrano qui con l'impronta del
+    # testo salvata nel risultato, così i duplicati valgono su tutte le incluse
+    prescan = PagePrescan(PAGE_MIN_CHARS) if skip_pages else None
+    if prescan is not None:
+        for idx in sorted(done):
+            res = done[idx]
+            if "text_chars" not in res:
+                # risultato di una versione precedente: si rilegge la pagina
+                res["text_hash"], res["text_chars"] = page_text_key(doc.load_page(idx))
+            prescan.reason(idx, res["text_hash"], res["text_chars"])
+
+    doc_store = DocStore(out_dir, profile or None) if keep_docs else None
+    if doc_store is None:
+        # Doc di una run precedente: non corrisponderebbero più agli output
+        shutil.rmtree(DocStore(out_dir).dir, ignore_errors=True)
+
+    writer = None
+    try:
+        writer = _ExtractWriter(out_dir, doc_store)
+        if not todo:
+            computed = iter(())
+        elif workers > 1 and len(todo) > 1:
+            computed = _iter_results_parallel(pdf_path, todo, workers, batch_size,
+                                              context_mode=context_mode,
+                                              docs_out_dir=out_dir if keep_docs else None,
+                                              profile=profile,
+                                              min_chars=PAGE_MIN_CHARS if skip_pages else None)
+        else:
+            computed = extract_pages(doc, todo, nlp, batch_size=batch_size,
+                                     context_mode=context_mode, doc_store=doc_store,
+                                     n_process=n_process, prescan=prescan)
+
+        total = len(indices)
+        if progress_cb:
+            progress_cb(0, total, None)
+
+        # merge in ordine di pagina: checkpoint/cache + pagine appena calcolate
+        # (le saltate non vanno in checkpoint né in cache: dipendono dalle
+        # altre pagine incluse e da PAGE_SKIP/PAGE_MIN_CHARS)
+        t0 = time.perf_counter()
+        skipped_before_ner = 0
+        for i, idx in enumerate(indices, start=1):
+            res = done.get(idx)
+            if res is None:
+                res = next(computed)
+                if res.get("skipped"):
+                    skipped_before_ner += 1
+                else:
+                    checkpoint.append(res)
+                    page_cache.put(cache_keys[idx], res)
+            if prescan is not None:
+                res = _apply_prescan(prescan, res)
+            writer.add_page(res)
+            if progress_cb:
+                progress_cb(i, total, res["page_label"])
+        compute_seconds = time.perf_counter() - t0
+        writer.close()
+        checkpoint.clear()
+    except BaseException:
+        # niente output a metà: il checkpoint resta per riprendere
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        checkpoint.close()
+        doc.close()
+
+    marked_pdf = phase_mark(pdf_path, out_dir, mark_output)["pdf"] if mark else None
+
+    # stima: pagine saltate prima della NER x tempo medio di una pagina calcolata
+    pages_skipped = prescan.skipped if prescan is not None else 0
+    pages_computed = len(todo) - skipped_before_ner
+    skip_seconds_saved = None
+    if skipped_before_ner and pages_computed:
+        skip_seconds_saved = round(skipped_before_ner * compute_seconds / pages_computed, 2)
+    if pages_skipped:
+        logger.info("Pre-scansione: %d pagine saltate %s, ~%ss risparmiati",
+                    pages_skipped, prescan.counts, skip_seconds_saved)
 
     return {
-        "csv": csv_path,
-        "pdf": pdf_out_path,
-        "exclusions": excl_csv,
-        "attestazioni": attest_json_path,
-        "tagged": tagged_json_path,
+        "csv": writer.csv_path,
+        "pdf": marked_pdf,
+        "exclusions": writer.excl_csv,
+        "attestazioni": writer.attest_path,
+        "attestazioni_index": writer.index_path,
+        "tagged": writer.tagged_path,
         "total_pages": total_pages,
         "include_ranges": includes,
+        "profile": profile or None,
+        "model": model_key,
+        "context_mode": context_mode,
+        "pages_processed": len(indices),
+        "pages_from_cache": pages_cached,
+        "pages_computed": pages_computed,
+        "pages_skipped": pages_skipped,
+        "pages_skipped_by_reason": dict(prescan.counts) if prescan is not None else {},
+        "skip_seconds_saved": skip_seconds_saved,
     }
@@ -0,0 +1,375 @@
+# processor/geocache.py
+"""
+Geocache su SQLite: le risposte di Nominatim per nome normalizzato.
+
+Sostituisce geocache_toponyms.json, che veniva riscritto per intero
+(con indent=2) a ogni toponimo nuovo: con migliaia di poligoni in cache
+il geocoding diventava quadratico in I/O, e un crash a metà scrittura
+lasciava un JSON illeggibile (cioè una cache vuota).
+
+Due livelli (open_geocache → LayeredGeoCache):
+  condiviso  GEOCACHE_SHARED_PATH (default cache/geocache.sqlite, fuori da
+             workspace/ che il server espone per job),
+             unico per tutti i job: "Roma" si geocoda una volta sola.
+             Le voci scadono dopo GEOCACHE_TTL_DAYS (risolte, default 180)
+             o GEOCACHE_NEG_TTL_DAYS (rifiutate, default 7: un toponimo
+             non trovato oggi può esserlo dopo un aggiornamento di OSM);
+             0 = mai. Oltre GEOCACHE_MAX_ENTRIES voci si eliminano le meno
+             usate di recente (LRU su `used`, aggiornato a ogni hit).
+             GEOCACHE_SHARED=0 lo disattiva (si torna alla cache per job).
+  job        <job>/geocache_toponyms.sqlite, letto per primo: correzioni
+             dell'utente (set_correction) e voci importate dal vecchio JSON
+             del job. Non scade e non esce dal job.
+
+Schema (uguale per i due livelli):
+  geocache(norm PRIMARY KEY, name, ok, data, reason, updated, used)
+    norm    nome normalizzato (utils._norm), chiave di lookup
+    ok      1 = risolto (data = hit normalizzato in JSON), 0 = rifiutato
+            (reason = motivo: no_results, no_accepted_candidate, ...)
+    updated scrittura della voce (per il TTL), used ultimo hit (per l'LRU)
+  meta(key PRIMARY KEY, value)
+    imported:<path json> = "size:mtime" del JSON già importato
+
+- Journal WAL: letture concorrenti mentre un altro thread/processo scrive;
+  ogni put() è un upsert in una sola istruzione (atomico).
+- Una connessione per thread (i thread del geocoding parallelo) e
+  busy_timeout per i processi che scrivono insieme (server + batch).
+- Migrazione: all'apertura il JSON accanto (o quello indicato) viene
+  importato se è cambiato dall'ultima importazione; le voci già nel
+  database hanno la precedenza. Il JSON non viene toccato.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+GEOCACHE_DB_NAME = "geocache_toponyms.sqlite"
+GEOCACHE_JSON_NAME = "geocache_toponyms.json"
+
+GEOCACHE_SHARED = os.environ.get("GEOCACHE_SHARED", "1").strip().lower() in {"1", "true", "yes"}
+GEOCACHE_SHARED_PATH = os.path.abspath(
+    os.environ.get("GEOCACHE_SHARED_PATH") or os.path.join("cache", "geocache.sqlite")
+)
+GEOCACHE_TTL_DAYS = float(os.environ.get("GEOCACHE_TTL_DAYS", "180"))
+GEOCACHE_NEG_TTL_DAYS = float(os.environ.get("GEOCACHE_NEG_TTL_DAYS", "7"))
+GEOCACHE_MAX_ENTRIES = int(os.environ.get("GEOCACHE_MAX_ENTRIES", "100000"))
+# dopo un'eviction la cache scende a questa frazione del massimo
+_EVICT_TO = 0.9
+# ogni quante scritture si controlla la dimensione
+_EVICT_EVERY = 64
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS geocache (
+    norm    TEXT PRIMARY KEY,
+    name    TEXT,
+    ok      INTEGER NOT NULL,
+    data    TEXT,
+    reason  TEXT,
+    updated REAL NOT NULL,
+    used    REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_UPSERT = """
+INSERT INTO geocache (norm, name, ok, data, reason, updated, used)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(norm) DO UPDATE SET
+    name = excluded.name, ok = excluded.ok, data = excluded.data,
+    reason = excluded.reason, updated = excluded.updated, used = excluded.used
+"""
+
+
+def _days(d: float) -> Optional[float]:
+    """Giorni → secondi (None = nessuna scadenza)."""
+    return d * 86400.0 if d and d > 0 else None
+
+
+def _legacy_entry(entry) -> Optional[Tuple[Optional[dict], Optional[str]]]:
+    """Voce del vecchio JSON → (data, reason); None se illeggibile."""
+    if isinstance(entry, dict) and entry.get("ok") is True:
+        return entry.get("data"), None
+    if isinstance(entry, dict) and entry.get("ok") is False:
+        return None, entry.get("reason", "cached_reject")
+    if isinstance(entry, dict) and ("class" in entry or "lat" in entry):
+        return entry, None
+    if entry is None:
+        return None, "cached_none"
+    return None
+
+
+class GeoCache:
+    """
+    Cache (data, reason) per nome normalizzato, thread-safe.
+    `ttl` / `neg_ttl`: secondi di validità delle voci risolte / rifiutate
+    (None = sempre valide); `max_entries`: tetto con eviction LRU (0 = nessuno).
+    """
+
+    def __init__(self, path: str, legacy_json: Optional[str] = None,
+                 ttl: Optional[float] = None, neg_ttl: Optional[float] = None,
+                 max_entries: int = 0):
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.max_entries = max(0, int(max_entries or 0))
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._puts = 0
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(geocache)")}
+        if "used" not in cols:
+            # database creato prima del TTL/LRU
+            conn.execute("ALTER TABLE geocache ADD COLUMN used REAL")
+            conn.execute("UPDATE geocache SET used = updated")
+        conn.execute("CREATE INDEX IF NOT EXISTS geocache_used ON geocache(used)")
+        if legacy_json:
+            self.import_json(legacy_json)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit: ogni istruzione è la sua transazione
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _expired(self, ok: int, updated: float, now: float) -> bool:
+        ttl = self.ttl if ok else self.neg_ttl
+        return ttl is not None and now - (updated or 0.0) > ttl
+
+    def get(self, norm: str) -> Optional[Tuple[Optional[dict], Optional[str]]]:
+        """(data, reason) della voce `norm`, o None se assente o scaduta."""
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT ok, data, reason, updated FROM geocache WHERE norm = ?", (norm,)
+        ).fetchone()
+        now = time.time()
+        if row is None or self._expired(row[0], row[3], now):
+            self.misses += 1
+            return None
+        conn.execute("UPDATE geocache SET used = ? WHERE norm = ?", (now, norm))
+        self.hits += 1
+        ok, data, reason, _ = row
+        if ok:
+            return json.loads(data), None
+        return None, reason or "cached_reject"
+
+    def put(self, norm: str, name: str, data: Optional[dict], reason: Optional[str]):
+        """Scrive (o sostituisce) la voce `norm`."""
+        self._conn().execute(_UPSERT, self._row(norm, name, data, reason))
+        if self.max_entries:
+            with self._lock:
+                self._puts += 1
+                check = self._puts % _EVICT_EVERY == 0
+            if check:
+                self.evict()
+
+    def delete(self, norm: str) -> bool:
+        """Elimina la voce `norm` (True se c'era)."""
+        return self._conn().execute("DELETE FROM geocache WHERE norm = ?", (norm,)).rowcount > 0
+
+    def evict(self) -> int:
+        """
+        Elimina le voci scadute e, oltre max_entries, le meno usate di
+        recente fino a _EVICT_TO del massimo. Ritorna le voci eliminate.
+        """
+        conn = self._conn()
+        now = time.time()
+        removed = 0
+        if self.ttl is not None:
+            removed += conn.execute("DELETE FROM geocache WHERE ok = 1 AND updated < ?",
+                                    (now - self.ttl,)).rowcount
+        if self.neg_ttl is not None:
+            removed += conn.execute("DELETE FROM geocache WHERE ok = 0 AND updated < ?",
+                                    (now - self.neg_ttl,)).rowcount
+        if self.max_entries:
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                excess += int(self.max_entries * (1.0 - _EVICT_TO))
+                removed += conn.execute(
+                    "DELETE FROM geocache WHERE norm IN "
+                    "(SELECT norm FROM geocache ORDER BY used LIMIT ?)", (excess,)
+                ).rowcount
+        if removed:
+            self.evicted += removed
+            logger.info("Geocache %s: eliminate %d voci", self.path, removed)
+        return removed
+
+    @staticmethod
+    def _row(norm, name, data, reason, updated=None) -> tuple:
+        updated = updated or time.time()
+        if data is not None:
+            return (norm, name, 1, json.dumps(data, ensure_ascii=False), None,
+                    updated, updated)
+        return (norm, name, 0, None, reason or "rejected", updated, updated)
+
+    def import_json(self, json_path: str) -> int:
+        """
+        Importa un vecchio geocache_toponyms.json (se cambiato dall'ultima
+        importazione). Le voci già presenti restano. Ritorna le voci nuove.
+        """
+        try:
+            st = os.stat(json_path)
+        except OSError:
+            return 0
+        key = "imported:" + os.path.abspath(json_path)
+        stamp = f"{st.st_size}:{st.st_mtime_ns}"
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row and row[0] == stamp:
+            return 0
+        try:
+            with open(json_path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except Exception as e:
+            logger.warning("Geocache JSON %s non importata: %s", json_path, e)
+            return 0
+        if not isinstance(legacy, dict):
+            return 0
+
+        rows = []
+        now = time.time()
+        for norm, entry in legacy.items():
+            parsed = _legacy_entry(entry)
+            if parsed is not None:
+                rows.append(self._row(norm, None, parsed[0], parsed[1], now))
+        before = len(self)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR IGNORE INTO geocache (norm, name, ok, data, reason, updated, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, stamp))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        added = len(self) - before
+        if added:
+            logger.info("Geocache: importate %d voci da %s", added, json_path)
+        return added
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM geocache").fetchone()[0]
+
+    def close(self):
+        """Chiude le connessioni di tutti i thread (a lavoro finito)."""
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self._local = threading.local()
+
+
+class LayeredGeoCache:
+    """
+    Cache del job sopra la cache condivisa (vedi docstring del modulo).
+    get() legge prima il job, put() scrive nella condivisa (nel job se non
+    c'è), set_correction() solo nel job.
+    """
+
+    def __init__(self, job_path: str, shared: Optional[GeoCache],
+                 legacy_json: Optional[str] = None):
+        self.job_path = job_path
+        self.shared = shared
+        self._job_lock = threading.Lock()
+        # il database del job si crea solo se serve (correzioni, vecchio
+        # JSON da importare, nessuna cache condivisa)
+        self.job: Optional[GeoCache] = None
+        if shared is None or legacy_json or os.path.exists(job_path):
+            self.job = GeoCache(job_path, legacy_json=legacy_json)
+
+    def _job_cache(self) -> GeoCache:
+        with self._job_lock:
+            if self.job is None:
+                self.job = GeoCache(self.job_path)
+            return self.job
+
+    def get(self, norm: str) -> Optional[Tuple[Optional[dict], Optional[str]]]:
+        if self.job is not None:
+            hit = self.job.get(norm)
+            if hit is not None:
+                return hit
+        if self.shared is not None:
+            return self.shared.get(norm)
+        return None
+
+    def put(self, norm: str, name: str, data: Optional[dict], reason: Optional[str]):
+        # `is None`: una GeoCache vuota ha len() == 0
+        cache = self.shared if self.shared is not None else self._job_cache()
+        cache.put(norm, name, data, reason)
+
+    def set_correction(self, norm: str, name: str, data: Optional[dict],
+                       reason: Optional[str] = None):
+        """Correzione dell'utente: vale solo per questo job."""
+        self._job_cache().put(norm, name, data, reason or "user_rejected")
+
+    def clear_correction(self, norm: str) -> bool:
+        """Toglie la voce del job: si torna alla cache condivisa / a Nominatim."""
+        return self._job_cache().delete(norm)
+
+    def close(self):
+        for cache in (self.job, self.shared):
+            if cache is not None:
+                cache.close()
+
+
+def shared_geocache(path: Optional[str] = None) -> GeoCache:
+    """Cache condivisa tra i job (`path` o GEOCACHE_SHARED_PATH) con TTL e tetto."""
+    return GeoCache(path or GEOCACHE_SHARED_PATH,
+                    ttl=_days(GEOCACHE_TTL_DAYS), neg_ttl=_days(GEOCACHE_NEG_TTL_DAYS),
+                    max_entries=GEOCACHE_MAX_ENTRIES)
+
+
+def open_geocache(out_dir: str, cache_path: Optional[str] = None) -> LayeredGeoCache:
+    """
+    Cache del job (<out_dir>/geocache_toponyms.sqlite, che importa il vecchio
+    geocache_toponyms.json del job) sopra la cache condivisa: `cache_path`
+    se dato (es. <out>/geocache_toponyms.sqlite del batch), altrimenti
+    GEOCACHE_SHARED_PATH (nessuna con GEOCACHE_SHARED=0). Un `cache_path`
+    .json (vecchio formato) viene importato nel .sqlite con lo stesso nome.
+    """
+    job_path = os.path.join(out_dir, GEOCACHE_DB_NAME)
+    legacy = os.path.join(out_dir, GEOCACHE_JSON_NAME)
+
+    shared: Optional[GeoCache] = None
+    if cache_path:
+        shared_legacy = None
+        if cache_path.endswith(".json"):
+            shared_legacy = cache_path
+            cache_path = cache_path[:-len(".json")] + ".sqlite"
+        if os.path.abspath(cache_path) != os.path.abspath(job_path):
+            shared = shared_geocache(cache_path)
+            if shared_legacy:
+                shared.import_json(shared_legacy)
+    elif GEOCACHE_SHARED:
+        shared = shared_geocache()
+    return LayeredGeoCache(job_path, shared,
+                           legacy_json=legacy if os.path.exists(legacy) else None)
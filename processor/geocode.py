@@ -10,13 +10,30 @@ Offriamo due modalità:
    - produce annale_toponimi.ndjson e annale_toponimi.geojson
    - produce annale_toponimi_osm_rejects.csv
 
-2. phase_geocode_grouped(out_dir, progress_cb=None)  [NUOVA]
+2. phase_geocode_grouped(out_dir, progress_cb=None, cache_path=None)  [NUOVA]
    - usa il CSV attivo (filtrato se l'utente ha escluso dei toponimi o certe
      attestazioni)
    - geocoda ogni toponimo una sola volta
    - costruisce annale_toponimi_grouped.geojson
    - produce annale_toponimi_grouped_rejects.csv
    - supporta un callback progress_cb(done, total, current_term)
+   - cache_path: geocache condivisa tra più job (es. batch da riga di
+     comando); default GEOCACHE_SHARED_PATH, sotto le correzioni del job
+     in <out_dir>/geocache_toponyms.sqlite (vedi geocache.py)
+   - più toponimi in parallelo (ThreadPoolExecutor), entro i limiti
+     dell'endpoint (vedi sotto)
+
+Due fasi: /search chiede solo i metadati per il ranking (niente
+poligoni per i ~15 candidati di ogni variante); i poligoni dei soli
+vincitori arrivano poi da /lookup, LOOKUP_BATCH_SIZE (50) id per
+richiesta (fetch_geometries). La cache tiene il dato completo.
+
+Limiti per endpoint: ogni NOMINATIM_BASE_URL ha un token bucket (richieste
+al secondo) e un tetto di richieste in volo, condivisi da tutti i thread e
+da tutti i job del processo. Il Nominatim pubblico resta a 1 richiesta/s,
+una alla volta (policy d'uso OSM) qualunque sia la configurazione; per
+un'istanza propria valgono GEOCODE_RATE (default 50 req/s, 0 = nessun
+limite) e GEOCODE_CONCURRENCY (default 20 richieste in volo).
 """
 
 from __future__ import annotations
@@ -26,7 +43,11 @@ import json
 import time
 import csv
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from typing import Dict, List, Tuple, Optional, Set
+from urllib.parse import urlparse
 
 import requests
 
@@ -35,6 +56,7 @@ from .utils import (
     ordered_unique,
 )
 from .exclusions import choose_active_csv, load_user_exclusions_full
+from .geocache import GeoCache, open_geocache
 
 logger = logging.getLogger(__name__)
 
@@ -42,7 +64,21 @@ logger = logging.getLogger(__name__)
 NOMINATIM_EMAIL = "erasmo.difonso@libero.it"
 NOMINATIM_BASE_URL = os.environ.get("NOMINATIM_BASE_URL", "https://nominatim.openstreetmap.org")
 NOMINATIM_COUNTRYCODES = "it"
-GEOCODING_SLEEP_SECONDS = 1.0
+GEOCODING_SLEEP_SECONDS = 1.0   # intervallo minimo sul Nominatim pubblico
+LOOKUP_BATCH_SIZE = 50          # id per richiesta /lookup (massimo di Nominatim)
+
+# istanza propria: richieste/s (0 = nessun limite) e richieste in volo
+GEOCODE_RATE = float(os.environ.get("GEOCODE_RATE", "50"))
+GEOCODE_CONCURRENCY = int(os.environ.get("GEOCODE_CONCURRENCY", "20"))
+PUBLIC_NOMINATIM_HOSTS = {"nominatim.openstreetmap.org"}
+
+# uscita anticipata dalle varianti: ci si ferma appena il miglior candidato
+# ha tier <= GEOCODE_EARLY_TIER e forza del nome >= GEOCODE_EARLY_MATCH
+# (2 = nome esatto, 1 = parziale; vedi _rank_key). Default: tier 2, cioè
+# anche il boundary di un comune (admin_level 8) con il nome esatto.
+# GEOCODE_EARLY_TIER=-1 prova sempre tutte le varianti.
+GEOCODE_EARLY_TIER = int(os.environ.get("GEOCODE_EARLY_TIER", "2"))
+GEOCODE_EARLY_MATCH = int(os.environ.get("GEOCODE_EARLY_MATCH", "2"))
 
 PRIMARY_PLACE_TYPES = {
     "city","town","village","hamlet","municipality",
@@ -231,6 +267,84 @@ def _normalize_hit_with_geom(hit: dict, raw_name: str) -> dict:
     return out
 
 
+# ---------------- Limiti per endpoint ----------------
+
+class TokenBucket:
+    """
+    Token bucket thread-safe: `rate` gettoni al secondo, al massimo `burst`
+    accumulati. Ogni acquire() prenota il prossimo gettone e dorme fuori dal
+    lock fino al suo turno. rate <= 0: nessun limite.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1.0
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class EndpointLimiter:
+    """Token bucket + tetto di richieste in volo per un endpoint Nominatim."""
+
+    def __init__(self, rate: float, max_inflight: int):
+        self.rate = rate
+        self.max_inflight = max_inflight
+        self.bucket = TokenBucket(rate, burst=max(1.0, rate))
+        self._slots = threading.BoundedSemaphore(max_inflight)
+
+    @contextmanager
+    def request(self):
+        with self._slots:
+            self.bucket.acquire()
+            yield
+
+
+_limiters: Dict[str, EndpointLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def endpoint_limits(base_url: Optional[str] = None) -> Tuple[float, int]:
+    """(richieste/s, richieste in volo) per `base_url` (default NOMINATIM_BASE_URL)."""
+    host = (urlparse(base_url or NOMINATIM_BASE_URL).hostname or "").lower()
+    if host in PUBLIC_NOMINATIM_HOSTS:
+        return 1.0 / GEOCODING_SLEEP_SECONDS, 1
+    return max(0.0, GEOCODE_RATE), max(1, GEOCODE_CONCURRENCY)
+
+
+def endpoint_limiter(base_url: Optional[str] = None) -> EndpointLimiter:
+    """Limiter condiviso (uno per base URL, per processo)."""
+    key = (base_url or NOMINATIM_BASE_URL).rstrip("/")
+    with _limiters_lock:
+        lim = _limiters.get(key)
+        if lim is None:
+            lim = _limiters[key] = EndpointLimiter(*endpoint_limits(key))
+        return lim
+
+
+_local = threading.local()
+
+
+def thread_session() -> requests.Session:
+    """requests.Session del thread corrente (una per thread, riusata)."""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+    return session
+
+
 # ---------------- Chiamata a Nominatim ----------------
 
 def _dump_debug(obj: dict, out_dir: str):
@@ -248,30 +362,20 @@ def _dump_debug(obj: dict, out_dir: str):
         pass
 
 
-def nominatim_search(session: requests.Session, q: str, countrycodes: Optional[str],
-                     debug_label: str, out_dir: str) -> list:
+def _nominatim_get(session: Optional[requests.Session], path: str, params: dict,
+                   q: str, debug_label: str, out_dir: str) -> list:
     """
-    Query grezza a Nominatim /search.
+    GET su Nominatim (path: "/search" o "/lookup"), entro i limiti
+    dell'endpoint. Con session=None usa la sessione del thread corrente.
+    Errori di rete/HTTP → [{"__http_error__": ...}].
     """
-    url = NOMINATIM_BASE_URL.rstrip("/") + "/search"
+    session = session or thread_session()
+    url = NOMINATIM_BASE_URL.rstrip("/") + path
     headers = {"User-Agent": f"annale-toponimi/3.2 ({NOMINATIM_EMAIL})"}
-    params = {
-        "q": q,
-        "format": "jsonv2",
-        "limit": 15,
-        "addressdetails": 1,
-        "namedetails": 1,
-        "extratags": 1,
-        "polygon_geojson": 1,
-        "polygon_threshold": 0.005,
-        "accept-language": "it",
-        "dedupe": 1,
-    }
-    if countrycodes:
-        params["countrycodes"] = countrycodes
 
     try:
-        r = session.get(url, headers=headers, params=params, timeout=25)
+        with endpoint_limiter().request():
+            r = session.get(url, headers=headers, params=params, timeout=25)
     except Exception as e:
         _dump_debug(
             {"stage": "network_exception", "query": q,
@@ -308,18 +412,125 @@ def nominatim_search(session: requests.Session, q: str, countrycodes: Optional[s
         return []
 
 
+def nominatim_search(session: Optional[requests.Session], q: str, countrycodes: Optional[str],
+                     debug_label: str, out_dir: str) -> list:
+    """
+    Query grezza a Nominatim /search, solo metadati (niente poligoni):
+    bastano a _rank_key; la geometria del vincitore arriva dopo da
+    /lookup (fetch_geometries).
+    """
+    params = {
+        "q": q,
+        "format": "jsonv2",
+        "limit": 15,
+        "addressdetails": 1,
+        "namedetails": 1,
+        "extratags": 1,
+        "accept-language": "it",
+        "dedupe": 1,
+    }
+    if countrycodes:
+        params["countrycodes"] = countrycodes
+    return _nominatim_get(session, "/search", params, q, debug_label, out_dir)
+
+
+def nominatim_lookup(session: Optional[requests.Session], osm_ids: List[str],
+                     out_dir: str) -> list:
+    """
+    Nominatim /lookup con i poligoni per al massimo LOOKUP_BATCH_SIZE id
+    ("R44874", "W123", "N456").
+    """
+    ids = ",".join(osm_ids[:LOOKUP_BATCH_SIZE])
+    params = {
+        "osm_ids": ids,
+        "format": "jsonv2",
+        "polygon_geojson": 1,
+        "polygon_threshold": 0.005,
+        "accept-language": "it",
+    }
+    return _nominatim_get(session, "/lookup", params, ids, "lookup", out_dir)
+
+
+_OSM_PREFIX = {"node": "N", "way": "W", "relation": "R"}
+
+
+def _osm_ref(data: dict) -> Optional[str]:
+    """"R44874" per un hit/dato con osm_type e osm_id (None se mancano)."""
+    prefix = _OSM_PREFIX.get(str(data.get("osm_type") or "").lower())
+    if not prefix or data.get("osm_id") in (None, ""):
+        return None
+    return f"{prefix}{data['osm_id']}"
+
+
+def needs_geometry(data: dict) -> bool:
+    """
+    True se il dato ha solo il centroide della ricerca e l'oggetto OSM può
+    avere un poligono (way/relation) non ancora chiesto a /lookup.
+    """
+    return (data.get("geometry_source") == "centroid"
+            and not data.get("geometry_checked")
+            and str(data.get("osm_type") or "").lower() in {"way", "relation"}
+            and _osm_ref(data) is not None)
+
+
+def _apply_lookup_hit(data: dict, hit: Optional[dict]):
+    geom = (hit or {}).get("geojson")
+    if isinstance(geom, dict) and geom.get("type") and geom.get("type") != "Point":
+        data["geometry"] = geom
+        data["geometry_source"] = "polygon"
+    data["geometry_checked"] = True
+
+
+def fetch_geometries(items: List[dict], session: Optional[requests.Session],
+                     out_dir: str, pool: Optional[ThreadPoolExecutor] = None) -> List[dict]:
+    """
+    Seconda fase del geocoding: per i dati con needs_geometry() chiede a
+    /lookup i poligoni, LOOKUP_BATCH_SIZE id per richiesta (in parallelo su
+    `pool`, se dato), e li scrive nei dati (in place). Un id che /lookup
+    non restituisce tiene il centroide; su errore HTTP il dato resta da
+    completare. Ritorna i dati aggiornati.
+    """
+    by_ref: Dict[str, List[dict]] = {}
+    for data in items:
+        if data is not None and needs_geometry(data):
+            by_ref.setdefault(_osm_ref(data), []).append(data)
+    if not by_ref:
+        return []
+    refs = list(by_ref)
+    batches = [refs[i:i + LOOKUP_BATCH_SIZE] for i in range(0, len(refs), LOOKUP_BATCH_SIZE)]
+    if pool is not None:
+        answers = list(pool.map(lambda b: nominatim_lookup(None, b, out_dir), batches))
+    else:
+        answers = [nominatim_lookup(session, b, out_dir) for b in batches]
+
+    updated: List[dict] = []
+    for batch, arr in zip(batches, answers):
+        if arr and "__http_error__" in arr[0]:
+            continue
+        found = {_osm_ref(h): h for h in arr if isinstance(h, dict)}
+        for ref in batch:
+            for data in by_ref[ref]:
+                _apply_lookup_hit(data, found.get(ref))
+                updated.append(data)
+    logger.debug("Geometrie: %d oggetti OSM in %d richieste /lookup", len(refs), len(batches))
+    return updated
+
+
 def geocode_name_robust(
     name: str,
-    session: requests.Session,
+    session: Optional[requests.Session],
     out_dir: str
 ) -> Tuple[Optional[dict], Optional[str]]:
     """
-    Tenta:
+    Tenta, nell'ordine:
     - bias Italia
     - "<name>, Italia"
     - globale
     - eventuale esonimo (Parigi->Paris)
-    Poi seleziona il best candidate tramite ranking.
+    fermandosi appena il miglior candidato è abbastanza buono
+    (GEOCODE_EARLY_TIER / GEOCODE_EARLY_MATCH). Poi seleziona il best
+    candidate tramite ranking; in data["variant"] la variante che l'ha
+    trovato per prima, in data["queries"] le query fatte.
     """
     q_norm = _norm(name)
     variants = [
@@ -334,10 +545,12 @@ def geocode_name_robust(
 
     all_hits: List[dict] = []
     seen_keys = set()
+    found_by: Dict[tuple, str] = {}
+    queries = 0
 
     for label, q, cc in variants:
         arr = nominatim_search(session, q, cc, label, out_dir)
-        time.sleep(GEOCODING_SLEEP_SECONDS)
+        queries += 1
 
         if arr and "__http_error__" in arr[0]:
             continue
@@ -349,9 +562,16 @@ def geocode_name_robust(
             if key in seen_keys:
                 continue
             seen_keys.add(key)
+            found_by[key] = label
             all_hits.append(h)
 
+        if all_hits and GEOCODE_EARLY_TIER >= 0:
+            tier, neg_match, _ = min(_rank_key(h, q_norm) for h in all_hits)
+            if tier <= GEOCODE_EARLY_TIER and -neg_match >= GEOCODE_EARLY_MATCH:
+                break
+
     if not all_hits:
+        logger.info("Geocoding %r: nessun risultato (%d query)", name, queries)
         return None, "no_results"
 
     all_hits.sort(key=lambda h: _rank_key(h, q_norm))
@@ -362,44 +582,87 @@ def geocode_name_robust(
             {"stage": "final_reject_all", "name": name, "top": best},
             out_dir
         )
+        logger.info("Geocoding %r: nessun candidato accettabile (%d query)", name, queries)
         return None, "no_accepted_candidate"
 
-    return _normalize_hit_with_geom(best, name), None
+    data = _normalize_hit_with_geom(best, name)
+    data["variant"] = found_by.get((best.get("osm_type"), best.get("osm_id")))
+    data["queries"] = queries
+    logger.info("Geocoding %r: %s (variante %s, %d/%d query)",
+                name, data.get("display_name"), data["variant"], queries, len(variants))
+    return data, None
 
 
 def geocode_with_cache(
     name: str,
-    cache: dict,
-    session: requests.Session,
-    out_dir: str
-) -> Tuple[Optional[dict], Optional[str], dict]:
+    cache: GeoCache,
+    session: Optional[requests.Session],
+    out_dir: str,
+) -> Tuple[Optional[dict], Optional[str], GeoCache]:
     """
-    Geocoding con cache (geocache_toponyms.json).
+    Geocoding con cache (GeoCache, vedi open_geocache). Chiamabile da più
+    thread sulla stessa cache: ogni voce nuova è un upsert atomico.
     """
     norm_key = _norm(name)
-    cache_path = os.path.join(out_dir, "geocache_toponyms.json")
-
-    if norm_key in cache:
-        entry = cache[norm_key]
-        if isinstance(entry, dict) and entry.get("ok") is True:
-            return entry["data"], None, cache
-        if isinstance(entry, dict) and entry.get("ok") is False:
-            return None, entry.get("reason","cached_reject"), cache
-        if isinstance(entry, dict) and ("class" in entry or "lat" in entry):
-            return entry, None, cache
-        if entry is None:
-            return None, "cached_none", cache
+    hit = cache.get(norm_key)
+    if hit is not None:
+        return hit[0], hit[1], cache
 
     data, reason = geocode_name_robust(name, session, out_dir)
-    if data is not None:
-        cache[norm_key] = {"ok": True, "data": data}
-    else:
-        cache[norm_key] = {"ok": False, "reason": reason or "rejected"}
+    cache.put(norm_key, name, data, reason)
+    return data, reason, cache
+
 
-    with open(cache_path, "w", encoding="utf-8") as f:
-        json.dump(cache, f, ensure_ascii=False, indent=2)
+def _store_geometries(cache, updated: List[dict]):
+    """Riscrive in cache i dati completati da fetch_geometries."""
+    for data in updated:
+        raw = data.get("raw") or ""
+        cache.put(_norm(raw), raw, data, None)
 
-    return (data if data is not None else None), reason, cache
+
+def set_geocode_correction(out_dir: str, name: str,
+                           lat: Optional[float] = None, lon: Optional[float] = None,
+                           display_name: Optional[str] = None,
+                           reject: bool = False, clear: bool = False) -> Optional[dict]:
+    """
+    Correzione dell'utente per `name` nel solo job `out_dir` (livello job
+    della geocache, vedi geocache.py): un punto (lat, lon), un rifiuto
+    (reject) o, con clear, la rimozione della correzione. Vale dal
+    prossimo geocoding; la cache condivisa non cambia.
+    Ritorna il dato salvato (None per rifiuto/rimozione).
+    """
+    norm_key = _norm(name)
+    if not norm_key:
+        raise ValueError("nome mancante")
+    cache = open_geocache(out_dir)
+    try:
+        if clear:
+            cache.clear_correction(norm_key)
+            return None
+        if reject:
+            cache.set_correction(norm_key, name, None, "user_rejected")
+            return None
+        if lat is None or lon is None:
+            raise ValueError("servono lat e lon (oppure reject / clear)")
+        lat, lon = float(lat), float(lon)
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+            raise ValueError("coordinate fuori intervallo")
+        data = {
+            "lat": lat,
+            "lon": lon,
+            "display_name": display_name or name,
+            "class": "user",
+            "type": "correction",
+            "raw": name,
+            "admin_level": None,
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "geometry_source": "user",
+            "variant": "user",
+        }
+        cache.set_correction(norm_key, name, data)
+        return data
+    finally:
+        cache.close()
 
 
 # ---------------- Gestione NDJSON/GeoJSON legacy ----------------
@@ -496,15 +759,7 @@ def phase_geocode(out_dir: str):
     ndjson_path = os.path.join(out_dir, "annale_toponimi.ndjson")
     geojson_path = os.path.join(out_dir, "annale_toponimi.geojson")
     rejects_path = os.path.join(out_dir, "annale_toponimi_osm_rejects.csv")
-    cache_path = os.path.join(out_dir, "geocache_toponyms.json")
-
-    cache = {}
-    if os.path.exists(cache_path):
-        try:
-            cache = json.load(open(cache_path, "r", encoding="utf-8"))
-        except Exception:
-            cache = {}
-
+    cache = open_geocache(out_dir)
     session = requests.Session()
     processed_keys = read_processed_keys_from_ndjson(ndjson_path)
     rejects_rows: List[Tuple[str,str,str,str,str]] = []
@@ -535,6 +790,7 @@ def phase_geocode(out_dir: str):
             if data is None:
                 rejects_rows.append((pagina, anno, pid, term, reason or "rejected"))
                 continue
+            _store_geometries(cache, fetch_geometries([data], session, out_dir))
 
             props = {
                 "pagina": pagina,
@@ -546,12 +802,14 @@ def phase_geocode(out_dir: str):
                 "type": data.get("type"),
                 "geometry_source": data.get("geometry_source"),
                 "admin_level": data.get("admin_level"),
+                "variant": data.get("variant"),
             }
             feat = make_feature_from_hit(data, props)
             ndjson_append_feature(ndjson_path, feat)
             processed_keys.add(key)
 
     session.close()
+    cache.close()
 
     if rejects_rows:
         with open(rejects_path, "w", newline="", encoding="utf-8") as rej:
@@ -605,40 +863,66 @@ def _sorted_pages_str(pages: set) -> str:
     return ",".join(str(x) for x in sorted(pages, key=_key))
 
 
-def phase_geocode_grouped(out_dir: str, progress_cb=None):
+def phase_geocode_grouped(out_dir: str, progress_cb=None, cache_path: Optional[str] = None):
     """
     Geocoding raggruppato (rispetta le esclusioni):
     - Usa il CSV attivo (filtrato se esiste, originale altrimenti)
     - Geocoda ogni toponimo una sola volta
     - Scrive annale_toponimi_grouped.geojson
     - Scrive annale_toponimi_grouped_rejects.csv
-    - Aggiorna progress_cb(done, total, current_term) durante il loop
+    - Più toponimi in parallelo entro i limiti dell'endpoint, poi i
+      poligoni dei vincitori da /lookup a blocchi; progress_cb
+      (done, total, ultimo_termine) è chiamato da questo thread
+    - Con `cache_path` legge/scrive una geocache condivisa tra più job
+      (un .json del vecchio formato viene migrato nel .sqlite accanto)
+    Ritorna {geojson, terms, features, rejects, variants} (variants: toponimi
+    risolti per variante di query, "cache" per le voci senza variante).
     """
     csv_path = choose_active_csv(out_dir)
     occ = _collect_occurrences_by_term(csv_path)
     terms = list(occ.values())
     total = len(terms)
 
-    cache_path = os.path.join(out_dir, "geocache_toponyms.json")
-    cache = {}
-    if os.path.exists(cache_path):
-        try:
-            cache = json.load(open(cache_path, "r", encoding="utf-8"))
-        except Exception:
-            cache = {}
+    cache = open_geocache(out_dir, cache_path)
+
+    # toponimi in parallelo (una sessione per thread); il callback gira
+    # solo in questo thread, i risultati tornano nell'ordine dei termini
+    _, max_inflight = endpoint_limits()
+    results: List[Optional[Tuple[Optional[dict], Optional[str]]]] = [None] * total
+    if progress_cb and total:
+        progress_cb(0, total, terms[0]["raw"])
+
+    def _one(item):
+        data, reason, _ = geocode_with_cache(item["raw"], cache, None, out_dir)
+        return data, reason
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_inflight, total)),
+                              thread_name_prefix="geocode")
+    try:
+        futures = {pool.submit(_one, item): i for i, item in enumerate(terms)}
+        for done, fut in enumerate(as_completed(futures), start=1):
+            i = futures[fut]
+            results[i] = fut.result()
+            if progress_cb:
+                progress_cb(done, total, terms[i]["raw"])
+
+        # fase 2: poligoni dei soli vincitori, a blocchi da /lookup
+        _store_geometries(cache, fetch_geometries([r[0] for r in results], None, out_dir, pool))
+    finally:
+        # su errore non aspettare i toponimi ancora in coda
+        pool.shutdown(wait=True, cancel_futures=True)
+        cache.close()
 
-    session = requests.Session()
     features = []
     rejects_rows: List[Tuple[str,str,str,str,str]] = []
+    variants: Dict[str, int] = {}
 
-    for i, item in enumerate(terms, start=1):
-        if progress_cb:
-            progress_cb(i-1, total, item["raw"])
-
-        data, reason, cache = geocode_with_cache(item["raw"], cache, session, out_dir)
+    for item, (data, reason) in zip(terms, results):
         if data is None:
             rejects_rows.append(("", "", "", item["raw"], reason or "rejected"))
             continue
+        v = data.get("variant") or "cache"
+        variants[v] = variants.get(v, 0) + 1
 
         props = {
             "pagine": _sorted_pages_str(item["pages"]),
@@ -651,12 +935,11 @@ def phase_geocode_grouped(out_dir: str, progress_cb=None):
             "type": data.get("type"),
             "geometry_source": data.get("geometry_source"),
             "admin_level": data.get("admin_level"),
+            "variant": data.get("variant"),
         }
         feat = make_feature_from_hit(data, props)
         features.append(feat)
 
-    session.close()
-
     grouped_path = os.path.join(out_dir, "annale_toponimi_grouped.geojson")
     with open(grouped_path, "w", encoding="utf-8") as f:
         json.dump(
@@ -676,3 +959,11 @@ def phase_geocode_grouped(out_dir: str, progress_cb=None):
 
     if progress_cb:
         progress_cb(total, total, None)
+
+    return {
+        "geojson": grouped_path,
+        "terms": total,
+        "features": len(features),
+        "rejects": len(rejects_rows),
+        "variants": variants,
+    }
@@ -0,0 +1,348 @@
+# processor/marking.py
+"""
+Stadio di marcatura: costruisce annale_marked.pdf (highlight + asterisco
+su ogni attestazione) a partire dai box salvati in annale_attestazioni.ndjson.
+
+È separato da phase_extract(): l'estrazione produce CSV e JSON senza
+toccare il PDF, la marcatura si può lanciare dopo (in background, al primo
+download del PDF marcato) oppure saltare del tutto se serve solo il CSV
+per il geocoding.
+
+Tre forme di output (MARK_OUTPUT o parametro `output`):
+  - "full"        annale_marked.pdf = tutto il PDF originale, marcato;
+  - "subset"      annale_marked.pdf con le sole pagine elaborate; le
+                  etichette di pagina riportano la numerazione originale;
+  - "incremental" annale_marked.overlay = solo l'aggiornamento incrementale
+                  (annotazioni) da accodare ai byte di annale.pdf; il PDF
+                  marcato si ottiene concatenando i due (iter_marked_pdf).
+Con subset e incremental tempo e spazio su disco sono proporzionali alle
+pagine elaborate, non alla dimensione del PDF.
+
+Il PDF marcato è considerato aggiornato se è più recente dell'indice
+delle attestazioni (scritto per ultimo a fine estrazione) e, se richiesta,
+ha la stessa forma di output; altrimenti viene ricostruito.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import shutil
+import logging
+import threading
+from typing import Dict, Iterator, List, Optional
+
+import fitz  # PyMuPDF
+
+from .attestations import ATTEST_INDEX_NAME, iter_attestations, iter_tagged_pages
+
+logger = logging.getLogger(__name__)
+
+MARKED_PDF_NAME = "annale_marked.pdf"
+MARKED_OVERLAY_NAME = "annale_marked.overlay"
+MARKED_META_NAME = "annale_marked.json"
+
+MARK_OUTPUTS = ("full", "subset", "incremental")
+MARK_OUTPUT = os.environ.get("MARK_OUTPUT", "full").strip().lower()
+if MARK_OUTPUT not in MARK_OUTPUTS:
+    MARK_OUTPUT = "full"
+
+# un lock per job: marcatura in background e download concorrente
+# non costruiscono lo stesso file due volte
+_locks_guard = threading.Lock()
+_locks: Dict[str, threading.Lock] = {}
+
+
+def _job_lock(out_dir: str) -> threading.Lock:
+    key = os.path.abspath(out_dir)
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = threading.Lock()
+        return lock
+
+
+def add_highlight_and_star(page: fitz.Page, rect: fitz.Rect):
+    """
+    Evidenzia nel PDF e aggiunge un asterisco accanto.
+    Manteniamo questo output visivo legacy,
+    ma in parallelo ora generiamo anche annale_tagged.ndjson
+    per una marcatura testuale più pulita.
+    """
+    try:
+        a = page.add_highlight_annot(rect)
+        a.set_colors({"stroke": (1, 1, 0), "fill": (1, 1, 0)})
+        a.update()
+    except Exception:
+        pass
+
+    try:
+        h = rect.y1 - rect.y0
+        fs = max(8, min(12, h))
+        x = rect.x1 + 1.5
+        y = rect.y0 + max(fs * 0.85, h * 0.8)
+        page.insert_text(
+            fitz.Point(x, y), "*",
+            fontsize=fs, color=(0, 0, 0), overlay=True
+        )
+    except Exception:
+        pass
+
+
+# ---------------- Stato del PDF marcato ----------------
+
+def _source_stamp(pdf_path: str) -> List[float]:
+    st = os.stat(pdf_path)
+    return [st.st_size, st.st_mtime]
+
+
+def _load_meta(out_dir: str) -> Optional[Dict]:
+    path = os.path.join(out_dir, MARKED_META_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _artifact_path(out_dir: str, output: str) -> str:
+    name = MARKED_OVERLAY_NAME if output == "incremental" else MARKED_PDF_NAME
+    return os.path.join(out_dir, name)
+
+
+def remove_marked_outputs(out_dir: str):
+    """Cancella PDF marcato / overlay di una run precedente (box non più validi)."""
+    for name in (MARKED_PDF_NAME, MARKED_OVERLAY_NAME, MARKED_META_NAME):
+        path = os.path.join(out_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def marked_pdf_is_current(out_dir: str, output: Optional[str] = None,
+                          pdf_path: Optional[str] = None) -> bool:
+    """
+    True se il PDF marcato (o l'overlay) esiste ed è più recente delle
+    attestazioni. Con `output` deve avere anche quella forma; con
+    `pdf_path` un overlay vale solo se annale.pdf non è cambiato.
+    """
+    meta = _load_meta(out_dir)
+    # job marcati prima dell'introduzione di annale_marked.json: sempre "full"
+    current_output = (meta or {}).get("output", "full")
+    if output and output != current_output:
+        return False
+    marked = _artifact_path(out_dir, current_output)
+    attest = os.path.join(out_dir, ATTEST_INDEX_NAME)
+    if not os.path.exists(marked):
+        return False
+    if current_output == "incremental" and pdf_path and os.path.exists(pdf_path):
+        if (meta or {}).get("source") != _source_stamp(pdf_path):
+            return False
+    if not os.path.exists(attest):
+        return True
+    return os.path.getmtime(marked) >= os.path.getmtime(attest)
+
+
+# ---------------- Costruzione ----------------
+
+def _annotate(doc: fitz.Document, out_dir: str,
+              page_map: Optional[Dict[int, int]] = None) -> Dict:
+    """
+    Applica highlight + asterischi a `doc` leggendo le attestazioni una alla
+    volta (sono in ordine di pagina). `page_map` = indice originale -> indice
+    in `doc` (subset); None = stesso PDF.
+    """
+    pages_marked = 0
+    n_boxes = 0
+    page = None
+    for occ in iter_attestations(out_dir):
+        idx = occ.get("pdf_page_index")
+        if idx is None:
+            continue
+        idx = int(idx) if page_map is None else page_map.get(int(idx))
+        if idx is None or not (0 <= idx < doc.page_count):
+            continue
+        if page is None or page.number != idx:
+            page = doc.load_page(idx)
+            pages_marked += 1
+        for box in occ.get("boxes") or []:
+            add_highlight_and_star(page, fitz.Rect(box))
+            n_boxes += 1
+    return {"pages_marked": pages_marked, "boxes": n_boxes}
+
+
+def _processed_pages(out_dir: str) -> List[int]:
+    """Indici 0-based delle pagine elaborate dall'estrazione, ordinati."""
+    pages = {int(p["pdf_page_index"]) for p in iter_tagged_pages(out_dir)
+             if p.get("pdf_page_index") is not None}
+    if not pages:
+        # annale_tagged.ndjson senza indici PDF: bastano le pagine con attestazioni
+        pages = {int(o["pdf_page_index"]) for o in iter_attestations(out_dir)
+                 if o.get("pdf_page_index") is not None}
+    return sorted(pages)
+
+
+def _runs(indices: List[int]) -> List[List[int]]:
+    """[3,4,5,9,10] -> [[3,5],[9,10]]"""
+    runs: List[List[int]] = []
+    for i in indices:
+        if runs and i == runs[-1][1] + 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return runs
+
+
+def _build_full(src: fitz.Document, out_dir: str, tmp: str) -> Dict:
+    stats = _annotate(src, out_dir)
+    src.save(tmp)
+    return stats
+
+
+def _build_subset(src: fitz.Document, out_dir: str, tmp: str) -> Dict:
+    """
+    Copia le sole pagine elaborate (a blocchi contigui) in un nuovo PDF e le
+    marca; le etichette di pagina rimandano alla numerazione del PDF
+    originale (o alle sue etichette, se ne ha).
+    """
+    indices = [i for i in _processed_pages(out_dir) if 0 <= i < src.page_count]
+    runs = _runs(indices)
+    sub = fitz.open()
+    try:
+        for a, b in runs:
+            sub.insert_pdf(src, from_page=a, to_page=b, annots=False)
+        page_map = {orig: new for new, orig in enumerate(indices)}
+
+        if src.get_page_labels():
+            # etichette originali arbitrarie: una regola per pagina
+            labels = [{"startpage": new, "prefix": src[orig].get_label(),
+                       "style": "", "firstpagenum": 1}
+                      for orig, new in page_map.items()]
+        else:
+            labels, start = [], 0
+            for a, b in runs:
+                labels.append({"startpage": start, "prefix": "", "style": "D",
+                               "firstpagenum": a + 1})
+                start += b - a + 1
+        if labels:
+            sub.set_page_labels(labels)
+
+        stats = _annotate(sub, out_dir, page_map)
+        sub.save(tmp, garbage=1, deflate=True)
+    finally:
+        sub.close()
+    stats["pages"] = len(indices)
+    return stats
+
+
+def _build_overlay(pdf_path: str, out_dir: str, tmp: str) -> Optional[Dict]:
+    """
+    Salvataggio incrementale su una copia di annale.pdf; dell'output teniamo
+    solo i byte accodati (l'aggiornamento con le annotazioni). None se il
+    PDF non si può aggiornare in modo incrementale (es. riparato all'apertura).
+    """
+    work = tmp + ".pdf"
+    shutil.copyfile(pdf_path, work)
+    try:
+        doc = fitz.open(work)
+        try:
+            if not doc.can_save_incrementally():
+                return None
+            stats = _annotate(doc, out_dir)
+            doc.save(work, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        finally:
+            doc.close()
+        base_size = os.path.getsize(pdf_path)
+        with open(work, "rb") as fin, open(tmp, "wb") as fout:
+            fin.seek(base_size)
+            shutil.copyfileobj(fin, fout)
+    finally:
+        if os.path.exists(work):
+            os.remove(work)
+    return stats
+
+
+def phase_mark(pdf_path: str, out_dir: str, output: str = MARK_OUTPUT) -> Dict:
+    """
+    Costruisce il PDF marcato nella forma `output` (full | subset | incremental)
+    dalle attestazioni in annale_attestazioni.ndjson.
+    Il file viene scritto in modo atomico (tmp + rename), quindi chi lo
+    scarica durante la marcatura non vede mai un PDF a metà.
+    Se il PDF non supporta il salvataggio incrementale si ripiega su "full".
+    """
+    if output not in MARK_OUTPUTS:
+        raise ValueError(f"output di marcatura non valido: {output}")
+    if not os.path.exists(os.path.join(out_dir, ATTEST_INDEX_NAME)):
+        raise FileNotFoundError(f"Attestazioni non trovate in {out_dir}")
+    if not os.path.exists(pdf_path):
+        raise FileNotFoundError(f"PDF non trovato: {pdf_path}")
+
+    stats = None
+    if output == "incremental":
+        tmp = _artifact_path(out_dir, output) + ".tmp"
+        stats = _build_overlay(pdf_path, out_dir, tmp)
+        if stats is None:
+            logger.warning("Salvataggio incrementale non possibile per %s: uso output full",
+                           pdf_path)
+            output = "full"
+    if stats is None:
+        tmp = _artifact_path(out_dir, output) + ".tmp"
+        src = fitz.open(pdf_path)
+        try:
+            if output == "subset":
+                stats = _build_subset(src, out_dir, tmp)
+            else:
+                stats = _build_full(src, out_dir, tmp)
+        finally:
+            src.close()
+
+    out_path = _artifact_path(out_dir, output)
+    remove_marked_outputs(out_dir)
+    os.replace(tmp, out_path)
+
+    meta_path = os.path.join(out_dir, MARKED_META_NAME)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"output": output, "source": _source_stamp(pdf_path)}, f)
+    os.replace(meta_path + ".tmp", meta_path)
+
+    return {"pdf": out_path, "output": output,
+            "bytes": os.path.getsize(out_path), **stats}
+
+
+def ensure_marked_pdf(pdf_path: str, out_dir: str,
+                      output: Optional[str] = None) -> Optional[str]:
+    """
+    Ritorna il path del PDF marcato (annale_marked.pdf, oppure
+    annale_marked.overlay per l'output incrementale: vedi iter_marked_pdf),
+    costruendolo se manca, non è aggiornato o ha una forma diversa da
+    `output` (None = va bene quella esistente, altrimenti MARK_OUTPUT).
+    Se un'altra richiesta lo sta già costruendo, aspetta quella.
+    None se non ci sono ancora attestazioni (estrazione mai eseguita).
+    """
+    with _job_lock(out_dir):
+        if marked_pdf_is_current(out_dir, output, pdf_path):
+            return _artifact_path(out_dir, (_load_meta(out_dir) or {}).get("output", "full"))
+        if not os.path.exists(os.path.join(out_dir, ATTEST_INDEX_NAME)):
+            return None
+        return phase_mark(pdf_path, out_dir, output or MARK_OUTPUT)["pdf"]
+
+
+def iter_marked_pdf(pdf_path: str, out_dir: str,
+                    chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """
+    Byte del PDF marcato, per lo streaming HTTP: con l'output incrementale
+    sono annale.pdf seguito dall'overlay, altrimenti annale_marked.pdf.
+    """
+    meta = _load_meta(out_dir) or {}
+    if meta.get("output") == "incremental":
+        parts = [pdf_path, os.path.join(out_dir, MARKED_OVERLAY_NAME)]
+    else:
+        parts = [os.path.join(out_dir, MARKED_PDF_NAME)]
+    for path in parts:
+        with open(path, "rb") as f:
+            while True:
+                buf = f.read(chunk_size)
+                if not buf:
+                    break
+                yield buf
@@ -0,0 +1,166 @@
+# processor/models.py
+"""
+Registro process-wide dei modelli spaCy.
+
+Prima ogni chiamata a phase_extract() ricaricava il modello italiano
+(diversi secondi e centinaia di MB per it_core_news_lg). Ora il modello
+viene caricato UNA volta per processo e riusato da tutte le estrazioni:
+
+- get_nlp()
+    Ritorna il modello "caldo", caricandolo al primo uso. Thread-safe:
+    se un preload è in corso, la chiamata aspetta quello invece di
+    caricare una seconda copia.
+
+- preload_async()
+    Avvia il caricamento in un thread daemon (usato da server.py all'avvio).
+
+- model_status()
+    Stato del registro (idle | loading | ready | error), nome del modello
+    e tempo di caricamento in secondi, per l'endpoint /api/model_status.
+
+- get_nlp_variant()
+    Modelli dei profili di estrazione (profiles.py): altri candidati e/o
+    componenti disattivati/attivati. Uno per combinazione, anche questi
+    caricati una volta sola per processo.
+"""
+
+from __future__ import annotations
+
+import time
+import logging
+import threading
+from typing import Dict, Any, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+SPACY_MODEL_CANDIDATES = ("it_core_news_lg", "it_core_news_md", "it_core_news_sm")
+
+_lock = threading.Lock()
+_nlp = None
+_status: Dict[str, Any] = {
+    "status": "idle",        # idle | loading | ready | error
+    "model": None,
+    "load_seconds": None,
+    "error": None,
+}
+# varianti dei profili: (candidati, disable, enable) -> (nlp, nome_modello)
+_variants: Dict[Tuple, Tuple[Any, str]] = {}
+# componenti che impostano i confini di frase (servono a deep_context)
+_SENT_FACTORIES = {"parser", "senter", "sentencizer"}
+
+
+def _load_first_available(candidates=SPACY_MODEL_CANDIDATES) -> Tuple[Any, str]:
+    """
+    Carica il primo modello spaCy disponibile tra `candidates`.
+    Ritorna (nlp, nome_modello).
+    """
+    try:
+        import spacy
+    except Exception:
+        raise RuntimeError(
+            "spaCy assente. Installa con: pip install spacy; "
+            "python -m spacy download it_core_news_sm"
+        )
+
+    for model in candidates:
+        try:
+            return spacy.load(model), model
+        except Exception:
+            continue
+    raise RuntimeError(
+        "Nessun modello it_core_news_* trovato. "
+        "Esegui: python -m spacy download it_core_news_sm"
+    )
+
+
+def get_nlp():
+    """
+    Ritorna il modello spaCy condiviso, caricandolo se necessario.
+    """
+    global _nlp
+    if _nlp is not None:
+        return _nlp
+
+    with _lock:
+        if _nlp is not None:
+            return _nlp
+        _status.update({"status": "loading", "error": None})
+        t0 = time.perf_counter()
+        try:
+            nlp, name = _load_first_available()
+        except Exception as e:
+            _status.update({"status": "error", "error": f"{type(e).__name__}: {e}"})
+            raise
+        elapsed = time.perf_counter() - t0
+        _status.update({
+            "status": "ready",
+            "model": name,
+            "load_seconds": round(elapsed, 3),
+        })
+        logger.info("Modello spaCy %s caricato in %.2fs", name, elapsed)
+        _nlp = nlp
+        return _nlp
+
+
+def _configure_components(nlp, disable: Sequence[str], enable: Sequence[str]):
+    """
+    Disattiva/attiva componenti (quelli che il modello non ha vengono
+    ignorati). Se nessun componente rimasto dà i confini di frase (parser
+    disattivato e senter assente) aggiunge un sentencizer.
+    """
+    for name in disable:
+        if name in nlp.pipe_names:
+            nlp.disable_pipe(name)
+    for name in enable:
+        if name in nlp.disabled:
+            nlp.enable_pipe(name)
+    if not any(nlp.get_pipe_meta(n).factory in _SENT_FACTORIES for n in nlp.pipe_names):
+        nlp.add_pipe("sentencizer", first=True)
+
+
+def get_nlp_variant(candidates: Sequence[str], disable: Sequence[str] = (),
+                    enable: Sequence[str] = ()) -> Tuple[Any, str]:
+    """
+    (nlp, nome_modello) per un profilo: primo modello disponibile tra
+    `candidates`, con i componenti `disable` spenti e `enable` accesi
+    (es. "senter" al posto del parser). Stessa combinazione = stesso oggetto.
+    """
+    key = (tuple(candidates), tuple(sorted(disable)), tuple(sorted(enable)))
+    hit = _variants.get(key)
+    if hit is not None:
+        return hit
+    with _lock:
+        hit = _variants.get(key)
+        if hit is not None:
+            return hit
+        t0 = time.perf_counter()
+        nlp, name = _load_first_available(tuple(candidates))
+        _configure_components(nlp, disable, enable)
+        logger.info("Modello spaCy %s (disable=%s, enable=%s) caricato in %.2fs",
+                    name, list(disable), list(enable), time.perf_counter() - t0)
+        _variants[key] = (nlp, name)
+        return nlp, name
+
+
+def preload_async() -> Optional[threading.Thread]:
+    """
+    Carica il modello in background. Ritorna il thread avviato
+    (None se il modello è già pronto).
+    """
+    if _nlp is not None:
+        return None
+
+    def _run():
+        try:
+            get_nlp()
+        except Exception as e:
+            logger.warning("Preload spaCy fallito: %s", e)
+
+    t = threading.Thread(target=_run, name="spacy-preload", daemon=True)
+    t.start()
+    return t
+
+
+def model_status() -> Dict[str, Any]:
+    """Copia dello stato corrente del registro."""
+    return dict(_status)
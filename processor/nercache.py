@@ -0,0 +1,237 @@
+# processor/nercache.py
+"""
+Cache NER condivisa tra i job, indirizzata per contenuto.
+
+Lo stesso annale (o volumi che si sovrappongono) viene ricaricato in job
+diversi: la cache per pagina (pagecache.py) vive nella cartella del job,
+questa invece è unica per tutto il server. La chiave è lo sha256 di:
+  - testo del corpo pagina così come va a spaCy (già normalizzato da
+    text_for_nlp: sillabazioni unite),
+  - firma del modello: lingua, nome e versione del pacchetto, versione di
+    spaCy e hash della config,
+  - componenti eseguiti (pipeline completa o solo NER, vedi context_mode).
+
+Valore = il Doc analizzato serializzato con DocBin (token, POS, lemmi,
+dipendenze, frasi, entità): un hit salta tutta la pipeline spaCy e le
+euristiche di contesto lavorano sul Doc ricostruito come su quello appena
+calcolato.
+
+Stato in NER_CACHE_DIR/<2 caratteri>/<chiave>.spacy (default
+cache/ner: fuori da workspace/, che il server espone per job). Dimensione massima NER_CACHE_MAX_MB: oltre la
+soglia si eliminano i file usati meno di recente (LRU sul mtime, che
+viene aggiornato a ogni hit). NER_CACHE=0 disattiva la cache.
+"""
+
+from __future__ import annotations
+
+import os
+import hashlib
+import logging
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+NER_CACHE = os.environ.get("NER_CACHE", "1").strip().lower() in {"1", "true", "yes"}
+NER_CACHE_DIR = os.path.abspath(
+    os.environ.get("NER_CACHE_DIR") or os.path.join("cache", "ner")
+)
+NER_CACHE_MAX_MB = int(os.environ.get("NER_CACHE_MAX_MB", "512"))
+# dopo un'eviction la cache scende a questa frazione del massimo
+_EVICT_TO = 0.9
+# componenti che annotano il Doc senza cambiare l'analisi (filtro di
+# contesto, component.py): fuori dalla chiave, come se non ci fossero
+ANNOTATION_PIPES = ("toponym_context_filter",)
+
+
+def model_signature(nlp) -> str:
+    """Firma del modello per la chiave: cambia se cambia modello, versione o config."""
+    sig = getattr(nlp, "_ner_cache_signature", None)
+    if sig is None:
+        import spacy
+        meta = nlp.meta or {}
+        config = nlp.config.copy()
+        config["nlp"]["pipeline"] = [n for n in config["nlp"]["pipeline"]
+                                     if n not in ANNOTATION_PIPES]
+        for name in ANNOTATION_PIPES:
+            config["components"].pop(name, None)
+        config_hash = hashlib.sha256(config.to_str().encode("utf-8")).hexdigest()[:16]
+        sig = (f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}"
+               f"|spacy-{spacy.__version__}|{config_hash}")
+        try:
+            nlp._ner_cache_signature = sig
+        except Exception:
+            pass
+    return sig
+
+
+class NerCache:
+    """Cache su disco: un DocBin per testo, scritto in modo atomico."""
+
+    def __init__(self, root: str = NER_CACHE_DIR, max_mb: int = NER_CACHE_MAX_MB):
+        self.root = root
+        self.max_bytes = max(0, max_mb) * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._size: Optional[int] = None   # byte su disco (stima, ricalcolata all'eviction)
+        self._lock = threading.Lock()
+
+    def key(self, text: str, signature: str, pipes: Iterable[str]) -> str:
+        h = hashlib.sha256()
+        h.update(f"{signature}|{','.join(pipes)}|".encode("utf-8"))
+        h.update(text.encode("utf-8"))
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".spacy")
+
+    def get(self, key: str, vocab):
+        """Doc ricostruito dalla cache, o None."""
+        from spacy.tokens import DocBin
+
+        p = self._path(key)
+        try:
+            with open(p, "rb") as f:
+                data = f.read()
+            doc = next(DocBin().from_bytes(data).get_docs(vocab))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Voce cache NER illeggibile (%s): %s", key[:12], e)
+            return None
+        try:
+            os.utime(p)  # LRU: ultimo uso
+        except OSError:
+            pass
+        return doc
+
+    def put(self, key: str, doc):
+        from spacy.tokens import DocBin
+
+        p = self._path(key)
+        tmp = f"{p}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            data = DocBin(store_user_data=False, docs=[doc]).to_bytes()
+            os.makedirs(os.path.dirname(p), exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, p)
+        except Exception as e:
+            logger.warning("Voce cache NER non scritta (%s): %s", key[:12], e)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_size()
+            else:
+                self._size += len(data)
+            over = self.max_bytes and self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _entries(self) -> List[os.DirEntry]:
+        out = []
+        if not os.path.isdir(self.root):
+            return out
+        for sub in os.scandir(self.root):
+            if sub.is_dir():
+                out.extend(e for e in os.scandir(sub.path) if e.name.endswith(".spacy"))
+        return out
+
+    def _disk_size(self) -> int:
+        total = 0
+        for e in self._entries():
+            try:
+                total += e.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def evict(self):
+        """Elimina i file meno usati finché la cache non scende sotto il massimo."""
+        with self._lock:
+            entries = []
+            for e in self._entries():
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+            total = sum(size for _, size, _ in entries)
+            target = int(self.max_bytes * _EVICT_TO)
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue   # già eliminato da un altro processo
+                total -= size
+                removed += 1
+            self._size = total
+        if removed:
+            logger.info("Cache NER: eliminate %d voci (LRU), %.1f MB", removed, total / 1e6)
+
+    def pipe(self, nlp, texts: Iterable[str], batch_size: int,
+             disable: Optional[List[str]] = None, n_process: int = 1) -> Iterator:
+        """
+        Come nlp.pipe(texts, batch_size, disable, n_process): i Doc già in
+        cache vengono ricostruiti, gli altri calcolati a batch e salvati.
+        Ordine di uscita = ordine dei testi.
+        """
+        disable = list(disable or [])
+        signature = model_signature(nlp)
+        pipes = [n for n in nlp.pipe_names if n not in disable and n not in ANNOTATION_PIPES]
+        n_process = max(1, int(n_process))
+        texts = iter(texts)
+        while True:
+            chunk = [t for _, t in zip(range(batch_size * n_process), texts)]
+            if not chunk:
+                break
+            keys = [self.key(t, signature, pipes) for t in chunk]
+            docs: Dict[int, object] = {}
+            for i, k in enumerate(keys):
+                doc = self.get(k, nlp.vocab)
+                if doc is not None:
+                    docs[i] = doc
+            self.hits += len(docs)
+            todo = [i for i in range(len(chunk)) if i not in docs]
+            self.misses += len(todo)
+            if todo:
+                procs = n_process if len(todo) > batch_size else 1
+                for i, doc in zip(todo, nlp.pipe([chunk[i] for i in todo], batch_size=batch_size,
+                                                 disable=disable, n_process=procs)):
+                    self.put(keys[i], doc)
+                    docs[i] = doc
+            for i in range(len(chunk)):
+                yield docs[i]
+
+
+# ---------------- Registro di processo ----------------
+
+_cache: Optional[NerCache] = None
+_cache_guard = threading.Lock()
+
+
+def get_ner_cache() -> Optional[NerCache]:
+    """Cache condivisa del processo (None se NER_CACHE=0)."""
+    global _cache
+    if not NER_CACHE:
+        return None
+    with _cache_guard:
+        if _cache is None:
+            _cache = NerCache()
+        return _cache
+
+
+def ner_pipe(nlp, texts: Iterable[str], batch_size: int,
+             disable: Optional[List[str]] = None,
+             use_cache: bool = True, n_process: int = 1) -> Iterator:
+    """nlp.pipe passando dalla cache condivisa, se attiva (e use_cache)."""
+    cache = get_ner_cache() if use_cache else None
+    if cache is None:
+        return nlp.pipe(texts, batch_size=batch_size, disable=disable or [],
+                        n_process=max(1, int(n_process)))
+    return cache.pipe(nlp, texts, batch_size, disable, n_process)
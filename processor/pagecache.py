@@ -0,0 +1,71 @@
+# processor/pagecache.py
+"""
+Cache per pagina dei risultati di estrazione, indirizzata per contenuto.
+
+Chiave = sha256 di:
+  - contenuto della pagina (content stream decompresso + geometria),
+  - indice della pagina nel PDF (serve per il fallback del numero pagina),
+  - nome del modello spaCy,
+  - versione delle euristiche (HEURISTICS_VERSION in extract.py).
+
+Valore = il risultato di analyze_page() per quella pagina (candidati,
+esclusi, box, snippet). Rilanciare /api/extract con un range più ampio
+(es. prima 51-104, poi 51-104,115-136) o sullo stesso PDF calcola solo
+le pagine che non sono ancora in cache.
+
+Stato in <job_dir>/extract_cache/<2 caratteri>/<chiave>.json
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, Optional
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+PAGE_CACHE_DIRNAME = "extract_cache"
+
+
+def page_content_key(page: fitz.Page, model: Optional[str], heuristics_version: str) -> str:
+    """Chiave di cache della pagina (hex sha256)."""
+    h = hashlib.sha256()
+    h.update(f"{heuristics_version}|{model}|{page.number}|".encode("utf-8"))
+    h.update(repr((tuple(page.rect), page.rotation)).encode("utf-8"))
+    h.update(page.read_contents() or b"")
+    return h.hexdigest()
+
+
+class PageCache:
+    """Cache su disco: un file JSON per pagina, scritto in modo atomico."""
+
+    def __init__(self, out_dir: str):
+        self.dir = os.path.join(out_dir, PAGE_CACHE_DIRNAME)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dir, key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[Dict]:
+        p = self._path(key)
+        if not os.path.exists(p):
+            return None
+        try:
+            with open(p, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def put(self, key: str, res: Dict):
+        p = self._path(key)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        tmp = p + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(res, f, ensure_ascii=False)
+            os.replace(tmp, p)
+        except Exception as e:
+            logger.warning("Cache pagina non scritta (%s): %s", key[:12], e)
@@ -0,0 +1,210 @@
+# processor/pagetext.py
+"""
+Strutture testuali per pagina, costruite UNA volta per pagina e riusate
+da tutti i candidati toponimi.
+
+- PageTextLayer
+    Un solo TextPage PyMuPDF per pagina: parole, blocchi e testo di
+    qualsiasi area (footer, fascia alta, corpo) vengono ricavati dalla
+    stessa struttura in memoria invece di far rianalizzare la pagina a
+    PyMuPDF per ogni get_text(clip=...).
+
+- PageWordIndex
+    Parole della pagina che cadono nel corpo (body_rect), con bbox e forma
+    normalizzata (solo caratteri alfanumerici, minuscolo) calcolata una volta.
+
+- TermMatcher
+    Trie sui termini normalizzati: trova i box di TUTTI i candidati della
+    pagina con un solo passaggio sulle parole (finestre fino a MAX_WIN
+    parole consecutive, es. "Reggio" + "Emilia" o "Reg-" + "gio").
+    Stessa semantica del vecchio confronto termine-per-termine: per ogni
+    termine le occorrenze sono scelte in modo greedy da sinistra, a parità
+    di inizio vince la finestra più corta, senza sovrapposizioni.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import List, Dict, Iterable, Optional
+
+import fitz  # PyMuPDF
+
+MAX_WIN = 4
+
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def norm_token(s: str) -> str:
+    """Forma usata per il match: niente punteggiatura/spazi, minuscolo."""
+    return _NON_WORD.sub("", s).lower()
+
+
+def union_rect(rects: List[fitz.Rect]) -> Optional[fitz.Rect]:
+    """Restituisce il bounding box unificato di più rettangoli."""
+    if not rects:
+        return None
+    r = fitz.Rect(rects[0])
+    for rr in rects[1:]:
+        r |= rr
+    return r
+
+
+class PageTextLayer:
+    """
+    Strato testuale di una pagina, analizzato una volta sola.
+
+    Con textpage=... PyMuPDF ignora il parametro clip, quindi il testo di
+    un'area lo ricomponiamo dai caratteri (rawdict): un carattere appartiene
+    all'area se il centro del suo bbox vi cade dentro. MuPDF usa il contorno
+    del glifo, quindi su caratteri tagliati a metà dal bordo il risultato
+    può differire di qualche carattere; per le aree usate nell'estrazione
+    (footer, fascia alta, corpo) le righe sono intere dentro o fuori.
+    """
+
+    def __init__(self, page: fitz.Page):
+        self.page = page
+        self.textpage = page.get_textpage(flags=fitz.TEXTFLAGS_TEXT)
+        self._words = None
+        self._blocks = None
+        self._lines = None
+        self._chars = None
+
+    def words(self) -> list:
+        """Come page.get_text("words")."""
+        if self._words is None:
+            self._words = self.page.get_text("words", textpage=self.textpage)
+        return self._words
+
+    def blocks(self) -> list:
+        """Come page.get_text("blocks", sort=True)."""
+        if self._blocks is None:
+            self._blocks = self.page.get_text("blocks", sort=True, textpage=self.textpage)
+        return self._blocks
+
+    def _line_index(self) -> list:
+        """
+        [(bbox_riga, testo_riga), ...] nell'ordine di lettura di MuPDF
+        (da extractDICT: testo per span, senza dettaglio carattere).
+        """
+        if self._lines is None:
+            lines = []
+            for block in self.textpage.extractDICT().get("blocks", []):
+                if block.get("type") != 0:
+                    continue
+                for line in block.get("lines", []):
+                    text = "".join(span.get("text", "") for span in line.get("spans", []))
+                    if text:
+                        lines.append((fitz.Rect(line["bbox"]), text))
+            self._lines = lines
+        return self._lines
+
+    def _line_chars(self) -> list:
+        """
+        Per ogni riga di _line_index(): [(carattere, cx, cy), ...].
+        Serve solo per le righe tagliate dal bordo di un'area, quindi
+        il rawdict viene chiesto a PyMuPDF solo alla prima occorrenza.
+        """
+        if self._chars is None:
+            chars_by_line = []
+            for block in self.textpage.extractRAWDICT().get("blocks", []):
+                if block.get("type") != 0:
+                    continue
+                for line in block.get("lines", []):
+                    chars = []
+                    for span in line.get("spans", []):
+                        for ch in span.get("chars", []):
+                            x0, y0, x1, y1 = ch["bbox"]
+                            chars.append((ch["c"], (x0 + x1) / 2, (y0 + y1) / 2))
+                    if chars:
+                        chars_by_line.append(chars)
+            self._chars = chars_by_line
+        return self._chars
+
+    def clip_text(self, rect: fitz.Rect) -> str:
+        """Come page.get_text("text", clip=rect): righe terminate da newline."""
+        out = []
+        for i, (bbox, text) in enumerate(self._line_index()):
+            if rect.contains(bbox):
+                out.append(text + "\n")
+            elif bbox.intersects(rect):
+                part = "".join(
+                    c for c, cx, cy in self._line_chars()[i]
+                    if rect.x0 <= cx <= rect.x1 and rect.y0 <= cy <= rect.y1
+                )
+                if part:
+                    out.append(part + "\n")
+        return "".join(out)
+
+
+class PageWordIndex:
+    """
+    Parole del corpo pagina, nell'ordine di PyMuPDF.
+    `words` è l'output di page.get_text("words") (tuple x0,y0,x1,y1,testo,...).
+    """
+
+    def __init__(self, words: Iterable, body_rect: fitz.Rect):
+        self.rects: List[fitz.Rect] = []
+        self.norms: List[str] = []
+        for w in words:
+            rect = fitz.Rect(w[0], w[1], w[2], w[3])
+            inter = rect & body_rect
+            if inter.get_area() > 0.5 * rect.get_area():
+                self.rects.append(rect)
+                self.norms.append(norm_token(w[4]))
+
+    @classmethod
+    def from_page(cls, page: fitz.Page, body_rect: fitz.Rect,
+                  layer: Optional[PageTextLayer] = None) -> "PageWordIndex":
+        words = layer.words() if layer is not None else page.get_text("words")
+        return cls(words, body_rect)
+
+    def __len__(self) -> int:
+        return len(self.norms)
+
+
+class TermMatcher:
+    """
+    Trie a caratteri sui termini normalizzati. Le chiavi None dei nodi
+    contengono i termini (forma originale) che terminano in quel punto.
+    """
+
+    def __init__(self, terms: Iterable[str]):
+        self.terms: List[str] = []
+        self._root: Dict = {}
+        seen = set()
+        for term in terms:
+            if term in seen:
+                continue
+            seen.add(term)
+            self.terms.append(term)
+            node = self._root
+            for ch in norm_token(term):
+                node = node.setdefault(ch, {})
+            node.setdefault(None, []).append(term)
+
+    def find(self, index: PageWordIndex) -> Dict[str, List[fitz.Rect]]:
+        """
+        Ritorna {termine: [rect per occorrenza, ...]} per tutti i termini,
+        con un solo passaggio sulle parole dell'indice.
+        """
+        hits: Dict[str, List[fitz.Rect]] = {t: [] for t in self.terms}
+        next_free: Dict[str, int] = {t: 0 for t in self.terms}
+        norms = index.norms
+        n = len(norms)
+
+        for i in range(n):
+            node = self._root
+            for win in range(1, min(MAX_WIN, n - i) + 1):
+                for ch in norms[i + win - 1]:
+                    node = node.get(ch)
+                    if node is None:
+                        break
+                if node is None:
+                    break
+                for term in node.get(None, ()):
+                    # match solo se la posizione non è coperta da un match
+                    # precedente dello stesso termine (o da una finestra più corta)
+                    if next_free[term] <= i:
+                        hits[term].append(union_rect(index.rects[i:i + win]))
+                        next_free[term] = i + win
+        return hits
@@ -0,0 +1,95 @@
+# processor/prescan.py
+"""
+Pre-scansione economica delle pagine, prima di corpo/testo/NER.
+
+Negli annali scansionati ci sono tavole, versi bianchi e pagine solo
+immagine: farle passare da compute_body_rect, PageTextLayer e nlp() costa
+come una pagina vera e non produce toponimi. PagePrescan le riconosce con
+controlli che non richiedono l'analisi completa della pagina:
+
+  - "no_text_layer"     nessun operatore di testo nel content stream (e
+                        nessun Form XObject che possa contenerne), oppure
+                        nessun carattere estratto;
+  - "near_empty"        meno di PAGE_MIN_CHARS caratteri non bianchi su
+                        tutta la pagina (verso bianco con il solo numero);
+  - "duplicate_page:N"  stesso testo (spazi normalizzati) della pagina N
+                        del PDF, la prima con quel testo tra le incluse.
+
+La classificazione avviene nello stadio di scansione (extract_pages),
+sullo stesso TextPage che poi usa scan_page: le pagine normali non
+vengono lette due volte. Hash e numero di caratteri finiscono nel
+risultato di ogni pagina ("text_hash", "text_chars"), così le pagine
+riprese da checkpoint o cache contano per i duplicati senza rileggerle.
+Per i duplicati vale la pagina di indice più basso con lo stesso testo:
+phase_extract riapplica reason() a tutte le pagine incluse, in ordine,
+e il risultato non dipende da worker, checkpoint o cache.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import hashlib
+from typing import Dict, Optional, Tuple
+
+import fitz  # PyMuPDF
+
+# PAGE_SKIP=0 disattiva la pre-scansione (tutte le pagine vanno alla NER)
+PAGE_SKIP = os.environ.get("PAGE_SKIP", "1").strip().lower() in {"1", "true", "yes"}
+# sotto questa soglia di caratteri non bianchi la pagina è "quasi vuota"
+PAGE_MIN_CHARS = int(os.environ.get("PAGE_MIN_CHARS", "30"))
+
+_WS = re.compile(r"\s+")
+
+
+def has_text_operators(page: fitz.Page) -> bool:
+    """
+    False solo se la pagina non può contenere testo: nessun BT nel content
+    stream e nessun Form XObject (che potrebbe disegnarne).
+    """
+    if b"BT" in (page.read_contents() or b""):
+        return True
+    return bool(page.get_xobjects())
+
+
+def page_text_key(page: fitz.Page, textpage=None) -> Tuple[str, int]:
+    """
+    (sha1 del testo della pagina a spazi normalizzati, caratteri non bianchi).
+    Con `textpage` (es. PageTextLayer.textpage) la pagina non viene rianalizzata.
+    """
+    text = page.get_text("text", flags=fitz.TEXTFLAGS_TEXT, textpage=textpage)
+    flat = _WS.sub(" ", text).strip()
+    return hashlib.sha1(flat.encode("utf-8")).hexdigest(), len(flat) - flat.count(" ")
+
+
+class PagePrescan:
+    """
+    Motivi per saltare le pagine; ricorda, per ogni testo già visto, la
+    pagina di indice più basso (l'ordine delle chiamate è irrilevante).
+    """
+
+    def __init__(self, min_chars: int = PAGE_MIN_CHARS):
+        self.min_chars = min_chars
+        self._seen: Dict[str, int] = {}  # hash testo -> indice 0-based più basso
+        self.counts: Dict[str, int] = {}
+
+    def reason(self, idx: int, text_hash: Optional[str], text_chars: int) -> Optional[str]:
+        """Motivo per saltare la pagina `idx` (0-based) dato il suo testo, o None."""
+        if not text_chars:
+            return "no_text_layer"
+        if text_chars < self.min_chars:
+            return "near_empty"
+        first = self._seen.get(text_hash)
+        if first is None or idx < first:
+            self._seen[text_hash] = first = idx
+        if first < idx:
+            return f"duplicate_page:{first + 1}"
+        return None
+
+    def count(self, reason: str):
+        kind = reason.split(":", 1)[0]
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    @property
+    def skipped(self) -> int:
+        return sum(self.counts.values())
@@ -0,0 +1,93 @@
+# processor/profiles.py
+"""
+Profili di estrazione: compromessi velocità/accuratezza con un nome.
+
+Un profilo fissa il modello spaCy (candidati in ordine di preferenza), i
+componenti da spegnere/accendere, batch_size, worker e context_mode:
+
+  fast      it_core_news_sm, senter al posto del parser, senza
+            lemmatizer (i verbi di luogo si riconoscono dalla forma),
+            analisi "lazy", batch grandi e più processi;
+  balanced  md (o sm) completo, analisi "lazy";
+  accurate  lg (o md, sm) completo, pipeline completa su ogni pagina
+            (context_mode="full"): il comportamento storico.
+
+Senza profilo phase_extract() usa il modello di get_nlp() e i default
+NLP_BATCH_SIZE / EXTRACT_WORKERS / CONTEXT_MODE come sempre.
+EXTRACT_PROFILE imposta il profilo di default; nelle richieste a
+/api/extract i parametri espliciti (batch_size, workers, context_mode)
+prevalgono su quelli del profilo.
+
+Misura dei profili su un campione annotato:
+    python -m processor.bench profiles annale.pdf campione.csv --ranges 51-60
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from .models import get_nlp_variant
+
+_CPUS = os.cpu_count() or 1
+
+EXTRACT_PROFILES: Dict[str, Dict[str, Any]] = {
+    "fast": {
+        "models": ("it_core_news_sm",),
+        "disable": ("parser", "lemmatizer"),
+        "enable": ("senter",),
+        "batch_size": 64,
+        "workers": max(1, min(4, _CPUS)),
+        "context_mode": "lazy",
+    },
+    "balanced": {
+        "models": ("it_core_news_md", "it_core_news_sm"),
+        "disable": (),
+        "enable": (),
+        "batch_size": 32,
+        "workers": max(1, min(2, _CPUS)),
+        "context_mode": "lazy",
+    },
+    "accurate": {
+        "models": ("it_core_news_lg", "it_core_news_md", "it_core_news_sm"),
+        "disable": (),
+        "enable": (),
+        "batch_size": 16,
+        "workers": 1,
+        "context_mode": "full",
+    },
+}
+
+# profilo di default ("" = nessun profilo, comportamento storico)
+EXTRACT_PROFILE = os.environ.get("EXTRACT_PROFILE", "").strip().lower()
+if EXTRACT_PROFILE not in EXTRACT_PROFILES:
+    EXTRACT_PROFILE = ""
+
+
+def get_profile(name: str) -> Dict[str, Any]:
+    """Impostazioni del profilo `name` (ValueError se non esiste)."""
+    try:
+        return EXTRACT_PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"profilo non valido: {name} (disponibili: {', '.join(EXTRACT_PROFILES)})"
+        ) from None
+
+
+def profile_nlp(name: str) -> Tuple[Any, str]:
+    """
+    (nlp, chiave_modello) del profilo. La chiave (modello + profilo) entra
+    nelle chiavi di checkpoint e cache per pagina: profili diversi non
+    condividono risultati.
+    """
+    prof = get_profile(name)
+    nlp, model = get_nlp_variant(prof["models"], prof["disable"], prof["enable"])
+    return nlp, f"{model}+{name}"
+
+
+def describe_profiles() -> Dict[str, Dict[str, Any]]:
+    """Profili in forma serializzabile (per /api/model_status)."""
+    return {
+        name: {k: (list(v) if isinstance(v, tuple) else v) for k, v in prof.items()}
+        for name, prof in EXTRACT_PROFILES.items()
+    }
@@ -0,0 +1,263 @@
+# processor/refilter.py
+"""
+Re-filtro: riapplica le euristiche di contesto ai Doc dell'ultima
+estrazione (extract_docs/, vedi docstore.py) senza rileggere il PDF e
+senza rifare la NER.
+
+Serve a vedere subito l'effetto di una modifica a ALWAYS_ALLOW,
+COMMON_FIRST_NAMES, PERSON_TITLES, ...: phase_refilter() rigenera
+annale_toponimi.csv e annale_toponimi_esclusi.csv (e, per coerenza,
+attestazioni, tagged e indice) in pochi secondi.
+
+Limiti:
+- i box dei toponimi vengono dalle attestazioni precedenti; per un termine
+  che il nuovo filtro accetta per la prima volta su una pagina si apre il
+  PDF (se `pdf_path` è dato) e si localizzano solo quelli, altrimenti il
+  termine resta senza box (niente highlight nel PDF marcato);
+- per le pagine estratte con context_mode="lazy" il Doc salvato è solo
+  NER: le entità da risolvere sulla frase passano di nuovo dalla pipeline
+  completa del profilo dell'estrazione (user_data["profile"]), ma solo
+  sulle finestre di contesto (di solito già nella cache NER condivisa);
+- pagine senza Doc salvato (estratte prima di questa funzione) tengono
+  i candidati dell'estrazione originale.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import logging
+from typing import Dict, Iterator, List, Optional
+
+from .utils import ordered_unique
+from .attestations import ATTEST_NDJSON_NAME, TAGGED_NDJSON_NAME, ATTEST_INDEX_NAME
+from .docstore import DocStore
+from .rules import ContextRules, DEFAULT_RULES
+from .extract import (
+    _ExtractWriter,
+    compute_body_rect,
+    locate_terms,
+    filter_entities_with_context,
+    resolve_lazy_docs,
+    make_snippets,
+    NLP_BATCH_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+# output riscritti da _ExtractWriter: salvati in .prev durante il re-filtro
+# e rimessi al loro posto se qualcosa va storto
+REFILTER_OUTPUTS = (
+    "annale_toponimi.csv",
+    "annale_toponimi_esclusi.csv",
+    ATTEST_NDJSON_NAME,
+    TAGGED_NDJSON_NAME,
+    ATTEST_INDEX_NAME,
+)
+
+
+class _PrevAttestations:
+    """
+    Attestazioni della run precedente lette in parallelo alle pagine (stesso
+    ordine): box e snippet per (pagina, termine) senza caricarle tutte.
+    """
+
+    def __init__(self, path: str):
+        self._f = open(path, "r", encoding="utf-8") if os.path.exists(path) else None
+        self._pending: Optional[Dict] = None
+
+    def _next(self) -> Optional[Dict]:
+        if self._pending is not None:
+            occ, self._pending = self._pending, None
+            return occ
+        if self._f is None:
+            return None
+        for line in self._f:
+            line = line.strip()
+            if line:
+                return json.loads(line)
+        return None
+
+    def page(self, idx: int) -> Dict[str, Dict]:
+        """{termine: attestazione} della pagina `idx` (0-based)."""
+        out: Dict[str, Dict] = {}
+        while True:
+            occ = self._next()
+            if occ is None:
+                return out
+            occ_idx = occ.get("pdf_page_index")
+            if occ_idx is None or occ_idx < idx:
+                continue
+            if occ_idx > idx:
+                self._pending = occ
+                return out
+            out[occ["term"]] = occ
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+
+
+def _batches(it: Iterator, n: int) -> Iterator[List]:
+    batch: List = []
+    for x in it:
+        batch.append(x)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class _NewBoxes:
+    """Box dei termini nuovi su una pagina: apre il PDF solo se serve."""
+
+    def __init__(self, pdf_path: Optional[str]):
+        self.pdf_path = pdf_path
+        self.pages = 0
+        self._doc = None
+
+    def locate(self, idx: int, terms: List[str]) -> Dict[str, List]:
+        if not terms or not self.pdf_path:
+            return {}
+        if self._doc is None:
+            import fitz  # PyMuPDF
+            self._doc = fitz.open(self.pdf_path)
+        page = self._doc.load_page(idx)
+        self.pages += 1
+        return {
+            term: [[float(r.x0), float(r.y0), float(r.x1), float(r.y1)] for r in rects if r is not None]
+            for term, rects in locate_terms(page, compute_body_rect(page), terms).items()
+        }
+
+    def close(self):
+        if self._doc is not None:
+            self._doc.close()
+
+
+def phase_refilter(out_dir: str, rules: Optional[ContextRules] = None,
+                   overrides: Optional[Dict] = None,
+                   batch_size: int = NLP_BATCH_SIZE,
+                   pdf_path: Optional[str] = None) -> Dict:
+    """
+    Rigenera gli output di phase_extract() dai Doc salvati, con `rules`
+    (default: DEFAULT_RULES) modificate da `overrides` (vedi
+    ContextRules.with_overrides, es. {"always_allow": {"add": ["Cerignola"]}}).
+    `pdf_path`: PDF del job, serve solo per i box dei termini nuovi.
+
+    Ritorna un dict con i path dei CSV e i conteggi delle pagine.
+    """
+    store = DocStore(out_dir)
+    if not store.available():
+        raise FileNotFoundError(
+            f"Doc dell'estrazione non trovati in {out_dir}: rilanciare phase_extract"
+        )
+    rules = (rules or DEFAULT_RULES).with_overrides(overrides)
+
+    t0 = time.perf_counter()
+    backups = {}
+    for name in REFILTER_OUTPUTS:
+        path = os.path.join(out_dir, name)
+        if os.path.exists(path):
+            os.replace(path, path + ".prev")
+            backups[path] = path + ".prev"
+    prev_path = os.path.join(out_dir, ATTEST_NDJSON_NAME) + ".prev"
+    prev = _PrevAttestations(prev_path)
+    new_boxes = _NewBoxes(pdf_path)
+
+    n_pages = n_docs = n_missing = 0
+    # il manifest vecchio si legge mentre _ExtractWriter scrive il nuovo (.tmp)
+    writer = None
+    try:
+        writer = _ExtractWriter(out_dir, store)
+        for batch in _batches(store.iter_pages(), max(1, int(batch_size))):
+            docs = [None if p.get("skipped") else store.get(p["index"]) for p in batch]
+
+            # Doc completi: regole direttamente; Doc solo-NER: due livelli
+            results: Dict[int, tuple] = {}
+            lazy = [k for k, d in enumerate(docs)
+                    if d is not None and d.user_data.get("context_mode") == "lazy"]
+            for k, d in enumerate(docs):
+                if d is not None and k not in lazy:
+                    spans: List = []
+                    selected, excluded = filter_entities_with_context(d, rules, spans)
+                    results[k] = (selected, excluded, spans)
+            # finestre con la pipeline del profilo che ha prodotto il Doc
+            for prof in ordered_unique(docs[k].user_data.get("profile") or "" for k in lazy):
+                ks = [k for k in lazy if (docs[k].user_data.get("profile") or "") == prof]
+                for k, res in zip(ks, resolve_lazy_docs([docs[k] for k in ks], batch_size=batch_size,
+                                                        rules=rules, profile=prof or None)):
+                    results[k] = res
+
+            for k, page in enumerate(batch):
+                n_pages += 1
+                old = prev.page(page["index"])
+                if k in results:
+                    n_docs += 1
+                    selected, excluded, spans = results[k]
+                    candidates = ordered_unique(selected)
+                    span_by_term: Dict[str, tuple] = {}
+                    for term, span in zip(selected, spans):
+                        span_by_term.setdefault(term, tuple(span))
+                    snippets = make_snippets(docs[k].text, candidates, span_by_term)
+                    located = new_boxes.locate(page["index"], [t for t in candidates if t not in old])
+                    terms = [{
+                        "term": t,
+                        "boxes": old[t]["boxes"] if t in old else located.get(t, []),
+                        "snippet": snippets[t],
+                    } for t in candidates]
+                    pre_excluded = [[t, r] for t, r in excluded]
+                else:
+                    if not page.get("skipped"):
+                        n_missing += 1
+                    candidates = page.get("candidates") or []
+                    pre_excluded = page.get("pre_excluded") or []
+                    terms = [{
+                        "term": t,
+                        "boxes": (old.get(t) or {}).get("boxes") or [],
+                        "snippet": (old.get(t) or {}).get("snippet") or "",
+                    } for t in candidates]
+
+                writer.add_page({
+                    "index": page["index"],
+                    "page_label": page["page_label"],
+                    "id_found": page.get("id_found"),
+                    "year_found": page.get("year_found"),
+                    "candidates": candidates,
+                    "pre_excluded": pre_excluded,
+                    "terms": terms,
+                    "skipped": page.get("skipped"),
+                })
+        writer.close()
+    except BaseException:
+        # output della run precedente di nuovo al loro posto
+        prev.close()
+        if writer is not None:
+            writer.abort()
+        for name in REFILTER_OUTPUTS:
+            path = os.path.join(out_dir, name)
+            if path in backups:
+                os.replace(backups[path], path)
+            elif os.path.exists(path):
+                os.remove(path)
+        raise
+    finally:
+        prev.close()
+        new_boxes.close()
+    for bak in backups.values():
+        os.remove(bak)
+
+    elapsed = time.perf_counter() - t0
+    logger.info("Re-filtro: %d pagine (%d dai Doc salvati) in %.2fs",
+                n_pages, n_docs, elapsed)
+    return {
+        "csv": writer.csv_path,
+        "exclusions": writer.excl_csv,
+        "attestazioni": writer.attest_path,
+        "pages": n_pages,
+        "pages_from_docs": n_docs,
+        "pages_without_docs": n_missing,
+        "pages_relocated": new_boxes.pages,
+        "seconds": round(elapsed, 3),
+    }
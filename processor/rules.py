@@ -0,0 +1,456 @@
+# processor/rules.py
+"""
+Motore delle euristiche di contesto per i candidati toponimi (LOC/GPE).
+
+Insiemi di parole e pattern sono compilati UNA volta (ContextRules); le
+caratteristiche dei token (forma normalizzata, verbo di luogo) e il testo
+delle frasi vengono calcolati al più una volta per Doc (DocFeatures) e
+condivisi da tutte le entità: il costo per entità resta costante anche
+su pagine fitte di toponimi.
+
+Le regole sono divise in due livelli (vedi context_mode="lazy" in extract.py):
+- pre_exclusion / cheap_context: usano solo il testo dei token;
+- deep_context: usano pos_, lemma_ e la frase (tagger/parser).
+
+Il risultato è lo stesso delle vecchie regex costruite per entità:
+  verbo (risiede, nato, ...) seguito entro 80 caratteri dal toponimo,
+  toponimo seguito da ", addì" / ", li" / ", 12 marzo".
+"""
+
+from __future__ import annotations
+
+import re
+import hashlib
+from bisect import bisect_right
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Iterable
+
+from .utils import normalize_name
+
+DROP_IF_EXACT = set(map(str.lower, """
+Ministero Interno Direzione Generale Pubblica Sicurezza Servizio
+Governo Stato Regno Capitale Prefettura Questura
+""".strip().split()))
+
+PERSON_TITLES = {
+    "sig", "sig.", "sig.ra", "sig.na", "on.", "onorevole", "dott.", "dott", "prof.", "prof",
+    "ing.", "ing", "avv.", "avv", "mons.", "mons", "cav.", "cav", "prefetto", "questore",
+    "ministro", "direttore", "sottosegretario"
+}
+
+LOC_VERBS = {
+    "risiedere", "risiede", "risiedono", "domiciliare", "domiciliato", "domiciliata",
+    "abitare", "abita", "abitano", "nascere", "nato", "nata", "provenire", "proveniente",
+    "recarsi", "recatosi", "tornare", "tornato", "emigrare", "emigrato", "oriundo", "residente",
+    "resiedeva", "dimorare", "dimora", "trasferirsi", "trasferito", "fermare", "arrestato", "arrestato a"
+}
+
+LOC_PREPS = {
+    "a", "ad", "da", "di", "in", "nel", "nella", "nelle", "nello", "nei", "degli", "dei",
+    "della", "dello", "delle", "sul", "sulla", "sullo", "sui", "sulle", "presso", "tra", "fra"
+}
+
+ADDR_WORDS = {
+    "via", "viale", "piazza", "corso", "largo", "strada", "vicolo", "piazzale"
+}
+
+COMMON_FIRST_NAMES = {
+    "alberto","angelica","angel","antonio","antonietta","anzlovar","aristide","auriti","ausenda",
+    "bagnoli","balduini","balestri","ballarini","bancone","barbato","barbusse","bartocci","bartoli","basile",
+    "celeste","duilio","feltre","franca","giacinto","gigante","luigi","nullo","renato","vincenzo","vincent",
+    "benigni","cerruti","azzi","aprato","alessandro","giuseppe","giovanni","maria","mario",
+    "enzo","pasquale","francesco","paolo","pietro","salvatore","roberto","giorgio","grazia","graziano",
+    "carlo","claudio","fabrizio","giulia","valentina","stefano","simone","riccardo","chiara","celestino"
+}
+
+ALWAYS_ALLOW = {
+    "roma","milano","torino","napoli","genova","bologna","firenze","venezia","palermo","catania",
+    "bari","foggia","cerignola","lecce","taranto","brindisi","andria","barletta","trani",
+    "verona","padova","treviso","vicenza","udine","trieste","trento","bolzano","brescia","bergamo",
+    "como","varese","monza","pavia","piacenza","parma","modena","reggio emilia","ravenna","rimini",
+    "forlì","cesena","ancona","pesaro","urbino","perugia","terni","l'aquila","pescara","chieti",
+    "campobasso","potenza","catanzaro","reggio calabria","cagliari","sassari","aosta","matera","latina",
+    "viterbo","rieti","frosinone","novara","alessandria","asti","biella","cuneo","savona","la spezia",
+    "prato","pisa","lucca","arezzo","siena","grosseto","livorno"
+}
+
+
+
+MONTHS = r"gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre"
+
+# verbi di residenza/provenienza cercati nel testo della frase (senza \b iniziale,
+# come la regex originale)
+LOC_VERB_PATTERN = (
+    r"(risied\w+|resident\w+|domicili\w+|abit\w+|nato|nata|provenient\w+|"
+    r"recat\w+|tornat\w+|emigrat\w+|oriundo|dimor\w+|trasferit\w+|arrestat\w+)"
+)
+# distanza massima (caratteri) tra fine del verbo e inizio del toponimo
+LOC_VERB_MAX_GAP = 80
+
+# tutte le posizioni in cui inizia un verbo (anche sovrapposte)
+_VERB_START_RE = re.compile(r"(?=" + LOC_VERB_PATTERN + r")", re.IGNORECASE)
+# lunghezza minima di ogni alternativa (prefisso + almeno un carattere per \w+)
+_VERB_MIN_LEN = {
+    alt.replace(r"\w+", "").lower(): len(alt.replace(r"\w+", "")) + (1 if alt.endswith(r"\w+") else 0)
+    for alt in LOC_VERB_PATTERN[1:-1].split("|")
+}
+# dopo il toponimo: ", addì" / ", li" / ", 12 marzo"
+_DATE_AFTER_RE = re.compile(
+    rf"\s*,\s*(?:add[iì]|li|\d{{1,2}}\s+(?:{MONTHS}))", re.IGNORECASE
+)
+# punteggiatura tolta ai bordi del testo di un'entità
+ENTITY_STRIP_CHARS = " ’'\",.;:()[]"
+
+_WORD_CHAR_RE = re.compile(r"\w")
+_SPACES_RE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=65536)
+def _norm(s: str) -> str:
+    """normalize_name() con cache: le stesse parole ricorrono su tutte le pagine."""
+    return normalize_name(s)
+
+
+def _is_word(s: str, i: int) -> bool:
+    return 0 <= i < len(s) and _WORD_CHAR_RE.match(s[i]) is not None
+
+
+def _find_all_ci(text: str, text_lower: str, needle: str) -> Iterable[int]:
+    """Posizioni (anche sovrapposte) di `needle` in `text`, senza distinguere maiuscole."""
+    if len(text_lower) != len(text):
+        # lower() ha cambiato la lunghezza (caratteri Unicode particolari):
+        # le posizioni non sono più allineate, usiamo la regex
+        return [m.start() for m in re.finditer(r"(?=" + re.escape(needle) + r")", text, re.IGNORECASE)]
+    needle = needle.lower()
+    out = []
+    i = text_lower.find(needle)
+    while i >= 0:
+        out.append(i)
+        i = text_lower.find(needle, i + 1)
+    return out
+
+
+class _SentenceText:
+    """Testo di una frase con le posizioni dei verbi di luogo, calcolati una volta."""
+
+    def __init__(self, raw_text: str):
+        self.raw = raw_text
+        self.raw_lower = raw_text.lower()
+        self.flat = _SPACES_RE.sub(" ", raw_text)
+        self.flat_lower = self.flat.lower()
+        self._verbs = None
+
+    def verb_spans(self) -> List[Tuple[int, int]]:
+        """
+        [(fine_minima, fine_massima), ...] dei verbi in `flat`: con \w+ la
+        regex può terminare il verbo in qualsiasi punto della parola.
+        """
+        if self._verbs is None:
+            spans = []
+            for m in _VERB_START_RE.finditer(self.flat):
+                p, word = m.start(), m.group(1)
+                lw = word.lower()
+                min_len = next(
+                    (n for pre, n in _VERB_MIN_LEN.items() if lw.startswith(pre)),
+                    len(word),
+                )
+                spans.append((p + min_len, p + len(word)))
+            self._verbs = spans
+        return self._verbs
+
+
+class DocFeatures:
+    """
+    Caratteristiche di token e frasi di un Doc spaCy, calcolate al primo
+    uso e poi riusate da tutte le entità del Doc.
+    """
+
+    def __init__(self, doc, rules: "ContextRules"):
+        self.doc = doc
+        self.rules = rules
+        n = len(doc)
+        self._norm: List[Optional[str]] = [None] * n
+        self._title: List[Optional[str]] = [None] * n
+        self._verb: List[Optional[bool]] = [None] * n
+        self._sent_bounds: Optional[Tuple[List[int], List[int]]] = None
+        self._sents: Dict[Tuple[int, int], _SentenceText] = {}
+
+    def norm(self, i: int) -> str:
+        v = self._norm[i]
+        if v is None:
+            v = self._norm[i] = _norm(self.doc[i].text)
+        return v
+
+    def title_norm(self, i: int) -> str:
+        v = self._title[i]
+        if v is None:
+            v = self._title[i] = _norm(self.doc[i].text.strip(".’'"))
+        return v
+
+    def is_loc_verb(self, i: int) -> bool:
+        v = self._verb[i]
+        if v is None:
+            t = self.doc[i]
+            v = self._verb[i] = (
+                t.pos_ in {"VERB", "AUX"} and (t.lemma_ or t.text).lower() in self.rules.loc_verbs
+            )
+        return v
+
+    def sentence(self, ent) -> _SentenceText:
+        """
+        Come ent.sent (la frase che contiene ent.start, anche se l'entità
+        prosegue nella frase dopo), ma con i confini di frase letti una
+        volta per Doc invece di scorrere i token per ogni entità.
+        """
+        if self._sent_bounds is None:
+            sents = list(self.doc.sents)
+            self._sent_bounds = ([s.start for s in sents], [s.end for s in sents])
+        starts, ends = self._sent_bounds
+        k = bisect_right(starts, ent.start) - 1
+        start, end = starts[k], ends[k]
+        st = self._sents.get((start, end))
+        if st is None:
+            st = self._sents[(start, end)] = _SentenceText(self.doc[start:end].text)
+        return st
+
+
+# insiemi di parole sostituibili (argomenti di ContextRules / chiavi di with_overrides)
+RULE_SETS = ("drop_if_exact", "person_titles", "loc_verbs", "loc_preps",
+             "addr_words", "common_first_names", "always_allow")
+
+
+class ContextRules:
+    """
+    Euristiche di contesto compilate. Gli insiemi di default sono quelli
+    del modulo; si possono sostituire per costruire un set di regole diverso
+    (costruttore, oppure with_overrides() a partire da regole esistenti).
+    """
+
+    def __init__(self,
+                 drop_if_exact: Optional[Iterable[str]] = None,
+                 person_titles: Optional[Iterable[str]] = None,
+                 loc_verbs: Optional[Iterable[str]] = None,
+                 loc_preps: Optional[Iterable[str]] = None,
+                 addr_words: Optional[Iterable[str]] = None,
+                 common_first_names: Optional[Iterable[str]] = None,
+                 always_allow: Optional[Iterable[str]] = None):
+        self.drop_if_exact = frozenset(DROP_IF_EXACT if drop_if_exact is None else drop_if_exact)
+        self.person_titles = frozenset(PERSON_TITLES if person_titles is None else person_titles)
+        self.loc_verbs = frozenset(LOC_VERBS if loc_verbs is None else loc_verbs)
+        self.loc_preps = frozenset(LOC_PREPS if loc_preps is None else loc_preps)
+        self.addr_words = frozenset(ADDR_WORDS if addr_words is None else addr_words)
+        self.common_first_names = frozenset(
+            COMMON_FIRST_NAMES if common_first_names is None else common_first_names
+        )
+        self.always_allow = frozenset(ALWAYS_ALLOW if always_allow is None else always_allow)
+        self._fingerprint: Optional[str] = None
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Impronta degli insiemi di regole: due ContextRules con le stesse
+        parole hanno la stessa impronta anche in processi diversi (serve a
+        riconoscere i Doc già annotati con queste regole, vedi component.py).
+        """
+        if self._fingerprint is None:
+            h = hashlib.sha1()
+            for name in RULE_SETS:
+                h.update(name.encode("utf-8"))
+                h.update("\x00".join(sorted(getattr(self, name))).encode("utf-8"))
+                h.update(b"\x01")
+            self._fingerprint = h.hexdigest()[:16]
+        return self._fingerprint
+
+    def features(self, doc) -> DocFeatures:
+        return DocFeatures(doc, self)
+
+    def with_overrides(self, overrides: Optional[Dict]) -> "ContextRules":
+        """
+        Nuove regole a partire da queste. `overrides` = {insieme: valori}:
+          - lista        -> sostituisce l'insieme;
+          - {"add": [...], "remove": [...]} -> lo modifica.
+        Insiemi: RULE_SETS (anche in maiuscolo, es. "ALWAYS_ALLOW"). I valori
+        sono confrontati come nelle regole: forma normalizzata (minuscolo,
+        senza accenti), solo minuscolo per i lemmi di loc_verbs.
+        """
+        sets = {name: set(getattr(self, name)) for name in RULE_SETS}
+        for key, value in (overrides or {}).items():
+            name = str(key).strip().lower()
+            if name not in RULE_SETS:
+                raise ValueError(f"insieme di regole sconosciuto: {key}")
+            fix = (lambda v: str(v).strip().lower()) if name == "loc_verbs" else _norm
+            if isinstance(value, dict):
+                unknown = set(value) - {"add", "remove"}
+                if unknown:
+                    raise ValueError(f"{key}: chiavi ammesse add/remove, non {sorted(unknown)}")
+                sets[name] |= {fix(v) for v in value.get("add") or []}
+                for v in value.get("remove") or []:
+                    sets[name].discard(fix(v))
+                    sets[name].discard(str(v).strip().lower())
+            elif isinstance(value, (list, tuple, set)):
+                sets[name] = {fix(v) for v in value}
+            else:
+                raise ValueError(f"{key}: attesa una lista o {{add, remove}}")
+        return ContextRules(**sets)
+
+    # ---- livello 1: solo testo dei token ----
+
+    def pre_exclusion(self, f: DocFeatures, ent, norm: str) -> Optional[str]:
+        """
+        Scarti che dipendono solo dal testo dei token (dopo il controllo
+        empty/has_digit e il dedup): motivo dello scarto o None.
+        """
+        if norm in self.drop_if_exact:
+            return "institution_term"
+
+        if ent.end - ent.start > 4:
+            return "too_many_tokens"
+
+        if all(f.norm(i) in self.common_first_names for i in range(ent.start, ent.end)):
+            return "all_common_first_names"
+
+        if ent.start > 0:
+            prev = f.doc[ent.start - 1].text
+            if prev.endswith(".") and len(prev) <= 3:
+                return "prev_initial"
+
+        if any(f.title_norm(i) in self.person_titles
+               for i in range(max(0, ent.start - 4), ent.start)):
+            return "left_person_title"
+        return None
+
+    def cheap_context(self, f: DocFeatures, ent, norm: str) -> bool:
+        """
+        Contesto spaziale dai soli token: preposizione nelle 4 parole a
+        sinistra, "in/a ... via/piazza" a destra, ALWAYS_ALLOW.
+        """
+        doc = f.doc
+        left_words = [f.norm(i) for i in range(max(0, ent.start - 4), ent.start)
+                      if doc[i].is_alpha]
+        if any(w in self.loc_preps for w in left_words):
+            return True
+
+        if any(w in {"in", "a"} for w in left_words):
+            right_words = [f.norm(i) for i in range(ent.end, min(len(doc), ent.end + 6))
+                           if doc[i].is_alpha]
+            if any(w in self.addr_words for w in right_words[:4]):
+                return True
+
+        return norm in self.always_allow
+
+    # ---- livello 2: pos_, lemma_, frase ----
+
+    def deep_context(self, f: DocFeatures, ent, raw: str) -> bool:
+        """
+        Verbo di residenza/provenienza (pos_ + lemma_) nei 10 token a
+        sinistra, oppure verbo / data nella stessa frase (ent.sent).
+        """
+        if any(f.is_loc_verb(i) for i in range(max(0, ent.start - 10), ent.start)):
+            return True
+
+        st = f.sentence(ent)
+        n = len(raw)
+
+        # verbo_pat + ".{0,80}\b" + raw + "\b" sul testo a spazi compressi
+        verbs = st.verb_spans()
+        if verbs:
+            s = st.flat
+            for r in _find_all_ci(s, st.flat_lower, raw):
+                if _is_word(s, r - 1) == _is_word(s, r):
+                    continue
+                if _is_word(s, r + n - 1) == _is_word(s, r + n):
+                    continue
+                if any(e_min <= r <= e_max + LOC_VERB_MAX_GAP for e_min, e_max in verbs):
+                    return True
+
+        # "\b" + raw + "\s*,\s*(addì|li|12 marzo)" sul testo originale della frase
+        s = st.raw
+        for r in _find_all_ci(s, st.raw_lower, raw):
+            if _is_word(s, r - 1) == _is_word(s, r):
+                continue
+            if _DATE_AFTER_RE.match(s, r + n):
+                return True
+        return False
+
+    # ---- verdetti per Doc ----
+
+    def verdicts(self, doc, f: Optional[DocFeatures] = None) -> List[Tuple]:
+        """
+        Primo passaggio sulle entità LOC/GPE, indipendente dal dedup:
+        [(ent, raw, norm, verdetto), ...] con verdetto
+          ("empty"|"has_digit", None) | ("excluded", motivo)
+          | ("selected", None) | ("pending", None)
+        "pending" = decidono solo le regole di deep_context().
+        """
+        f = f or self.features(doc)
+        out = []
+        for ent in doc.ents:
+            if ent.label_ not in ("LOC", "GPE"):
+                continue
+            raw = entity_raw(ent)
+            if not raw:
+                out.append((ent, ent.text, None, ("empty", None)))
+                continue
+            if any(ch.isdigit() for ch in raw):
+                out.append((ent, raw, None, ("has_digit", None)))
+                continue
+            norm = _norm(raw)
+            reason = self.pre_exclusion(f, ent, norm)
+            if reason:
+                out.append((ent, raw, norm, ("excluded", reason)))
+            elif self.cheap_context(f, ent, norm):
+                out.append((ent, raw, norm, ("selected", None)))
+            else:
+                out.append((ent, raw, norm, ("pending", None)))
+        return out
+
+
+def entity_raw(ent) -> str:
+    """Testo dell'entità a spazi compressi, senza punteggiatura ai bordi."""
+    return _SPACES_RE.sub(" ", ent.text).strip(ENTITY_STRIP_CHARS)
+
+
+def pending_needed(verdicts: List[Tuple]) -> List[int]:
+    """
+    Entità "pending" che vanno davvero risolte: se la stessa forma
+    normalizzata è già selezionata da un'entità precedente (regole
+    economiche), quella pending verrà comunque saltata dal dedup.
+    """
+    needed = []
+    sure = set()
+    for i, (ent, raw, norm, (verdict, _)) in enumerate(verdicts):
+        if norm is None or norm in sure:
+            continue
+        if verdict == "selected":
+            sure.add(norm)
+        elif verdict == "pending":
+            needed.append(i)
+    return needed
+
+
+def entity_statuses(verdicts: List[Tuple], deep: Dict[int, bool]) -> List[Tuple[str, Optional[str]]]:
+    """
+    Secondo passaggio, in ordine di testo: esito finale di ogni entità di
+    `verdicts`, dopo il dedup per forma normalizzata. `deep[i]` = esito di
+    deep_context() per l'entità i-esima in stato "pending".
+    Esiti: ("kept", None) | ("excluded", motivo) | ("duplicate", None)
+    (stessa forma di un toponimo già tenuto più sopra nella pagina).
+    """
+    out: List[Tuple[str, Optional[str]]] = []
+    seen_norm = set()
+    for i, (ent, raw, norm, (verdict, reason)) in enumerate(verdicts):
+        if verdict in ("empty", "has_digit"):
+            out.append(("excluded", verdict))
+        elif norm in seen_norm:
+            out.append(("duplicate", None))
+        elif verdict == "excluded":
+            out.append(("excluded", reason))
+        elif verdict == "pending" and not deep.get(i, False):
+            out.append(("excluded", "no_spatial_context"))
+        else:
+            seen_norm.add(norm)
+            out.append(("kept", None))
+    return out
+
+
+DEFAULT_RULES = ContextRules()
@@ -94,6 +94,18 @@ def parse_include_ranges(ranges: str, total_pages: int) -> Optional[List[Tuple[i
     return merged
 
 
+def iter_included_indices(includes: Optional[List[Tuple[int,int]]], total_pages: int):
+    """
+    Indici 0-based delle pagine incluse, in ordine, scorrendo direttamente
+    i range fusi di parse_include_ranges (niente scansione di tutto il PDF).
+    """
+    if not includes:
+        yield from range(total_pages)
+        return
+    for a, b in includes:
+        yield from range(max(0, a), min(total_pages - 1, b) + 1)
+
+
 def index_in_includes(idx: int, includes: Optional[List[Tuple[int,int]]]) -> bool:
     """True se idx (0-based) rientra nei range dati."""
     if not includes:
@@ -111,7 +123,7 @@ def index_in_includes(idx: int, includes: Optional[List[Tuple[int,int]]]) -> boo
 def list_outputs(job_dir: str) -> Dict[str, str]:
     """
     Restituisce i file disponibili con il relativo path scaricabile dal server.
-    Inclusi i nuovi file annale_attestazioni.json e annale_tagged.json.
+    Inclusi i nuovi file annale_attestazioni.ndjson e annale_tagged.ndjson.
     """
     out: Dict[str, str] = {}
     candidate_names = [
@@ -124,18 +136,24 @@ def list_outputs(job_dir: str) -> Dict[str, str]:
         "annale_toponimi_grouped.geojson",       # geocoding raggruppato
         "annale_toponimi_osm_rejects.csv",
         "annale_toponimi_grouped_rejects.csv",   # reject raggruppato
-        "geocache_toponyms.json",
+        "geocache_toponyms.json",                # geocache vecchio formato
+        "geocache_toponyms.sqlite",              # geocache (geocache.py)
         "annale_osm_debug_last.json",
         "geocode_progress.json",
-        "annale_attestazioni.json",              # NEW: indice attestazioni per pagina
-        "annale_tagged.json",                    # NEW: snippet testuali/tagging
+        "extract_progress.json",
+        "annale_attestazioni.ndjson",            # NEW: attestazioni, una riga ciascuna
+        "annale_attestazioni_index.json",        # NEW: indice compatto per toponimo
+        "annale_tagged.ndjson",                  # NEW: snippet testuali/tagging
         "annale_user_exclusions.json",           # stato esclusioni utente
     ]
+    jid = os.path.basename(job_dir)
     for name in candidate_names:
         p = os.path.join(job_dir, name)
         if os.path.exists(p):
-            jid = os.path.basename(job_dir)
             out[name] = f"/files/{jid}/{name}"
+    # PDF marcato come overlay incrementale: il server lo ricompone al volo
+    if os.path.exists(os.path.join(job_dir, "annale_marked.overlay")):
+        out["annale_marked.pdf"] = f"/files/{jid}/annale_marked.pdf"
     return out
 
 
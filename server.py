@@ -11,7 +11,7 @@ import unicodedata
 import threading
 from typing import Dict, List, Tuple, Any, Set
 
-from flask import Flask, request, send_from_directory, jsonify, abort
+from flask import Flask, Response, request, send_from_directory, jsonify, abort
 from werkzeug.utils import secure_filename
 
 # importiamo le funzioni "pesanti" dalla pipeline esistente
@@ -19,7 +19,16 @@ from werkzeug.utils import secure_filename
 from processor import (
     phase_extract,
     phase_geocode_grouped,
+    set_geocode_correction,
     list_outputs,
+    preload_async,
+    model_status,
+    ensure_marked_pdf,
+    iter_marked_pdf,
+    read_term_occurrences,
+    phase_refilter,
+    EXTRACT_PROFILES,
+    describe_profiles,
 )
 
 # =====================================================
@@ -33,6 +42,29 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
 ALLOWED_EXTENSIONS = {"pdf"}
 
+# id dei job come li crea make_job_dir(): niente path arbitrari sotto
+# UPLOAD_ROOT (né "..", né cartelle che non sono job)
+JOB_ID_RE = re.compile(r"[0-9a-f]{12}")
+
+# SPACY_PRELOAD=1 -> carica il modello spaCy in background all'avvio,
+# così la prima estrazione parte subito
+SPACY_PRELOAD = os.environ.get("SPACY_PRELOAD", "0").strip().lower() in {"1", "true", "yes"}
+
+# Marcatura del PDF (annale_marked.pdf) dopo l'estrazione:
+#   background -> costruito in un thread appena finisce l'estrazione
+#   lazy       -> costruito alla prima richiesta del file (viewer/download)
+#   off        -> saltato: il viewer mostra il PDF originale
+MARK_MODES = {"background", "lazy", "off"}
+MARK_PDF = os.environ.get("MARK_PDF", "background").strip().lower()
+if MARK_PDF not in MARK_MODES:
+    MARK_PDF = "background"
+
+# Forma del PDF marcato (default: MARK_OUTPUT del processor):
+#   full        -> tutto il PDF
+#   subset      -> solo le pagine elaborate (etichette = numerazione originale)
+#   incremental -> overlay con le sole annotazioni, accodato ad annale.pdf al download
+MARK_OUTPUTS = {"full", "subset", "incremental"}
+
 app = Flask(
     __name__,
     static_folder=os.path.join(BASE_DIR, "static"),
@@ -55,6 +87,20 @@ def make_job_dir() -> Tuple[str, str]:
     return jid, job_dir
 
 
+@app.before_request
+def _check_job_id():
+    """Rifiuta le richieste con un job_id che make_job_dir() non può aver creato."""
+    if request.view_args and "job_id" in request.view_args:
+        if not JOB_ID_RE.fullmatch(request.view_args["job_id"]):
+            abort(404)
+        return None
+    data = request.get_json(silent=True) if request.is_json else None
+    jid = data.get("job_id") if isinstance(data, dict) else request.args.get("job_id")
+    if jid and not JOB_ID_RE.fullmatch(str(jid).strip()):
+        return jsonify({"ok": False, "error": "job_id non valido"}), 400
+    return None
+
+
 def _progress_path(job_dir: str) -> str:
     return os.path.join(job_dir, "geocode_progress.json")
 
@@ -86,6 +132,135 @@ def _geocode_worker(job_dir: str):
                         f"error: {type(e).__name__}: {e}", "error")
 
 
+def _extract_progress_path(job_dir: str) -> str:
+    return os.path.join(job_dir, "extract_progress.json")
+
+
+def _write_extract_progress(job_dir: str, done: int, total: int,
+                            current=None, status: str = "running",
+                            started_at: float = None, mark: str = None,
+                            mark_output: str = None):
+    """
+    Stessa forma di geocode_progress.json, più velocità ed ETA:
+    pages_per_sec calcolato dall'avvio del job, eta_seconds sulle pagine mancanti.
+    """
+    elapsed = (time.time() - started_at) if started_at else 0.0
+    pps = (done / elapsed) if (elapsed > 0 and done > 0) else 0.0
+    prog = {
+        "status": status,               # starting | running | done | error
+        "done": int(done),
+        "total": int(total),
+        "pct": (0 if total <= 0 else round(done * 100.0 / total, 1)),
+        "current": current,
+        "pages_per_sec": round(pps, 2),
+        "eta_seconds": (round((total - done) / pps, 1) if pps > 0 else None),
+        "elapsed_seconds": round(elapsed, 1),
+        "mark": mark,                   # modalità di marcatura del PDF
+        "mark_output": mark_output,     # forma del PDF marcato (None = default)
+    }
+    # scrittura atomica: chi fa polling non legge mai un file a metà
+    path = _extract_progress_path(job_dir)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(prog, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _marking_worker(job_dir: str, pdf_path: str, mark_output: str = None):
+    """Thread worker: costruisce annale_marked.pdf dalle attestazioni."""
+    try:
+        ensure_marked_pdf(pdf_path, job_dir, mark_output)
+    except Exception as e:
+        app.logger.warning("Marcatura PDF fallita (%s): %s", job_dir, e)
+
+
+def _after_extract(job_dir: str, pdf_path: str, mark: str, mark_output: str = None):
+    """Passi comuni a fine estrazione (sincrona o in background)."""
+    # rigenera il CSV filtrato coerente con lo stato utente
+    _rebuild_filtered_csv(job_dir)
+    if mark == "background":
+        threading.Thread(target=_marking_worker, args=(job_dir, pdf_path, mark_output),
+                         daemon=True).start()
+
+
+def _marked_pdf_url(jid: str, job_dir: str, mark: str):
+    """URL del PDF marcato (in lazy/background viene costruito alla prima richiesta)."""
+    if mark == "off" and "annale_marked.pdf" not in list_outputs(job_dir):
+        return None
+    return f"/files/{jid}/annale_marked.pdf"
+
+
+def _extract_worker(job_dir: str, pdf_path: str, ranges: str,
+                    extract_kwargs: Dict[str, Any], mark: str):
+    """Thread worker per l'estrazione in background con callback di progresso."""
+    started_at = time.time()
+    mark_output = extract_kwargs.get("mark_output")
+
+    def cb(done, total, current_page):
+        _write_extract_progress(job_dir, done, total, current_page, "running", started_at,
+                                mark, mark_output)
+
+    try:
+        _write_extract_progress(job_dir, 0, 0, None, "starting", started_at, mark, mark_output)
+        res = phase_extract(pdf_path=pdf_path, out_dir=job_dir, include_ranges=ranges,
+                            progress_cb=cb, **extract_kwargs)
+        _after_extract(job_dir, pdf_path, mark, mark_output)
+        total = res.get("pages_processed", 0)
+        _write_extract_progress(job_dir, total, total, None, "done", started_at, mark, mark_output)
+    except Exception as e:
+        _write_extract_progress(job_dir, 0, 0,
+                                f"error: {type(e).__name__}: {e}", "error", started_at,
+                                mark, mark_output)
+    finally:
+        _release_job(job_dir)
+
+
+# operazioni in corso in questo processo: {job_dir: "extract" | "refilter"}.
+# Lo stato in extract_progress.json non basta: dopo un crash o un riavvio
+# resterebbe "running" per sempre.
+_JOB_TASKS: Dict[str, str] = {}
+_JOB_TASKS_LOCK = threading.Lock()
+
+
+def _claim_job(job_dir: str, task: str) -> bool:
+    """Registra `task` sul job; False se il job ha già un'operazione in corso."""
+    with _JOB_TASKS_LOCK:
+        if job_dir in _JOB_TASKS:
+            return False
+        _JOB_TASKS[job_dir] = task
+        return True
+
+
+def _release_job(job_dir: str):
+    with _JOB_TASKS_LOCK:
+        _JOB_TASKS.pop(job_dir, None)
+
+
+def _extract_running(job_dir: str) -> bool:
+    with _JOB_TASKS_LOCK:
+        return job_dir in _JOB_TASKS
+
+
+def _job_busy_error(job_dir: str) -> str:
+    with _JOB_TASKS_LOCK:
+        task = _JOB_TASKS.get(job_dir)
+    return "Re-filtro in esecuzione" if task == "refilter" else "Estrazione già in esecuzione"
+
+
+def _job_extract_setting(job_dir: str, key: str):
+    """Parametro dell'ultima estrazione registrato in extract_progress.json (o None)."""
+    try:
+        with open(_extract_progress_path(job_dir), "r", encoding="utf-8") as f:
+            return json.load(f).get(key)
+    except Exception:
+        return None
+
+
+def _job_mark_output(job_dir: str):
+    """Forma del PDF marcato chiesta all'ultima estrazione (None = default)."""
+    return _job_extract_setting(job_dir, "mark_output")
+
+
 # =====================================================
 # NORMALIZZAZIONE NOMI / SUPPORTO CSV
 # =====================================================
@@ -104,6 +279,17 @@ def _safe_int(x):
         return None
 
 
+def _str_param(data: Dict[str, Any], key: str, default: str = "") -> str:
+    """Parametro stringa del body JSON: valori di altri tipi vengono convertiti."""
+    return str(data.get(key) or default).strip()
+
+
+def _json_body() -> Dict[str, Any]:
+    """Body JSON della richiesta ({} se assente o non è un oggetto)."""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
 def _best_display(a: str, b: str) -> str:
     """Scegli la forma più breve / semplice tra due versioni del toponimo."""
     if not a:
@@ -495,36 +681,201 @@ def api_upload():
 
 
 # ---------------- ESTRAZIONE PDF -> CSV/PDF MARCATO ----------------
+def _parse_extract_request(data: Dict[str, Any]):
+    """
+    Valida il body di /api/extract e /api/extract_start.
+    Ritorna (jid, job_dir, pdf_path, ranges, extract_kwargs, mark, errore_response).
+    """
+    jid = _str_param(data, "job_id")
+    ranges = _str_param(data, "ranges")
+    mark = _str_param(data, "mark", MARK_PDF).lower()
+
+    if not jid:
+        return None, None, None, None, None, None, (jsonify({"ok": False, "error": "job_id mancante"}), 400)
+    if mark not in MARK_MODES:
+        return None, None, None, None, None, None, (
+            jsonify({"ok": False, "error": f"mark non valido: {mark}"}), 400
+        )
+    job_dir = os.path.join(UPLOAD_ROOT, jid)
+    pdf_path = os.path.join(job_dir, "annale.pdf")
+    if not os.path.exists(pdf_path):
+        return None, None, None, None, None, None, (
+            jsonify({"ok": False, "error": "PDF non trovato per questo job_id"}), 404
+        )
+
+    # parametri opzionali di tuning (se assenti valgono i default del profilo
+    # o del processor)
+    extract_kwargs = {}
+    profile = _str_param(data, "profile").lower()
+    if profile:
+        if profile not in EXTRACT_PROFILES:
+            return None, None, None, None, None, None, (
+                jsonify({"ok": False, "error": f"profile non valido: {profile}"}), 400
+            )
+        extract_kwargs["profile"] = profile
+    batch_size = _safe_int(data.get("batch_size"))
+    if batch_size and batch_size > 0:
+        extract_kwargs["batch_size"] = batch_size
+    workers = _safe_int(data.get("workers"))
+    if workers and workers > 0:
+        extract_kwargs["workers"] = min(workers, os.cpu_count() or 1)
+    context_mode = _str_param(data, "context_mode").lower()
+    if context_mode:
+        if context_mode not in {"full", "lazy"}:
+            return None, None, None, None, None, None, (
+                jsonify({"ok": False, "error": f"context_mode non valido: {context_mode}"}), 400
+            )
+        extract_kwargs["context_mode"] = context_mode
+    mark_output = _str_param(data, "mark_output").lower()
+    if mark_output:
+        if mark_output not in MARK_OUTPUTS:
+            return None, None, None, None, None, None, (
+                jsonify({"ok": False, "error": f"mark_output non valido: {mark_output}"}), 400
+            )
+        extract_kwargs["mark_output"] = mark_output
+
+    return jid, job_dir, pdf_path, ranges, extract_kwargs, mark, None
+
+
 @app.post("/api/extract")
 def api_extract():
-    data = request.get_json(silent=True) or {}
-    jid = (data.get("job_id") or "").strip()
-    ranges = (data.get("ranges") or "").strip()
+    """Estrazione sincrona (compatibilità): per PDF lunghi usare /api/extract_start."""
+    data = _json_body()
+    jid, job_dir, pdf_path, ranges, extract_kwargs, mark, err = _parse_extract_request(data)
+    if err:
+        return err
+    if not _claim_job(job_dir, "extract"):
+        return jsonify({"ok": False, "error": _job_busy_error(job_dir)}), 400
+
+    started_at = time.time()
+    mark_output = extract_kwargs.get("mark_output")
+    try:
+        try:
+            res = phase_extract(pdf_path=pdf_path, out_dir=job_dir, include_ranges=ranges,
+                                **extract_kwargs)
+        except Exception as e:
+            return jsonify({"ok": False, "error": f"extract failed: {type(e).__name__}: {e}"}), 500
+
+        _after_extract(job_dir, pdf_path, mark, mark_output)
+        # come per l'estrazione in background: la marcatura lazy legge mark/mark_output da qui
+        total = res.get("pages_processed", 0)
+        _write_extract_progress(job_dir, total, total, None, "done", started_at, mark, mark_output)
+    finally:
+        _release_job(job_dir)
+
+    return jsonify({
+        "ok": True,
+        "files": list_outputs(job_dir),
+        "marked_pdf_url": _marked_pdf_url(jid, job_dir, mark),
+        "pdf_url": f"/files/{jid}/annale.pdf"
+    })
+
+
+@app.post("/api/extract_start")
+def api_extract_start():
+    """Avvia l'estrazione in un thread; l'avanzamento si legge da /api/extract_progress."""
+    data = _json_body()
+    jid, job_dir, pdf_path, ranges, extract_kwargs, mark, err = _parse_extract_request(data)
+    if err:
+        return err
+
+    # previene doppio worker (il worker libera il job alla fine)
+    if not _claim_job(job_dir, "extract"):
+        return jsonify({"ok": False, "error": _job_busy_error(job_dir)}), 400
+
+    try:
+        _write_extract_progress(job_dir, 0, 0, None, "starting", time.time(), mark,
+                                extract_kwargs.get("mark_output"))
+        t = threading.Thread(target=_extract_worker,
+                             args=(job_dir, pdf_path, ranges, extract_kwargs, mark), daemon=True)
+        t.start()
+    except Exception:
+        _release_job(job_dir)
+        raise
+
+    return jsonify({"ok": True})
+
 
+@app.get("/api/extract_progress")
+def api_extract_progress():
+    jid = (request.args.get("job_id") or "").strip()
+    if not jid:
+        return jsonify({"ok": False, "error": "job_id mancante"}), 400
+    job_dir = os.path.join(UPLOAD_ROOT, jid)
+
+    prog_path = _extract_progress_path(job_dir)
+    if not os.path.exists(prog_path):
+        return jsonify({
+            "ok": True,
+            "status": "idle",
+            "done": 0,
+            "total": 0,
+            "pct": 0.0,
+            "current": None,
+            "pages_per_sec": 0.0,
+            "eta_seconds": None,
+            "files": list_outputs(job_dir)
+        })
+
+    with open(prog_path, "r", encoding="utf-8") as f:
+        prog = json.load(f)
+    if prog.get("status") in {"starting", "running"} and not _extract_running(job_dir):
+        # stato lasciato da un processo che non c'è più (crash, riavvio):
+        # rilanciando l'estrazione si riparte dal checkpoint
+        prog["status"] = "error"
+        prog["current"] = "interrupted: estrazione interrotta, rilanciarla per riprendere"
+    prog["ok"] = True
+    prog["files"] = list_outputs(job_dir)
+    if prog.get("status") == "done":
+        prog["marked_pdf_url"] = _marked_pdf_url(jid, job_dir, prog.get("mark") or MARK_PDF)
+        prog["pdf_url"] = f"/files/{jid}/annale.pdf"
+    return jsonify(prog)
+
+
+@app.post("/api/refilter")
+def api_refilter():
+    """
+    Riapplica le euristiche di contesto ai Doc dell'ultima estrazione, con
+    modifiche agli insiemi di regole (es. {"always_allow": {"add": [...]}}):
+    rigenera CSV ed esclusi senza rileggere il PDF né rifare la NER.
+    """
+    data = _json_body()
+    jid = _str_param(data, "job_id")
     if not jid:
         return jsonify({"ok": False, "error": "job_id mancante"}), 400
     job_dir = os.path.join(UPLOAD_ROOT, jid)
     pdf_path = os.path.join(job_dir, "annale.pdf")
     if not os.path.exists(pdf_path):
         return jsonify({"ok": False, "error": "PDF non trovato per questo job_id"}), 404
+    overrides = data.get("rules") or {}
+    if not isinstance(overrides, dict):
+        return jsonify({"ok": False, "error": "rules deve essere un oggetto"}), 400
+    # il job risulta occupato per tutto il re-filtro (CSV e marcatura)
+    if not _claim_job(job_dir, "refilter"):
+        return jsonify({"ok": False, "error": _job_busy_error(job_dir)}), 400
 
     try:
-        phase_extract(pdf_path=pdf_path, out_dir=job_dir, include_ranges=ranges)
-    except Exception as e:
-        return jsonify({"ok": False, "error": f"extract failed: {type(e).__name__}: {e}"}), 500
-
-    # dopo aver estratto, rigenera il CSV filtrato coerente con lo stato utente
-    _rebuild_filtered_csv(job_dir)
-
-    files = list_outputs(job_dir)
-    marked_pdf_url = None
-    if os.path.exists(os.path.join(job_dir, "annale_marked.pdf")):
-        marked_pdf_url = f"/files/{jid}/annale_marked.pdf"
+        try:
+            res = phase_refilter(job_dir, overrides=overrides, pdf_path=pdf_path)
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+        except FileNotFoundError as e:
+            return jsonify({"ok": False, "error": str(e)}), 409
+        except Exception as e:
+            return jsonify({"ok": False, "error": f"refilter failed: {type(e).__name__}: {e}"}), 500
+
+        mark = _job_extract_setting(job_dir, "mark") or MARK_PDF
+        _after_extract(job_dir, pdf_path, mark, _job_mark_output(job_dir))
+    finally:
+        _release_job(job_dir)
 
     return jsonify({
         "ok": True,
-        "files": files,
-        "marked_pdf_url": marked_pdf_url
+        "files": list_outputs(job_dir),
+        "marked_pdf_url": _marked_pdf_url(jid, job_dir, mark),
+        "pages": res["pages"],
+        "pages_without_docs": res["pages_without_docs"],
+        "seconds": res["seconds"],
     })
 
 
@@ -605,11 +956,16 @@ def api_attestations():
             "occurrences": []
         })
 
+    # snippet dalle sole righe NDJSON di questo toponimo (indice compatto)
+    snippet_by_page = {}
+    for occ in read_term_occurrences(job_dir, nm):
+        snippet_by_page.setdefault(_safe_int(occ.get("page_label")), occ.get("snippet") or "")
+
     occs = []
     for p in info["pages"]:
         occs.append({
             "page_label": p,
-            "snippet": "",
+            "snippet": snippet_by_page.get(_safe_int(p), ""),
             "excluded_specific": False,
         })
 
@@ -625,8 +981,8 @@ def api_attestations():
 # ---------------- SALVATAGGIO ESCLUSIONI / RE-INCLUSIONI ----------------
 @app.post("/api/exclusions")
 def api_exclusions():
-    data = request.get_json(silent=True) or {}
-    jid = (data.get("job_id") or "").strip()
+    data = _json_body()
+    jid = _str_param(data, "job_id")
     if not jid:
         return jsonify({"ok": False, "error": "job_id mancante"}), 400
 
@@ -720,8 +1076,8 @@ def api_exclusions():
 # ---------------- GEOcoding START / PROGRESS ----------------
 @app.post("/api/geocode_start")
 def api_geocode_start():
-    data = request.get_json(silent=True) or {}
-    jid = (data.get("job_id") or "").strip()
+    data = _json_body()
+    jid = _str_param(data, "job_id")
     if not jid:
         return jsonify({"ok": False, "error": "job_id mancante"}), 400
 
@@ -746,6 +1102,36 @@ def api_geocode_start():
     return jsonify({"ok": True})
 
 
+@app.post("/api/geocode_correction")
+def api_geocode_correction():
+    """
+    Correzione del geocoding per un toponimo, solo per questo job:
+    {job_id, name, lat, lon[, display_name]} fissa il punto,
+    {job_id, name, reject: true} lo scarta, {job_id, name, clear: true}
+    torna al risultato di Nominatim. Vale dal prossimo geocoding.
+    """
+    data = _json_body()
+    jid = _str_param(data, "job_id")
+    name = _str_param(data, "name")
+    if not jid or not name:
+        return jsonify({"ok": False, "error": "job_id e name obbligatori"}), 400
+    job_dir = os.path.join(UPLOAD_ROOT, jid)
+    if not os.path.isdir(job_dir):
+        return jsonify({"ok": False, "error": "job non trovato"}), 404
+
+    try:
+        saved = set_geocode_correction(
+            job_dir, name,
+            lat=data.get("lat"), lon=data.get("lon"),
+            display_name=data.get("display_name"),
+            reject=bool(data.get("reject")), clear=bool(data.get("clear")),
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    return jsonify({"ok": True, "name": name, "data": saved})
+
+
 @app.get("/api/geocode_progress")
 def api_geocode_progress():
     jid = (request.args.get("job_id") or "").strip()
@@ -772,6 +1158,15 @@ def api_geocode_progress():
     return jsonify(prog)
 
 
+# ---------------- STATO MODELLO spaCy ----------------
+@app.get("/api/model_status")
+def api_model_status():
+    st = model_status()
+    st["profiles"] = describe_profiles()
+    st["ok"] = True
+    return jsonify(st)
+
+
 # ---------------- LISTA FILE DISPONIBILI ----------------
 @app.get("/api/list")
 def api_list():
@@ -790,6 +1185,17 @@ def files(job_id, filename):
     job_dir = os.path.join(UPLOAD_ROOT, job_id)
     if not os.path.isdir(job_dir):
         abort(404)
+    if filename == "annale_marked.pdf":
+        # PDF marcato costruito al primo download (o atteso se è in corso)
+        pdf_path = os.path.join(job_dir, "annale.pdf")
+        if os.path.exists(pdf_path) and not _extract_running(job_dir):
+            try:
+                marked = ensure_marked_pdf(pdf_path, job_dir, _job_mark_output(job_dir))
+            except Exception as e:
+                return jsonify({"ok": False, "error": f"marking failed: {type(e).__name__}: {e}"}), 500
+            if marked and not os.path.exists(os.path.join(job_dir, filename)):
+                # overlay incrementale: annale.pdf + annotazioni accodate
+                return Response(iter_marked_pdf(pdf_path, job_dir), mimetype="application/pdf")
     return send_from_directory(job_dir, filename, as_attachment=False)
 
 
@@ -805,4 +1211,9 @@ def serve_static(path):
 
 if __name__ == "__main__":
     # debug=True va bene in sviluppo
-    app.run(debug=True)
+    debug = True
+    # con il reloader attivo il modulo gira due volte: precarichiamo solo
+    # nel processo figlio che serve davvero le richieste
+    if SPACY_PRELOAD and (not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        preload_async()
+    app.run(debug=debug)
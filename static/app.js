@@ -7,6 +7,7 @@ let MAP = null;
 let GEOJSON_LAYER = null;
 
 let PROG_TIMER = null;
+let EXTRACT_TIMER = null;
 
 // cache attestazioni per il toponimo incluso aperto
 let ATTEST_CACHE = {};
@@ -534,7 +535,7 @@ async function uploadPDF(file){
 async function doExtract(){
   if(!JOB_ID){ toast('Carica prima un PDF'); return; }
   const ranges = document.getElementById('ranges').value.trim();
-  const r = await fetch('/api/extract', {
+  const r = await fetch('/api/extract_start', {
     method:'POST',
     headers:{'Content-Type':'application/json'},
     body: JSON.stringify({ job_id: JOB_ID, ranges })
@@ -544,16 +545,51 @@ async function doExtract(){
     toast(j.error || 'Errore estrazione');
     return;
   }
+  showProgress(true);
+  setProgress(0, 'Estrazione – inizio');
+  if(EXTRACT_TIMER) clearInterval(EXTRACT_TIMER);
+  EXTRACT_TIMER = setInterval(pollExtractProgress, 900);
+}
 
-  setDownloads(j.files || {});
-  if(j.marked_pdf_url){
-    PDF_URL = j.marked_pdf_url;
-    loadPdfInFrame(1);
-  }
+function formatEta(sec){
+  if(sec == null) return '';
+  const s = Math.round(sec);
+  return s >= 60 ? `${Math.floor(s/60)}m ${s%60}s` : `${s}s`;
+}
 
-  ATTEST_CACHE = {};
-  await refreshToponyms();
-  toast('Estrazione completata');
+async function pollExtractProgress(){
+  if(!JOB_ID) return;
+  const r = await fetch(`/api/extract_progress?job_id=${encodeURIComponent(JOB_ID)}`);
+  const j = await r.json();
+  if(!j.ok){ return; }
+
+  if(j.status === 'starting' || j.status === 'running'){
+    showProgress(true);
+    const page = j.current != null ? ` – p. ${j.current}` : '';
+    const speed = j.pages_per_sec ? ` – ${j.pages_per_sec} pag/s` : '';
+    const eta = j.eta_seconds != null ? ` – ETA ${formatEta(j.eta_seconds)}` : '';
+    setProgress(j.pct || 0, `Estrazione ${j.done}/${j.total}${page}${speed}${eta}`);
+  } else if(j.status === 'done'){
+    clearInterval(EXTRACT_TIMER); EXTRACT_TIMER = null;
+    setProgress(100, 'Estrazione completata');
+    showProgress(false);
+
+    setDownloads(j.files || {});
+    // marked_pdf_url manca se la marcatura è disattivata: mostriamo il PDF originale
+    const pdfUrl = j.marked_pdf_url || j.pdf_url;
+    if(pdfUrl){
+      PDF_URL = pdfUrl;
+      loadPdfInFrame(1);
+    }
+
+    ATTEST_CACHE = {};
+    await refreshToponyms();
+    toast('Estrazione completata');
+  } else if(j.status === 'error'){
+    clearInterval(EXTRACT_TIMER); EXTRACT_TIMER = null;
+    toast(j.current || 'Errore estrazione');
+    showProgress(false);
+  }
 }
 
 